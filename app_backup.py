@@ -6,11 +6,12 @@ from PIL import Image
 import fitz
 from src.openai_utils import rewrite_with_gpt
 from src.pdf_utils import extract_text_blocks, rebuild_pdf
-from src.erase_utils import erase_mode
+from src.erase_utils import erase_sessions
 import pytesseract
 import shutil
 import cv2
 import numpy as np
+import uuid
 
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -25,6 +26,11 @@ if 'processed_images' not in st.session_state:
     st.session_state.processed_images = []
 if 'current_page' not in st.session_state:
     st.session_state.current_page = 0
+if 'erase_session_id' not in st.session_state:
+    st.session_state.erase_session_id = uuid.uuid4().hex
+
+# Erase engine (and undo history) private to this browser session
+erase_mode = erase_sessions.get(st.session_state.erase_session_id)
 
 with st.sidebar:
     st.image("https://img.icons8.com/ios-filled/100/6C63FF/brain.png", width=80)
@@ -131,7 +137,12 @@ if uploaded_file is not None:
                         for block in blocks:
                             original_text = block.get('text', '')
                             if original_text.strip() and not original_text.startswith("OCR failed"):
-                                processed_text = rewrite_with_gpt(original_text)
+                                try:
+                                    processed_text = rewrite_with_gpt(original_text)
+                                except Exception as e:
+                                    # Keep the original text rather than printing the error into the PDF
+                                    st.warning(f"⚠️ Block kept unchanged: {str(e)}")
+                                    processed_text = original_text
                                 processed_blocks.append({
                                     'text': processed_text,
                                     'page': block.get('page', 1),
@@ -223,7 +234,7 @@ if uploaded_file is not None:
                         # Process coordinate-based erasure
                         if x1 != 0 or y1 != 0 or x2 != 100 or y2 != 100:
                             coordinates = [[x1, y1, x2, y2]]
-                            processed_image = erase_mode.erase_text_by_coordinates(
+                            processed_image, _ = erase_mode.erase_text_by_coordinates(
                                 processed_image, coordinates
                             )
                             st.success("✅ Erased text at specified coordinates")
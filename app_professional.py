@@ -317,7 +317,7 @@ with col2:
                 if command and st.button("✨ Apply AI Edit"):
                     with st.spinner("Processing with AI..."):
                         try:
-                            edited_text = rewrite_with_gpt(command, st.session_state.processed_text)
+                            edited_text = rewrite_with_gpt(st.session_state.processed_text)
                             st.session_state.edit_history.append({
                                 'command': command,
                                 'original': st.session_state.processed_text,
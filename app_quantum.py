@@ -4,13 +4,15 @@ from dotenv import load_dotenv
 from io import BytesIO
 from PIL import Image
 import fitz
-from src.openai_utils import rewrite_with_gpt
-from src.pdf_utils import extract_text_blocks, rebuild_pdf, pdf_to_images
-from src.erase_utils import erase_mode
+from src.openai_utils import rewrite_text_blocks
+from src.pdf_utils import iter_text_blocks, rebuild_pdf, pdf_page_images
+from src.erase_utils import erase_sessions
+from src.doc_utils import load_document
 import pytesseract
 import shutil
 import cv2
 import numpy as np
+import uuid
 
 load_dotenv()
 openai_api_key = os.getenv("OPENAI_API_KEY")
@@ -25,6 +27,11 @@ if 'processed_images' not in st.session_state:
     st.session_state.processed_images = []
 if 'current_page' not in st.session_state:
     st.session_state.current_page = 0
+if 'erase_session_id' not in st.session_state:
+    st.session_state.erase_session_id = uuid.uuid4().hex
+
+# Erase engine (and undo history) private to this browser session
+erase_mode = erase_sessions.get(st.session_state.erase_session_id)
 
 with st.sidebar:
     st.image("https://img.icons8.com/ios-filled/100/6C63FF/brain.png", width=80)
@@ -111,6 +118,15 @@ if tesseract_available:
 else:
     st.warning(tesseract_message)
 
+def cached_page_images(uploaded_file, pdf_bytes):
+    """Lazily rendered preview pages of the upload, kept across reruns"""
+    if st.session_state.get('page_images_id') != uploaded_file.file_id:
+        if st.session_state.get('page_images') is not None:
+            st.session_state.page_images.close()
+        st.session_state.page_images = pdf_page_images(pdf_bytes)
+        st.session_state.page_images_id = uploaded_file.file_id
+    return st.session_state.page_images
+
 # qpdf check and user guidance
 def check_qpdf_status():
     import subprocess
@@ -130,7 +146,8 @@ else:
     st.warning(qpdf_message)
 
 if uploaded_file is not None:
-    pdf_bytes = uploaded_file.read()
+    # Zero-copy view of the upload; documents are opened straight from memory
+    pdf_bytes = uploaded_file.getbuffer()
     
     # Ensure we have valid PDF data
     if not pdf_bytes:
@@ -140,10 +157,11 @@ if uploaded_file is not None:
             # Edit Mode
             st.subheader("📝 Edit Mode - AI-Powered Text Editing")
             command = st.text_input("🧠 Command to Copilot (optional)", placeholder="e.g. Summarize this page")
+            regenerate = st.checkbox("🔁 Regenerate (ignore cached rewrites)", value=False)
             
             # Convert PDF to images for preview
             try:
-                preview_images = pdf_to_images(pdf_bytes)
+                preview_images = cached_page_images(uploaded_file, pdf_bytes)
                 if preview_images:
                     st.success(f"✅ Loaded {len(preview_images)} pages for preview")
                     
@@ -167,32 +185,48 @@ if uploaded_file is not None:
                     
                     with tab2:
                         try:
-                            # Use the bulletproof extract_text_blocks function directly with bytes
-                            blocks = extract_text_blocks(pdf_bytes)
-                            
-                            if blocks:
-                                st.success(f"✅ Extracted {len(blocks)} text blocks from PDF")
+                            # Stream blocks from the bulletproof extractor as each page finishes
+                            extract_status = st.empty()
+                            blocks = []
+                            for block in iter_text_blocks(pdf_bytes):
+                                blocks.append(block)
                                 
                                 # Display extracted text
-                                for i, block in enumerate(blocks[:5]):  # Show first 5 blocks
+                                if len(blocks) <= 5:  # Show first 5 blocks
                                     block_type = block.get('type', 'unknown')
-                                    st.text_area(f"Block {i+1} ({block_type})", block.get('text', ''), height=100)
+                                    st.text_area(f"Block {len(blocks)} ({block_type})", block.get('text', ''), height=100)
+                                extract_status.info(f"⏳ Extracted {len(blocks)} text blocks (page {block['page']})...")
+                            
+                            if blocks:
+                                extract_status.success(f"✅ Extracted {len(blocks)} text blocks from PDF")
                                 
                                 if command:
                                     st.success(f"✅ Copilot command received: {command}")
                                     st.subheader("🤖 Processing with GPT...")
-                                    # Process each block with GPT
+                                    # Rewrite all blocks concurrently, sending repeated headers/footers once
+                                    rewrite_blocks = [block for block in blocks
+                                                      if block.get('text', '').strip() and not block.get('text', '').startswith("OCR failed")]
+                                    results = rewrite_text_blocks(rewrite_blocks, use_cache=not regenerate)
                                     processed_blocks = []
-                                    for block in blocks:
-                                        original_text = block.get('text', '')
-                                        if original_text.strip() and not original_text.startswith("OCR failed"):
-                                            processed_text = rewrite_with_gpt(original_text)
-                                            processed_blocks.append({
-                                                'text': processed_text,
-                                                'page': block.get('page', 1),
-                                                'bbox': block.get('bbox', [0, 0, 100, 100]),
-                                                'type': 'processed'
-                                            })
+                                    failed = 0
+                                    for block, result in zip(rewrite_blocks, results):
+                                        if result['error'] is not None:
+                                            # Keep the original text rather than writing the error into the PDF
+                                            failed += 1
+                                        processed_blocks.append({
+                                            'text': result['text'] if result['error'] is None else block['text'],
+                                            'page': block.get('page', 1),
+                                            'bbox': block.get('bbox', [0, 0, 100, 100]),
+                                            'type': 'processed'
+                                        })
+                                    if failed:
+                                        st.warning(f"⚠️ {failed} block(s) could not be rewritten and were kept as-is")
+                                    reused = sum(1 for result in results if result['cached'])
+                                    if reused:
+                                        st.caption(f"♻️ {reused} of {len(results)} block(s) reused from the rewrite cache")
+                                    repeated = sum(1 for result in results if result['duplicate'])
+                                    if repeated:
+                                        st.caption(f"📑 {repeated} repeated header/footer block(s) rewritten once and reused")
                                     
                                     if processed_blocks:
                                         # Rebuild PDF with processed content
@@ -205,7 +239,7 @@ if uploaded_file is not None:
                                 else:
                                     st.info("💡 Enter a command above to process the PDF with GPT")
                             else:
-                                st.warning("⚠️ No text blocks found in the PDF")
+                                extract_status.warning("⚠️ No text blocks found in the PDF")
                                 
                         except Exception as e:
                             st.error(f"❌ Error processing PDF: {str(e)}")
@@ -236,10 +270,11 @@ if uploaded_file is not None:
                 x2 = st.number_input("X2", min_value=0, value=100)
             with col4:
                 y2 = st.number_input("Y2", min_value=0, value=100)
+            snap_to_text = st.checkbox("Erase only the text under the box", value=False)
             
             # Convert PDF to images
             try:
-                images = pdf_to_images(pdf_bytes)
+                images = cached_page_images(uploaded_file, pdf_bytes)
                 
                 if images:
                     st.success(f"✅ Converted PDF to {len(images)} images")
@@ -270,12 +305,18 @@ if uploaded_file is not None:
                         if len(processed_image.shape) == 3 and processed_image.shape[2] == 3:
                             processed_image = cv2.cvtColor(processed_image, cv2.COLOR_RGB2BGR)
                         
+                        # Page text layer, so born-digital text is found without OCR
+                        erase_doc = load_document(pdf_bytes)
+                        erase_page = erase_doc.load_page(st.session_state.current_page)
+                        erased_boxes = []
+                        
                         # Process command-based erasure
                         if erase_command:
                             processed_image, erased_regions = erase_mode.erase_text_by_command(
-                                processed_image, erase_command
+                                processed_image, erase_command, page=erase_page
                             )
                             
+                            erased_boxes.extend(region['bbox'] for region in erased_regions)
                             if erased_regions:
                                 st.success(f"✅ Erased {len(erased_regions)} text regions")
                                 for region in erased_regions:
@@ -286,13 +327,17 @@ if uploaded_file is not None:
                         # Process coordinate-based erasure
                         if x1 != 0 or y1 != 0 or x2 != 100 or y2 != 100:
                             coordinates = [[x1, y1, x2, y2]]
-                            processed_image = erase_mode.erase_text_by_coordinates(
-                                processed_image, coordinates
+                            processed_image, coordinate_boxes = erase_mode.erase_text_by_coordinates(
+                                processed_image, coordinates, snap_to_text=snap_to_text, page=erase_page,
+                                dpi=images.dpi
                             )
+                            erased_boxes.extend(coordinate_boxes)
                             st.success("✅ Erased text at specified coordinates")
+                        erase_doc.close()
                         
                         # Add to history
-                        erase_mode.add_to_history(processed_image, f"Erase: {erase_command or 'manual coordinates'}")
+                        erase_mode.add_to_history(processed_image, f"Erase: {erase_command or 'manual coordinates'}",
+                                                  erasures={st.session_state.current_page: erased_boxes})
                         
                         # Display processed image
                         st.subheader("✅ Processed Image")
@@ -335,14 +380,15 @@ if uploaded_file is not None:
                         with col3:
                             # Export all pages as PDF
                             if st.button("📥 Download All Pages"):
+                                # Untouched pages (None) are copied from the original PDF
                                 all_images = []
-                                for i, img in enumerate(images):
-                                    if i < len(st.session_state.processed_images) and st.session_state.processed_images[i] is not None:
+                                for i in range(len(images)):
+                                    if i < len(st.session_state.processed_images):
                                         all_images.append(st.session_state.processed_images[i])
                                     else:
-                                        all_images.append(img)
+                                        all_images.append(None)
                                 
-                                pdf_output = erase_mode.images_to_pdf(all_images)
+                                pdf_output = erase_mode.images_to_pdf(all_images, source_pdf=pdf_bytes)
                                 if pdf_output:
                                     st.download_button(
                                         "📥 Download All Pages PDF",
@@ -350,6 +396,20 @@ if uploaded_file is not None:
                                         "erased_document.pdf",
                                         mime="application/pdf"
                                     )
+                        
+                        # Erase in the original PDF: keeps text, fonts and untouched pages intact
+                        if st.button("📥 Download All Pages (keep text layer)"):
+                            try:
+                                pdf_output = erase_mode.redact_pdf(pdf_bytes, erase_mode.applied_erasures(),
+                                                                   dpi=images.dpi)
+                                st.download_button(
+                                    "📥 Download Redacted PDF",
+                                    pdf_output,
+                                    "erased_document_vector.pdf",
+                                    mime="application/pdf"
+                                )
+                            except Exception as e:
+                                st.error(f"❌ Vector export failed: {str(e)}")
                     
                     # Undo/Redo controls
                     st.subheader("🔄 History Controls")
@@ -373,7 +433,7 @@ if uploaded_file is not None:
                     
                     # History info
                     history_info = erase_mode.get_history_info()
-                    st.info(f"History: {history_info['current_step']}/{history_info['total_steps']} steps")
+                    st.info(f"History: {history_info['current_step']}/{history_info['total_steps']} steps ({history_info['memory_bytes'] / 1e6:.1f} MB)")
                     
                 else:
                     st.error("❌ Failed to convert PDF to images")
@@ -4,6 +4,7 @@ import fitz  # PyMuPDF
 from PIL import Image
 from io import BytesIO
 import speech_recognition as sr
+from utils.span_utils import SpanTable
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
@@ -35,18 +36,9 @@ def rewrite_with_gpt(prompt, text):
 
 def extract_text(pdf_stream):
     doc = fitz.open(stream=pdf_stream, filetype="pdf")
-    blocks = []
-    for i in range(len(doc)):
-        for span in doc[i].get_text("dict")["blocks"]:
-            for line in span.get("lines", []):
-                for s in line.get("spans", []):
-                    blocks.append({
-                        "page": i,
-                        "text": s["text"],
-                        "bbox": s["bbox"],
-                        "font": s["font"],
-                        "size": s["size"]
-                    })
+    # Columnar spans; items still read like {"page", "text", "bbox", "font", "size"}
+    blocks = SpanTable.from_document(doc)
+    doc.close()
     return blocks
 
 def rebuild_pdf(pdf_stream, edits):
@@ -76,7 +68,7 @@ if uploaded_pdf:
         img = Image.frombytes("RGB", *doc[pg_num].get_pixmap().size, doc[pg_num].get_pixmap().samples)
         st.image(img, use_column_width=True)
 
-        for item in [x for x in text_data if x["page"] == pg_num]:
+        for item in text_data.page(pg_num):
             col1, col2, col3 = st.columns([3,1,1])
             with col1:
                 new_text = st.text_area("Edit Text", value=item["text"], key=str(item["bbox"]))
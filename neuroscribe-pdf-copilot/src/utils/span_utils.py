@@ -0,0 +1,86 @@
+"""
+span_utils.py - Compact columnar storage for the copilot's text spans.
+"""
+
+from array import array
+from collections.abc import Sequence
+
+import numpy as np
+
+class SpanTable(Sequence):
+    """
+    Text spans of a document stored column-wise in numpy arrays.
+
+    Indexing and iteration build the same {"page", "text", "bbox", "font",
+    "size"} dicts a list of spans would hold, one at a time. Bboxes and sizes
+    are float64, so they read back exactly as PyMuPDF reported them.
+    """
+
+    def __init__(self, pages, bboxes, sizes, font_ids, fonts, text, starts, ends):
+        self.pages = pages
+        self.bboxes = bboxes
+        self.sizes = sizes
+        self.font_ids = font_ids
+        self.fonts = fonts
+        self.text = text
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_document(cls, doc):
+        """Read every text span of an open PyMuPDF document, in page order."""
+        pages, sizes, font_ids = array('i'), array('d'), array('i')
+        bboxes = array('d')
+        offsets = array('q', [0])
+        fonts, font_index, texts = [], {}, []
+        for page_num in range(len(doc)):
+            # Parsed one page at a time, so only one page of dicts is alive
+            for block in doc.load_page(page_num).get_text("dict")["blocks"]:
+                for line in block.get("lines", []):
+                    for span in line.get("spans", []):
+                        if span["font"] not in font_index:
+                            font_index[span["font"]] = len(fonts)
+                            fonts.append(span["font"])
+                        pages.append(page_num)
+                        bboxes.extend(span["bbox"])
+                        sizes.append(span["size"])
+                        font_ids.append(font_index[span["font"]])
+                        texts.append(span["text"])
+                        offsets.append(offsets[-1] + len(span["text"]))
+        offsets = np.frombuffer(offsets, dtype=np.int64)
+        return cls(np.frombuffer(pages, dtype=np.intc),
+                   np.frombuffer(bboxes, dtype=np.float64).reshape(-1, 4),
+                   np.frombuffer(sizes, dtype=np.float64),
+                   np.frombuffer(font_ids, dtype=np.intc),
+                   fonts, "".join(texts), offsets[:-1], offsets[1:])
+
+    def __len__(self):
+        return len(self.pages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            # numpy slices are views; the text buffer and font names are shared
+            return SpanTable(self.pages[index], self.bboxes[index], self.sizes[index],
+                             self.font_ids[index], self.fonts, self.text,
+                             self.starts[index], self.ends[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("span index out of range")
+        return {
+            "page": int(self.pages[index]),
+            "text": self.text[self.starts[index]:self.ends[index]],
+            "bbox": tuple(self.bboxes[index].tolist()),
+            "font": self.fonts[self.font_ids[index]],
+            "size": float(self.sizes[index])
+        }
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def page(self, page_num):
+        """Get the spans of one page without scanning the whole table."""
+        first = int(np.searchsorted(self.pages, page_num, side='left'))
+        last = int(np.searchsorted(self.pages, page_num, side='right'))
+        return self[first:last]
@@ -0,0 +1,270 @@
+"""
+doc_utils.py - Shared in-memory PDF document handles.
+"""
+
+import io
+import os
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Union
+
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+from PIL import Image
+
+PdfSource = Union[bytes, bytearray, memoryview, io.BytesIO, str, fitz.Document]
+
+def pdf_buffer(source: PdfSource) -> memoryview:
+    """
+    Get a zero-copy view of PDF data.
+
+    Args:
+        source: PDF bytes, bytearray, memoryview, BytesIO, or file path
+
+    Returns:
+        memoryview: View over the PDF bytes (file paths are read once)
+
+    Raises:
+        Exception: If the source is not a supported type
+    """
+    if isinstance(source, memoryview):
+        return source
+    if isinstance(source, (bytes, bytearray)):
+        return memoryview(source)
+    if isinstance(source, io.BytesIO):
+        return source.getbuffer()
+    if isinstance(source, str) and os.path.exists(source):
+        with open(source, "rb") as f:
+            return memoryview(f.read())
+    raise Exception("Invalid input: must be bytes, file path, or document object")
+
+def buffer_bytes(buffer: memoryview) -> bytes:
+    """
+    Get a bytes object for a buffer, reusing the underlying bytes when possible.
+
+    Needed where data must be pickled, e.g. to hand it to worker processes.
+
+    Args:
+        buffer: View returned by pdf_buffer()
+
+    Returns:
+        bytes: The PDF bytes
+    """
+    if isinstance(buffer.obj, bytes) and len(buffer.obj) == buffer.nbytes:
+        return buffer.obj
+    return buffer.tobytes()
+
+def load_document(source: PdfSource) -> fitz.Document:
+    """
+    Open a PDF from memory without touching the disk.
+
+    Encrypted PDFs are unlocked with an empty password. Document objects
+    are returned as-is.
+
+    Args:
+        source: PDF bytes, bytearray, memoryview, BytesIO, file path, or document object
+
+    Returns:
+        fitz.Document: Open document (the caller owns it unless it was passed in)
+
+    Raises:
+        Exception: If the source is invalid or the PDF cannot be unlocked
+    """
+    if hasattr(source, 'load_page'):  # Document object
+        doc = source
+    else:
+        doc = fitz.open(stream=pdf_buffer(source), filetype="pdf")
+
+    # Handle encrypted PDFs
+    if doc.is_encrypted:
+        if not doc.authenticate(""):
+            raise Exception("❌ Cannot unlock encrypted PDF.")
+        print("✅ Successfully unlocked encrypted PDF")
+
+    return doc
+
+@contextmanager
+def open_document(source: PdfSource) -> Iterator[fitz.Document]:
+    """
+    Context manager around load_document().
+
+    Closes the document on exit only if it was opened here, so callers may
+    pass their own document objects through.
+
+    Args:
+        source: PDF bytes, bytearray, memoryview, BytesIO, file path, or document object
+
+    Yields:
+        fitz.Document: Open document
+    """
+    doc = load_document(source)
+    try:
+        yield doc
+    finally:
+        if doc is not source:
+            doc.close()
+
+def pixmap_to_array(pix: fitz.Pixmap) -> np.ndarray:
+    """
+    Wrap a pixmap's samples as a numpy array without copying.
+
+    The array is a view of the pixmap's memory: keep pix referenced for as
+    long as the array is used, or copy it.
+
+    Args:
+        pix: PyMuPDF pixmap (RGB, or grayscale via colorspace=fitz.csGRAY)
+
+    Returns:
+        np.ndarray: (height, width, n) uint8 view, or (height, width) for grayscale
+    """
+    samples = pix.samples_mv if hasattr(pix, 'samples_mv') else pix.samples
+    array = np.frombuffer(samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+    return array[:, :, 0] if pix.n == 1 else array
+
+def render_page(page, dpi: int, output: str = 'pil', clip=None) -> Any:
+    """
+    Rasterise a page straight from the pixmap samples, without PNG encoding.
+
+    Args:
+        page: PyMuPDF page object
+        dpi: Render resolution
+        output: 'pil' for an RGB PIL image, 'bgr' for an OpenCV numpy array,
+            'gray' for a grayscale numpy array
+        clip: Optional page rectangle to render instead of the whole page
+
+    Returns:
+        The rendered page image
+    """
+    if output == 'gray':
+        pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, clip=clip)
+        return pixmap_to_array(pix).copy()
+
+    pix = page.get_pixmap(dpi=dpi, clip=clip)
+    if output == 'pil':
+        return Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+
+    # Convert RGB to BGR for OpenCV (writes a new array, so no copy is kept alive)
+    return cv2.cvtColor(pixmap_to_array(pix), cv2.COLOR_RGB2BGR)
+
+class PageImages(Sequence):
+    """
+    Page images of a PDF, rendered on first access.
+
+    Keeps the most recently used pages in a bounded LRU cache and renders
+    the neighbours of each accessed page on a background thread, so paging
+    through a document stays fast without holding every page in memory.
+    """
+
+    def __init__(self, source: PdfSource, dpi: int = 150, output: str = 'pil',
+                 cache_size: int = 8, prefetch: int = 1):
+        """
+        Args:
+            source: PDF bytes, memoryview, file path, or document object
+            dpi: Render resolution
+            output: 'pil' for RGB PIL images, 'bgr' for OpenCV numpy arrays
+            cache_size: Maximum number of rendered pages kept in memory
+            prefetch: Number of pages on each side to render ahead
+        """
+        self.dpi = dpi
+        self.output = output
+        self.cache_size = max(1, cache_size)
+        self.prefetch = prefetch
+        self._doc = load_document(source)
+        self._owns_doc = self._doc is not source
+        self._page_count = len(self._doc)
+        # PyMuPDF documents must not be used from two threads at once
+        self._doc_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._pending: Dict[int, Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch > 0 else None
+
+    def __len__(self) -> int:
+        return self._page_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._page_count))]
+        if index < 0:
+            index += self._page_count
+        if not 0 <= index < self._page_count:
+            raise IndexError("page index out of range")
+
+        image = self._get(index)
+        self._prefetch_around(index)
+        return image
+
+    def _render(self, index: int) -> Any:
+        with self._doc_lock:
+            return render_page(self._doc.load_page(index), self.dpi, self.output)
+
+    def _get(self, index: int) -> Any:
+        with self._lock:
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+            future = self._pending.get(index)
+
+        image = None
+        if future is not None:
+            try:
+                image = future.result()
+            except Exception:
+                image = None  # Prefetch failed or was cancelled; render here instead
+        if image is None:
+            image = self._render(index)
+        self._store(index, image)
+        return image
+
+    def _store(self, index: int, image: Any):
+        with self._lock:
+            self._pending.pop(index, None)
+            self._cache[index] = image
+            self._cache.move_to_end(index)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _prefetch_around(self, index: int):
+        if self._executor is None:
+            return
+        for offset in range(1, self.prefetch + 1):
+            for neighbour in (index + offset, index - offset):
+                if not 0 <= neighbour < self._page_count:
+                    continue
+                with self._lock:
+                    if neighbour in self._cache or neighbour in self._pending:
+                        continue
+                    future = self._executor.submit(self._render, neighbour)
+                    self._pending[neighbour] = future
+                future.add_done_callback(lambda done, page=neighbour: self._prefetched(page, done))
+
+    def _prefetched(self, index: int, future: Future):
+        if future.cancelled() or future.exception() is not None:
+            with self._lock:
+                self._pending.pop(index, None)
+            return
+        self._store(index, future.result())
+
+    def cached_pages(self) -> list:
+        """
+        Get the indices of pages currently held in memory
+
+        Returns:
+            Page indices, least recently used first
+        """
+        with self._lock:
+            return list(self._cache)
+
+    def close(self):
+        """Stop prefetching and release the document and cached images."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            self._cache.clear()
+            self._pending.clear()
+        if self._owns_doc:
+            self._doc.close()
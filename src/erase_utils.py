@@ -4,14 +4,98 @@ erase_utils.py - AI-powered text erasure with background restoration
 
 import cv2
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
 import fitz
-import io
 import os
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Any, Tuple, Optional
 import pytesseract
 from rembg import remove
-import tempfile
+from src.doc_utils import PageImages, load_document, open_document, render_page
+from src.ocr_utils import OcrCache, group_text_boxes, ocr_cache, ocr_service, page_content_hash, parse_tesseract_data
+from src.pdf_utils import classify_page
+from src.spatial_utils import SpatialIndex
+
+# Inpainting neighbourhood radius in pixels
+INPAINT_RADIUS = 3
+
+# Default memory budget for compressed undo/redo patches per engine
+HISTORY_BUDGET_BYTES = 64 * 1024 * 1024
+
+# Per-session engine limits for EraseSessionRegistry
+ERASE_SESSION_IDLE_SECONDS = 30 * 60
+ERASE_SESSIONS_MAX_BYTES = 512 * 1024 * 1024
+
+# Text region indexes kept per engine by EraseMode.text_region_index
+REGION_INDEX_CACHE_SIZE = 8
+
+# Page encoding for EraseMode.images_to_pdf
+JPEG_QUALITY = 85
+# Distinct colours per sampled pixel above which a page is treated as a photo
+PHOTO_MIN_COLOR_SHARE = 0.02
+# Share of mid-grey pixels below which a page is treated as black and white
+BILEVEL_MAX_MIDTONES = 0.01
+
+def choose_codec(image: np.ndarray) -> str:
+    """
+    Pick an encoding for a page image
+    
+    Args:
+        image: BGR or grayscale numpy array
+        
+    Returns:
+        'bilevel' for black-and-white pages, 'jpeg' for photographic ones, else 'png'
+    """
+    # A sparse sample is enough to tell the kinds apart
+    sample = image[::4, ::4]
+    if sample.ndim == 3:
+        if np.array_equal(sample[:, :, 0], sample[:, :, 1]) and np.array_equal(sample[:, :, 1], sample[:, :, 2]):
+            sample = sample[:, :, 0]
+        else:
+            packed = (sample[:, :, 0].astype(np.uint32) << 16) | (sample[:, :, 1].astype(np.uint32) << 8) | sample[:, :, 2]
+            return 'jpeg' if len(np.unique(packed)) >= PHOTO_MIN_COLOR_SHARE * packed.size else 'png'
+    
+    midtones = np.count_nonzero((sample > 32) & (sample < 224))
+    if midtones <= BILEVEL_MAX_MIDTONES * sample.size:
+        return 'bilevel'
+    return 'jpeg' if len(np.unique(sample)) >= 128 else 'png'
+
+def encode_page_image(image: np.ndarray, codec: str = 'auto', jpeg_quality: int = JPEG_QUALITY) -> bytes:
+    """
+    Encode a page image for insertion into a PDF
+    
+    Args:
+        image: BGR or grayscale numpy array
+        codec: 'auto', 'png', 'jpeg' or 'bilevel'
+        jpeg_quality: JPEG quality (0-100)
+        
+    Returns:
+        Encoded image bytes
+        
+    Raises:
+        ValueError: If the codec is unknown
+    """
+    if codec == 'auto':
+        codec = choose_codec(image)
+    
+    if codec == 'png':
+        # Fast zlib level; OpenCV takes BGR directly, no colour conversion
+        ok, data = cv2.imencode('.png', image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    elif codec == 'jpeg':
+        ok, data = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+    elif codec == 'bilevel':
+        gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        _, binary = cv2.threshold(gray, 127, 255, cv2.THRESH_BINARY)
+        ok, data = cv2.imencode('.png', binary, [cv2.IMWRITE_PNG_BILEVEL, 1])
+    else:
+        raise ValueError(f"Unknown page codec: {codec}")
+    
+    if not ok:
+        raise Exception(f"Failed to encode page as {codec}")
+    return data.tobytes()
 
 def erase_text_from_image(image_path, coordinates, inpaint_radius=3):
     """
@@ -39,14 +123,130 @@ class EraseMode:
     AI-powered text erasure with background restoration
     """
     
-    def __init__(self):
+    def __init__(self, history_budget_bytes: int = HISTORY_BUDGET_BYTES):
         self.history = []
         self.current_step = -1
-        self.max_history = 10
+        self.history_budget_bytes = history_budget_bytes
+        # Full image at current_step; history entries only hold patches
+        self._state = None
+        # Text region indexes by page image, DPI and level, most recent last
+        self._region_indexes = OrderedDict()
+        
+    def detect_text_regions(self, image: np.ndarray, mode: str = 'words',
+                            level: str = 'word') -> List[Dict[str, Any]]:
+        """
+        Detect text regions in image using OCR
+        
+        Args:
+            image: Input image as numpy array
+            mode: 'words' runs Tesseract once over the whole page;
+                'contours' OCRs each Otsu contour separately. Words mode
+                falls back to contours if page-level OCR fails.
+            level: Box granularity for words mode: 'word', 'line' or 'block'
+            
+        Returns:
+            List of text regions with bounding boxes, text content and confidence
+        """
+        if mode == 'words':
+            words = self._detect_words(image)
+            if words is not None:
+                return group_text_boxes(words, level)
+        return self._detect_text_regions_by_contours(image)
+    
+    def detect_page_text_regions(self, page, image: np.ndarray, level: str = 'word') -> List[Dict[str, Any]]:
+        """
+        Detect text regions of a rendered PDF page, reading the text layer where there is one
+        
+        Born-digital text comes straight from page.get_text("words"), scaled
+        to the image; only scanned pages and the image areas of hybrid pages
+        are OCR'd.
+        
+        Args:
+            page: PyMuPDF page the image was rendered from
+            image: Rendered page image (any DPI)
+            level: Box granularity: 'word', 'line' or 'block'
+            
+        Returns:
+            List of text regions with pixel bounding boxes, text content and confidence
+        """
+        layout = classify_page(page)
+        if layout['kind'] == 'scanned':
+            return self.detect_text_regions(image, level=level)
+        
+        # PDF points (unrotated) to image pixels
+        height, width = image.shape[:2]
+        to_pixels = page.rotation_matrix * fitz.Matrix(width / page.rect.width, height / page.rect.height)
+        
+        def pixel_box(rect) -> List[int]:
+            rect = fitz.Rect(rect) * to_pixels
+            return [max(int(np.floor(rect.x0)), 0), max(int(np.floor(rect.y0)), 0),
+                    min(int(np.ceil(rect.x1)), width), min(int(np.ceil(rect.y1)), height)]
+        
+        words = []
+        for x0, y0, x1, y1, text, block, line, _ in page.get_text("words"):
+            words.append({
+                'bbox': pixel_box((x0, y0, x1, y1)),
+                'text': text,
+                'confidence': 1.0,
+                'block': [0, block],
+                'line': [0, block, 0, line]
+            })
+        regions = group_text_boxes(words, level)
+        
+        # Hybrid pages: OCR just the image areas the text layer doesn't cover
+        for rect in layout['ocr_rects']:
+            x0, y0, x1, y1 = pixel_box(rect)
+            if x1 - x0 < 2 or y1 - y0 < 2:
+                continue
+            for region in self.detect_text_regions(image[y0:y1, x0:x1], level=level):
+                bx0, by0, bx1, by1 = region['bbox']
+                region['bbox'] = [bx0 + x0, by0 + y0, bx1 + x0, by1 + y0]
+                regions.append(region)
+        
+        return regions
+    
+    def _detect_words(self, image: np.ndarray) -> Optional[List[Dict[str, Any]]]:
+        """
+        Run Tesseract once over the image and return its word boxes
+        
+        Args:
+            image: Input image as numpy array
+            
+        Returns:
+            Words from parse_tesseract_data, or None if OCR failed
+        """
+        config = '--oem 3 --psm 3'
+        cache_key = None
+        try:
+            cache_key = OcrCache.make_key(image, f"regions words {config}")
+            cached = ocr_cache.get(cache_key)
+            if cached is not None:
+                return cached['words']
+        except Exception as cache_error:
+            print(f"OCR cache unavailable: {cache_error}")
         
-    def detect_text_regions(self, image: np.ndarray) -> List[Dict[str, Any]]:
+        try:
+            gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            data = ocr_service.ocr_page(gray, config=config, output='data')
+            words = parse_tesseract_data(data)
+        except Exception as e:
+            print(f"Page OCR failed, falling back to contour detection: {e}")
+            return None
+        
+        if cache_key is not None:
+            try:
+                ocr_cache.put(cache_key, {
+                    'text': " ".join(word['text'] for word in words),
+                    'words': words
+                })
+            except Exception as cache_error:
+                print(f"OCR cache unavailable: {cache_error}")
+        
+        return words
+    
+    def _detect_text_regions_by_contours(self, image: np.ndarray) -> List[Dict[str, Any]]:
         """
-        Detect text regions in image using OCR and contour detection
+        Detect text regions by OCRing each Otsu contour separately (slow fallback)
         
         Args:
             image: Input image as numpy array
@@ -55,6 +255,16 @@ class EraseMode:
             List of text regions with bounding boxes and text content
         """
         try:
+            # Reuse a previous OCR of the identical image
+            cache_key = None
+            try:
+                cache_key = OcrCache.make_key(image, "regions contour --psm 8")
+                cached = ocr_cache.get(cache_key)
+                if cached is not None:
+                    return cached['words']
+            except Exception as cache_error:
+                print(f"OCR cache unavailable: {cache_error}")
+            
             # Convert to grayscale
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
             
@@ -64,27 +274,44 @@ class EraseMode:
             # Find contours
             contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
             
-            text_regions = []
-            
+            boxes = []
+            rois = []
             for contour in contours:
                 # Filter small contours
                 if cv2.contourArea(contour) > 100:
                     x, y, w, h = cv2.boundingRect(contour)
-                    
-                    # Extract region for OCR
-                    roi = gray[y:y+h, x:x+w]
-                    
-                    # OCR the region
-                    try:
-                        text = pytesseract.image_to_string(roi, config='--psm 8').strip()
-                        if text and len(text) > 1:
-                            text_regions.append({
-                                'bbox': [x, y, x+w, y+h],
-                                'text': text,
-                                'confidence': 0.8
-                            })
-                    except:
-                        continue
+                    boxes.append([x, y, x+w, y+h])
+                    rois.append(gray[y:y+h, x:x+w])
+            
+            # OCR every region in one batch rather than one Tesseract call each
+            text_regions = []
+            ocr_failed = False
+            try:
+                texts = ocr_service.ocr_batch(rois, config='--psm 8')
+            except Exception as ocr_error:
+                print(f"Region OCR failed: {ocr_error}")
+                texts = []
+                ocr_failed = True
+            
+            for bbox, text in zip(boxes, texts):
+                text = text.strip()
+                if text and len(text) > 1:
+                    text_regions.append({
+                        'bbox': bbox,
+                        'text': text,
+                        'confidence': 0.8,
+                        'level': 'contour'
+                    })
+            
+            # Never cache a partial result from failed OCR calls
+            if cache_key is not None and not ocr_failed:
+                try:
+                    ocr_cache.put(cache_key, {
+                        'text': "\n".join(region['text'] for region in text_regions),
+                        'words': text_regions
+                    })
+                except Exception as cache_error:
+                    print(f"OCR cache unavailable: {cache_error}")
             
             return text_regions
             
@@ -121,10 +348,87 @@ class EraseMode:
         
         return mask
     
+    def create_mask_from_bboxes(self, image: np.ndarray, bboxes: List[List[int]],
+                                expand: int = 5) -> np.ndarray:
+        """
+        Create one mask covering every bounding box
+        
+        Args:
+            image: Input image
+            bboxes: Bounding boxes [x1, y1, x2, y2]
+            expand: Pixels to expand each box
+            
+        Returns:
+            Binary mask for inpainting the union of all boxes
+        """
+        height, width = image.shape[:2]
+        mask = np.zeros((height, width), dtype=np.uint8)
+        
+        for x1, y1, x2, y2 in bboxes:
+            # Expand the bounding box
+            x1 = max(0, x1 - expand)
+            y1 = max(0, y1 - expand)
+            x2 = min(width, x2 + expand)
+            y2 = min(height, y2 + expand)
+            
+            mask[y1:y2, x1:x2] = 255
+        
+        return mask
+    
+    def mask_tiles(self, mask: np.ndarray, radius: int = INPAINT_RADIUS) -> List[Tuple[int, int, int, int]]:
+        """
+        Split a mask into the image tiles that inpainting actually needs
+        
+        Each connected mask component gets a tile padded by enough pixels for
+        the inpainting neighbourhood; overlapping tiles are merged.
+        
+        Args:
+            mask: Binary mask of text regions
+            radius: Inpainting radius the tiles must accommodate
+            
+        Returns:
+            List of tiles (x1, y1, x2, y2), exclusive of x2/y2
+        """
+        height, width = mask.shape[:2]
+        margin = 2 * radius + 2
+        
+        count, _, stats, _ = cv2.connectedComponentsWithStats((mask > 0).astype(np.uint8), connectivity=8)
+        tiles = []
+        for x, y, w, h, _ in stats[1:count]:
+            tiles.append([max(0, x - margin), max(0, y - margin),
+                          min(width, x + w + margin), min(height, y + h + margin)])
+        
+        # Coalesce overlapping tiles until none overlap. Each pass sweeps the
+        # tiles by x, testing only tiles whose x range is still open; a merged
+        # tile can reach new neighbours, so passes repeat until nothing merges.
+        merged = True
+        while merged:
+            merged = False
+            tiles.sort(key=lambda tile: tile[0])
+            swept = []
+            active = []
+            for tile in tiles:
+                active = [other for other in active if other[2] > tile[0]]
+                for other in active:
+                    if other[1] < tile[3] and tile[1] < other[3]:
+                        other[0], other[1] = min(other[0], tile[0]), min(other[1], tile[1])
+                        other[2], other[3] = max(other[2], tile[2]), max(other[3], tile[3])
+                        merged = True
+                        break
+                else:
+                    swept.append(tile)
+                    active.append(tile)
+            tiles = swept
+        
+        return [tuple(int(v) for v in tile) for tile in tiles]
+    
     def inpaint_text_region(self, image: np.ndarray, mask: np.ndarray) -> np.ndarray:
         """
         Remove text using OpenCV inpainting
         
+        Only the tiles around masked pixels are inpainted, so cost scales
+        with the erased area rather than the page size.
+        
         Args:
             image: Input image
             mask: Binary mask of text regions
@@ -133,8 +437,12 @@ class EraseMode:
             Image with text removed
         """
         try:
-            # Use TELEA algorithm for better results
-            result = cv2.inpaint(image, mask, 3, cv2.INPAINT_TELEA)
+            result = image.copy()
+            for x1, y1, x2, y2 in self.mask_tiles(mask):
+                # Use TELEA algorithm for better results
+                result[y1:y2, x1:x2] = cv2.inpaint(
+                    image[y1:y2, x1:x2], mask[y1:y2, x1:x2], INPAINT_RADIUS, cv2.INPAINT_TELEA
+                )
             return result
         except Exception as e:
             print(f"Error in inpainting: {e}")
@@ -144,6 +452,9 @@ class EraseMode:
         """
         Enhanced text removal using AI techniques
         
+        Works tile by tile (see mask_tiles); pixels outside the mask are
+        left untouched.
+        
         Args:
             image: Input image
             mask: Binary mask of text regions
@@ -152,46 +463,50 @@ class EraseMode:
             Image with enhanced text removal
         """
         try:
-            # Convert to PIL for better processing
-            pil_image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-            
-            # Apply mask
-            mask_pil = Image.fromarray(mask)
-            
-            # Use rembg for background removal in masked area
-            # This helps with complex backgrounds
-            masked_region = np.array(pil_image)
-            masked_region[mask == 0] = [255, 255, 255]  # White background
-            
-            # Convert back to BGR for OpenCV
-            masked_region_bgr = cv2.cvtColor(masked_region, cv2.COLOR_RGB2BGR)
-            
-            # Apply inpainting
-            result = self.inpaint_text_region(masked_region_bgr, mask)
-            
-            # Blend with original image
+            result = image.copy()
             alpha = 0.8
-            blended = cv2.addWeighted(image, 1-alpha, result, alpha, 0)
             
-            return blended
+            for x1, y1, x2, y2 in self.mask_tiles(mask):
+                tile = image[y1:y2, x1:x2]
+                tile_mask = mask[y1:y2, x1:x2]
+                masked = tile_mask > 0
+                
+                # White background around the text helps with complex backgrounds
+                masked_region = tile.copy()
+                masked_region[~masked] = 255
+                
+                # Apply inpainting
+                inpainted = cv2.inpaint(masked_region, tile_mask, INPAINT_RADIUS, cv2.INPAINT_TELEA)
+                
+                # Blend with original image inside the mask
+                blended = cv2.addWeighted(tile, 1-alpha, inpainted, alpha, 0)
+                result[y1:y2, x1:x2][masked] = blended[masked]
+            
+            return result
             
         except Exception as e:
             print(f"Error in AI-enhanced removal: {e}")
             return self.inpaint_text_region(image, mask)
     
-    def erase_text_by_command(self, image: np.ndarray, command: str) -> Tuple[np.ndarray, List[Dict]]:
+    def erase_text_by_command(self, image: np.ndarray, command: str,
+                              page=None) -> Tuple[np.ndarray, List[Dict]]:
         """
         Erase text based on natural language command
         
         Args:
             image: Input image
             command: Natural language command (e.g., "Remove invoice number")
+            page: PyMuPDF page the image was rendered from; when given, its
+                text layer replaces OCR wherever it has one
             
         Returns:
             Tuple of (processed_image, erased_regions)
         """
         # Detect text regions
-        text_regions = self.detect_text_regions(image)
+        if page is not None:
+            text_regions = self.detect_page_text_regions(page, image)
+        else:
+            text_regions = self.detect_text_regions(image)
         
         # Simple keyword matching (can be enhanced with GPT)
         command_lower = command.lower()
@@ -215,70 +530,100 @@ class EraseMode:
                 should_erase = True
             
             if should_erase:
-                mask = self.create_mask_from_bbox(image, region['bbox'])
-                image = self.ai_enhanced_removal(image, mask)
                 erased_regions.append(region)
         
+        # One removal pass over the union of all matching regions
+        if erased_regions:
+            mask = self.create_mask_from_bboxes(image, [region['bbox'] for region in erased_regions])
+            image = self.ai_enhanced_removal(image, mask)
+        
         return image, erased_regions
     
-    def erase_text_by_coordinates(self, image: np.ndarray, coordinates: List[List[int]]) -> np.ndarray:
+    def text_region_index(self, image: np.ndarray, dpi: int = 300, level: str = 'word',
+                          page=None) -> SpatialIndex:
+        """
+        Build a spatial index over the text detected in a page image
+        
+        Indexes are kept per image content, page, DPI and level, so repeated
+        queries on the same page (e.g. across Streamlit reruns) reuse one
+        index instead of detecting the text again.
+        
+        Args:
+            image: Input image, rendered at dpi
+            dpi: Render resolution, so queries can also be made in PDF points
+            level: Box granularity: 'word', 'line' or 'block'
+            page: PyMuPDF page the image was rendered from, to read its text layer
+            
+        Returns:
+            SpatialIndex whose items are the detected regions
+        """
+        page_hash = page_content_hash(page) if page is not None else "-"
+        key = OcrCache.make_key(image, f"regions page={page_hash} dpi={dpi} level={level}")
+        index = self._region_indexes.get(key)
+        if index is not None:
+            self._region_indexes.move_to_end(key)
+            return index
+        
+        if page is not None:
+            regions = self.detect_page_text_regions(page, image, level=level)
+        else:
+            regions = self.detect_text_regions(image, level=level)
+        index = SpatialIndex.from_regions(regions, dpi=dpi)
+        self._region_indexes[key] = index
+        while len(self._region_indexes) > REGION_INDEX_CACHE_SIZE:
+            self._region_indexes.popitem(last=False)
+        return index
+    
+    def erase_text_by_coordinates(self, image: np.ndarray, coordinates: List[List[int]],
+                                  snap_to_text: bool = False, page=None,
+                                  dpi: float = 300) -> Tuple[np.ndarray, List[List[int]]]:
         """
         Erase text at specific coordinates
         
         Args:
             image: Input image
             coordinates: List of bounding boxes [x1, y1, x2, y2]
+            snap_to_text: Erase only the detected words under each box
+                instead of the whole box
+            page: PyMuPDF page the image was rendered from, used by snap_to_text
+            dpi: Resolution the image was rendered at (e.g. PageImages.dpi)
             
         Returns:
-            Processed image
+            Tuple of (processed_image, erased_boxes); with snap_to_text the
+            boxes are the detected words that were erased, not the input boxes
         """
-        for bbox in coordinates:
-            mask = self.create_mask_from_bbox(image, bbox)
+        if coordinates and snap_to_text:
+            index = self.text_region_index(image, dpi=dpi, page=page)
+            hits = sorted({i for box in coordinates for i in index.intersect(box, dpi=dpi)})
+            coordinates = [index.item(i)['bbox'] for i in hits]
+        
+        if coordinates:
+            # One removal pass over the union of all boxes
+            mask = self.create_mask_from_bboxes(image, coordinates)
             image = self.ai_enhanced_removal(image, mask)
         
-        return image
+        return image, coordinates
     
     def pdf_to_images(self, pdf_bytes: bytes) -> List[np.ndarray]:
         """
         Convert PDF to list of images
         
         Args:
-            pdf_bytes: PDF file as bytes
+            pdf_bytes: PDF file as bytes or memoryview
             
         Returns:
             List of images as numpy arrays
         """
         try:
-            # Save PDF temporarily
-            with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as tmp_file:
-                tmp_file.write(pdf_bytes)
-                tmp_path = tmp_file.name
-            
-            # Open PDF
-            doc = fitz.open(tmp_path)
             images = []
             
-            for page_num in range(len(doc)):
-                page = doc.load_page(page_num)
-                
-                # Render page as image
-                pix = page.get_pixmap(dpi=300)
-                img_data = pix.tobytes("png")
-                
-                # Convert to numpy array
-                pil_image = Image.open(io.BytesIO(img_data))
-                img_array = np.array(pil_image)
-                
-                # Convert RGB to BGR for OpenCV
-                if len(img_array.shape) == 3:
-                    img_array = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
-                
-                images.append(img_array)
-            
-            doc.close()
-            
-            # Cleanup
-            os.unlink(tmp_path)
+            # Open PDF straight from memory
+            with open_document(pdf_bytes) as doc:
+                for page_num in range(len(doc)):
+                    page = doc.load_page(page_num)
+                    
+                    # Render page as an OpenCV BGR image
+                    images.append(render_page(page, dpi=300, output='bgr'))
             
             return images
             
@@ -286,70 +631,251 @@ class EraseMode:
             print(f"Error converting PDF to images: {e}")
             return []
     
-    def images_to_pdf(self, images: List[np.ndarray]) -> bytes:
+    def page_images(self, pdf_bytes: bytes, cache_size: int = 4) -> PageImages:
+        """
+        Get lazily rendered page images for erasing
+        
+        Pages are rendered at 300 DPI on first access and kept in a small
+        LRU cache, instead of rendering the whole document up front.
+        
+        Args:
+            pdf_bytes: PDF file as bytes or memoryview
+            cache_size: Maximum number of rendered pages kept in memory
+            
+        Returns:
+            Sequence of images as numpy arrays
+        """
+        return PageImages(pdf_bytes, dpi=300, output='bgr', cache_size=cache_size)
+    
+    def redact_pdf(self, pdf_bytes, erasures: Dict[int, List[List[float]]],
+                   dpi: float = 300) -> bytes:
+        """
+        Erase regions in the original PDF instead of re-embedding page images
+        
+        Text-layer content under each region is removed with redaction
+        annotations, applied once per page, so fonts, vector graphics and the
+        remaining text stay selectable. Only where a region covers a raster
+        image is that area rendered, inpainted and patched back. Pages
+        without erasures are kept as they are.
+        
+        Args:
+            pdf_bytes: Original PDF as bytes or memoryview
+            erasures: Boxes [x1, y1, x2, y2] by page index, in pixels of page
+                images rendered at dpi (e.g. from applied_erasures())
+            dpi: Resolution the boxes are given in (72 for PDF points)
+            
+        Returns:
+            PDF as bytes
+            
+        Raises:
+            Exception: If the PDF cannot be processed
+        """
+        try:
+            with open_document(pdf_bytes) as doc:
+                for page_num, boxes in sorted(erasures.items()):
+                    if boxes:
+                        self._redact_page(doc.load_page(page_num), boxes, dpi)
+                return doc.tobytes(garbage=3, deflate=True)
+        except Exception as e:
+            raise Exception(f"🔴 Failed to redact PDF: {str(e)}")
+    
+    def _redact_page(self, page, boxes: List[List[float]], dpi: float):
+        """Redact text under the boxes and inpaint the raster images they cover"""
+        to_points = fitz.Matrix(72 / dpi, 72 / dpi) * page.derotation_matrix
+        rects = [fitz.Rect(box) * to_points for box in boxes]
+        image_rects = [fitz.Rect(info['bbox']) for info in page.get_image_info()]
+        
+        for rect in rects:
+            page.add_redact_annot(rect, fill=False, cross_out=False)
+        # Text only: images and line art under the boxes are left in place
+        page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE,
+                              graphics=fitz.PDF_REDACT_LINE_ART_NONE)
+        
+        # Pixel work only where a box overlaps an embedded image
+        margin = (2 * INPAINT_RADIUS + 8) * 72 / dpi
+        for rect in rects:
+            for image_rect in image_rects:
+                area = rect & image_rect
+                if area.is_empty:
+                    continue
+                # Render some surroundings too, for the inpainting to draw from
+                context = (area + (-margin, -margin, margin, margin)) & image_rect
+                patch = render_page(page, dpi, output='bgr', clip=context)
+                scale_x = patch.shape[1] / context.width
+                scale_y = patch.shape[0] / context.height
+                box = [int((area.x0 - context.x0) * scale_x), int((area.y0 - context.y0) * scale_y),
+                       int(np.ceil((area.x1 - context.x0) * scale_x)),
+                       int(np.ceil((area.y1 - context.y0) * scale_y))]
+                patch = self.ai_enhanced_removal(patch, self.create_mask_from_bboxes(patch, [box]))
+                ok, png = cv2.imencode('.png', patch)
+                if ok:
+                    page.insert_image(context, stream=png.tobytes(), keep_proportion=False)
+    
+    def images_to_pdf(self, images: List[Optional[np.ndarray]], codec: Any = 'auto',
+                      source_pdf=None, jpeg_quality: int = JPEG_QUALITY,
+                      workers: Optional[int] = None) -> bytes:
         """
         Convert list of images back to PDF
         
+        Pages are encoded on a thread pool (the OpenCV encoders release the
+        GIL) and inserted in order. Pages given as None are copied from
+        source_pdf as they are instead of being re-encoded.
+        
         Args:
-            images: List of images as numpy arrays
+            images: Page images as BGR/grayscale numpy arrays, or None for an
+                untouched page of source_pdf
+            codec: 'auto', 'png', 'jpeg' or 'bilevel', or a list with one per page.
+                'auto' picks bilevel for black-and-white scans, JPEG for
+                photographic pages and PNG for everything else.
+            source_pdf: Original PDF (bytes, memoryview, path or document) for None pages
+            jpeg_quality: JPEG quality (0-100)
+            workers: Encoder threads (defaults to the CPU count)
             
         Returns:
             PDF as bytes
         """
         try:
+            codecs = list(codec) if isinstance(codec, (list, tuple)) else [codec] * len(images)
+            jobs = [(i, image, codecs[i]) for i, image in enumerate(images) if image is not None]
+            
+            with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+                encoded = dict(zip([i for i, _, _ in jobs],
+                                   executor.map(lambda job: encode_page_image(job[1], job[2], jpeg_quality), jobs)))
+            
             # Create new PDF
             doc = fitz.open()
-            
-            for img_array in images:
-                # Convert BGR to RGB
-                if len(img_array.shape) == 3:
-                    img_array = cv2.cvtColor(img_array, cv2.COLOR_BGR2RGB)
-                
-                # Convert to PIL
-                pil_image = Image.fromarray(img_array)
-                
-                # Save to bytes
-                img_bytes = io.BytesIO()
-                pil_image.save(img_bytes, format='PNG')
-                img_bytes.seek(0)
-                
-                # Create PDF page
-                page = doc.new_page()
+            source = load_document(source_pdf) if source_pdf is not None else None
+            try:
+                i = 0
+                while i < len(images):
+                    if images[i] is None:
+                        if source is None:
+                            raise Exception("Untouched pages need source_pdf")
+                        # Copy each run of untouched pages in one call
+                        last = i
+                        while last + 1 < len(images) and images[last + 1] is None:
+                            last += 1
+                        doc.insert_pdf(source, from_page=i, to_page=last)
+                        i = last + 1
+                        continue
+                    
+                    # Create PDF page, sized like the original page when there is one
+                    sized_from_source = source is not None and i < len(source)
+                    if sized_from_source:
+                        page = doc.new_page(width=source[i].rect.width, height=source[i].rect.height)
+                    else:
+                        page = doc.new_page()
+                    
+                    # Insert image; only a page rendered from the source shares its aspect ratio
+                    page.insert_image(page.rect, stream=encoded[i], keep_proportion=not sized_from_source)
+                    i += 1
                 
-                # Insert image
-                page.insert_image(page.rect, stream=img_bytes.getvalue())
-            
-            # Get PDF as bytes
-            pdf_bytes = doc.write()
-            doc.close()
-            
-            return pdf_bytes
+                # Get PDF as bytes
+                return doc.write(garbage=3, deflate=True)
+            finally:
+                doc.close()
+                if source is not None and source is not source_pdf:
+                    source.close()
             
         except Exception as e:
             print(f"Error converting images to PDF: {e}")
             return b""
     
-    def add_to_history(self, image: np.ndarray, action: str):
+    def _pack_patch(self, array: np.ndarray) -> Dict[str, Any]:
+        """Compress an image or image region for the history."""
+        return {
+            'data': zlib.compress(np.ascontiguousarray(array).tobytes(), 1),
+            'shape': array.shape,
+            'dtype': array.dtype.str
+        }
+    
+    def _unpack_patch(self, patch: Dict[str, Any]) -> np.ndarray:
+        """Decompress a patch made by _pack_patch."""
+        return np.frombuffer(zlib.decompress(patch['data']), dtype=patch['dtype']).reshape(patch['shape'])
+    
+    def _apply_patch(self, entry: Dict[str, Any], patch: Optional[Dict[str, Any]]):
+        """Apply a history entry's before/after patch to the current state."""
+        if entry['kind'] == 'full':
+            self._state = self._unpack_patch(patch).copy()
+        elif entry['kind'] == 'patch':
+            x1, y1, x2, y2 = entry['bbox']
+            self._state[y1:y2, x1:x2] = self._unpack_patch(patch)
+    
+    def history_bytes(self) -> int:
+        """
+        Get the memory held by compressed history patches
+        
+        Returns:
+            Size in bytes
+        """
+        return sum(entry['size'] for entry in self.history)
+    
+    def memory_usage(self) -> int:
+        """
+        Get the total memory held by the history, including the current image
+        and the cached text region indexes
+        
+        Returns:
+            Size in bytes
+        """
+        index_bytes = sum(index.boxes.nbytes for index in self._region_indexes.values())
+        return self.history_bytes() + (self._state.nbytes if self._state is not None else 0) + index_bytes
+    
+    def add_to_history(self, image: np.ndarray, action: str,
+                       erasures: Optional[Dict[int, List[List[float]]]] = None):
         """
         Add current state to history for undo/redo
         
+        Only the rectangle that changed since the previous state is stored,
+        compressed, together with its inverse patch. The oldest steps are
+        dropped once the patches exceed history_budget_bytes.
+        
         Args:
             image: Current image state
             action: Description of action performed
+            erasures: Boxes erased by this action, by page index, for
+                replaying it on the original PDF with redact_pdf()
         """
         # Remove future history if we're not at the end
         if self.current_step < len(self.history) - 1:
             self.history = self.history[:self.current_step + 1]
         
+        previous = self._state
+        if previous is None:
+            entry = {'kind': 'base', 'bbox': None, 'before': None, 'after': None}
+        elif previous.shape != image.shape or previous.dtype != image.dtype:
+            entry = {'kind': 'full', 'bbox': None,
+                     'before': self._pack_patch(previous), 'after': self._pack_patch(image)}
+        else:
+            changed = previous != image
+            if changed.ndim == 3:
+                changed = changed.any(axis=2)
+            rows = np.flatnonzero(changed.any(axis=1))
+            cols = np.flatnonzero(changed.any(axis=0))
+            if rows.size == 0:
+                entry = {'kind': 'noop', 'bbox': None, 'before': None, 'after': None}
+            else:
+                x1, y1, x2, y2 = int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+                entry = {'kind': 'patch', 'bbox': (x1, y1, x2, y2),
+                         'before': self._pack_patch(previous[y1:y2, x1:x2]),
+                         'after': self._pack_patch(image[y1:y2, x1:x2])}
+        
+        entry['action'] = action
+        entry['erasures'] = {page: list(boxes) for page, boxes in (erasures or {}).items()}
+        entry['size'] = sum(len(entry[key]['data']) for key in ('before', 'after') if entry[key])
+        
         # Add to history
-        self.history.append({
-            'image': image.copy(),
-            'action': action
-        })
+        self.history.append(entry)
+        self._state = image.copy()
         
-        # Limit history size
-        if len(self.history) > self.max_history:
-            self.history.pop(0)
+        # Keep the patches within the memory budget; the oldest remaining
+        # step becomes the new base that cannot be undone past
+        while len(self.history) > 1 and self.history_bytes() > self.history_budget_bytes:
+            dropped = self.history.pop(0)
+            self.history[0].update({'kind': 'base', 'bbox': None, 'before': None, 'after': None, 'size': 0})
+            # Erasures of dropped steps are still applied
+            for page, boxes in dropped['erasures'].items():
+                self.history[0]['erasures'][page] = boxes + self.history[0]['erasures'].get(page, [])
         
         self.current_step = len(self.history) - 1
     
@@ -361,8 +887,10 @@ class EraseMode:
             Previous image state or None if no undo available
         """
         if self.current_step > 0:
+            entry = self.history[self.current_step]
+            self._apply_patch(entry, entry['before'])
             self.current_step -= 1
-            return self.history[self.current_step]['image'].copy()
+            return self._state.copy()
         return None
     
     def redo(self) -> Optional[np.ndarray]:
@@ -374,9 +902,24 @@ class EraseMode:
         """
         if self.current_step < len(self.history) - 1:
             self.current_step += 1
-            return self.history[self.current_step]['image'].copy()
+            entry = self.history[self.current_step]
+            self._apply_patch(entry, entry['after'])
+            return self._state.copy()
         return None
     
+    def applied_erasures(self) -> Dict[int, List[List[float]]]:
+        """
+        Get the erased boxes of every step up to the current one
+        
+        Returns:
+            Boxes by page index, oldest first; undone steps are excluded
+        """
+        erasures = {}
+        for entry in self.history[:self.current_step + 1]:
+            for page, boxes in entry['erasures'].items():
+                erasures.setdefault(page, []).extend(boxes)
+        return erasures
+    
     def get_history_info(self) -> Dict[str, Any]:
         """
         Get information about undo/redo history
@@ -388,8 +931,89 @@ class EraseMode:
             'can_undo': self.current_step > 0,
             'can_redo': self.current_step < len(self.history) - 1,
             'total_steps': len(self.history),
-            'current_step': self.current_step + 1
+            'current_step': self.current_step + 1,
+            'memory_bytes': self.memory_usage()
         }
 
-# Global instance
-erase_mode = EraseMode() 
\ No newline at end of file
+class EraseSessionRegistry:
+    """
+    One EraseMode engine per user session
+    
+    Engines idle for longer than idle_seconds are evicted, and the least
+    recently used sessions are evicted while all engines together hold
+    more than max_bytes.
+    """
+    
+    def __init__(self, idle_seconds: float = ERASE_SESSION_IDLE_SECONDS,
+                 max_bytes: int = ERASE_SESSIONS_MAX_BYTES,
+                 history_budget_bytes: int = HISTORY_BUDGET_BYTES):
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        self.history_budget_bytes = history_budget_bytes
+        # session_id -> [engine, last_used], least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, session_id: str) -> EraseMode:
+        """
+        Get the engine for a session, creating it if needed
+        
+        Args:
+            session_id: Unique id of the user session
+            
+        Returns:
+            The session's EraseMode engine
+        """
+        with self._lock:
+            now = time.monotonic()
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                entry = [EraseMode(history_budget_bytes=self.history_budget_bytes), now]
+                self._sessions[session_id] = entry
+            entry[1] = now
+            self._sessions.move_to_end(session_id)
+            self._evict(now, keep=session_id)
+            return entry[0]
+    
+    def release(self, session_id: str):
+        """
+        Drop a session's engine
+        
+        Args:
+            session_id: Unique id of the user session
+        """
+        with self._lock:
+            self._sessions.pop(session_id, None)
+    
+    def resident_bytes(self) -> int:
+        """
+        Get the memory held by all session engines
+        
+        Returns:
+            Size in bytes
+        """
+        with self._lock:
+            return sum(engine.memory_usage() for engine, _ in self._sessions.values())
+    
+    def enforce_limits(self):
+        """Evict idle sessions and trim to the memory cap."""
+        with self._lock:
+            self._evict(time.monotonic())
+    
+    def _evict(self, now: float, keep: Optional[str] = None):
+        for session_id, (_, last_used) in list(self._sessions.items()):
+            if session_id != keep and now - last_used > self.idle_seconds:
+                del self._sessions[session_id]
+        
+        total = sum(engine.memory_usage() for engine, _ in self._sessions.values())
+        for session_id in list(self._sessions):
+            if total <= self.max_bytes:
+                break
+            if session_id != keep:
+                total -= self._sessions.pop(session_id)[0].memory_usage()
+    
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+# Global registry
+erase_sessions = EraseSessionRegistry()
@@ -0,0 +1,549 @@
+"""
+ocr_utils.py - Shared OCR helpers and a persistent, content-addressed OCR result cache.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import re
+import shlex
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pytesseract
+from PIL import Image
+
+try:
+    import tesserocr  # Optional in-process Tesseract binding
+except ImportError:
+    tesserocr = None
+
+# Cache location and size cap (override via environment)
+OCR_CACHE_PATH = os.getenv(
+    "NEUROSCRIBE_OCR_CACHE",
+    os.path.join(os.path.expanduser("~"), ".neuroscribe", "ocr_cache.sqlite")
+)
+OCR_CACHE_MAX_BYTES = int(os.getenv("NEUROSCRIBE_OCR_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Indirect object reference inside a PDF object definition
+PDF_REFERENCE = re.compile(r"(\d+) (\d+) R\b")
+
+def _object_digest(doc, xref: int, memo: Dict[int, str]) -> str:
+    """
+    Hash a PDF object and everything it references, independent of xref numbers.
+
+    References are replaced by the digest of the object they point to, so
+    the same resources hash the same in any file.
+    """
+    if xref in memo:
+        return memo[xref]
+    memo[xref] = "cycle"  # Placeholder for objects that refer back to themselves
+    definition = doc.xref_object(xref, compressed=True)
+    digest = hashlib.sha256(_resolve_references(doc, definition, memo).encode())
+    if doc.xref_is_stream(xref):
+        digest.update(doc.xref_stream_raw(xref) or b"")
+    memo[xref] = digest.hexdigest()
+    return memo[xref]
+
+def _resolve_references(doc, definition: str, memo: Dict[int, str]) -> str:
+    return PDF_REFERENCE.sub(lambda ref: _object_digest(doc, int(ref.group(1)), memo), definition)
+
+def page_content_hash(page) -> str:
+    """
+    Hash what a page looks like without rasterising it.
+
+    Covers the page geometry, its content stream and every resource it can
+    draw with, followed recursively: images, form XObjects and their own
+    resources, fonts and font files, graphics states and patterns. Identical
+    pages hash identically across files.
+
+    Args:
+        page: PyMuPDF page object
+
+    Returns:
+        str: Hex digest identifying the page content
+    """
+    doc = page.parent
+    digest = hashlib.sha256()
+    digest.update(repr((tuple(page.rect), page.rotation)).encode())
+    digest.update(page.read_contents())
+
+    # Resources may be inherited from an ancestor in the page tree
+    xref = page.xref
+    kind, resources = doc.xref_get_key(xref, "Resources")
+    while kind == "null":
+        kind, parent = doc.xref_get_key(xref, "Parent")
+        if kind != "xref":
+            break
+        xref = int(parent.split()[0])
+        kind, resources = doc.xref_get_key(xref, "Resources")
+    digest.update(_resolve_references(doc, resources, {}).encode())
+    return digest.hexdigest()
+
+def parse_tesseract_data(data: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+    """
+    Turn pytesseract.image_to_data(output_type=Output.DICT) into word boxes.
+
+    Args:
+        data: Column dict returned by image_to_data
+
+    Returns:
+        List of words with 'bbox' [x1, y1, x2, y2], 'text', 'confidence'
+        (0-1) and the 'block'/'line' ids Tesseract assigned them
+    """
+    words = []
+    for i, text in enumerate(data['text']):
+        text = str(text).strip()
+        confidence = float(data['conf'][i])
+        if not text or confidence < 0:
+            continue
+        x, y = int(data['left'][i]), int(data['top'][i])
+        w, h = int(data['width'][i]), int(data['height'][i])
+        block = [int(data['page_num'][i]), int(data['block_num'][i])]
+        words.append({
+            'bbox': [x, y, x + w, y + h],
+            'text': text,
+            'confidence': confidence / 100.0,
+            'block': block,
+            'line': block + [int(data['par_num'][i]), int(data['line_num'][i])]
+        })
+    return words
+
+def group_text_boxes(words: List[Dict[str, Any]], level: str = 'word') -> List[Dict[str, Any]]:
+    """
+    Merge word boxes into line or block boxes.
+
+    Args:
+        words: Words from parse_tesseract_data()
+        level: 'word', 'line' or 'block'
+
+    Returns:
+        List of regions with 'bbox', 'text', mean 'confidence' and 'level'
+    """
+    if level == 'word':
+        return [{
+            'bbox': list(word['bbox']),
+            'text': word['text'],
+            'confidence': word['confidence'],
+            'level': 'word'
+        } for word in words]
+
+    if level not in ('line', 'block'):
+        raise ValueError(f"Unknown text level: {level}")
+
+    groups = {}
+    for word in words:
+        groups.setdefault(tuple(word[level]), []).append(word)
+
+    regions = []
+    for members in groups.values():
+        text = ""
+        previous_line = None
+        for word in members:
+            if previous_line is not None:
+                text += "\n" if tuple(word['line']) != previous_line else " "
+            text += word['text']
+            previous_line = tuple(word['line'])
+        regions.append({
+            'bbox': [
+                min(word['bbox'][0] for word in members),
+                min(word['bbox'][1] for word in members),
+                max(word['bbox'][2] for word in members),
+                max(word['bbox'][3] for word in members)
+            ],
+            'text': text,
+            'confidence': sum(word['confidence'] for word in members) / len(members),
+            'level': level
+        })
+    return regions
+
+class OcrCache:
+    """
+    On-disk OCR result cache backed by SQLite with LRU eviction.
+
+    Entries are keyed by a content hash plus the OCR configuration and hold
+    the recognised text and word boxes. Hit/miss counters live in the same
+    file, so lookups made in extraction worker processes are counted too.
+    """
+
+    def __init__(self, path: str = OCR_CACHE_PATH, max_bytes: int = OCR_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._initialised = False
+
+    @staticmethod
+    def make_key(content: Union[bytes, str, np.ndarray], config: str) -> str:
+        """
+        Build a cache key from page/image content and the OCR configuration.
+
+        Args:
+            content: Page content hash, raw bytes, or image array
+            config: Anything that changes the OCR output (engine flags, DPI, mode)
+
+        Returns:
+            str: Cache key
+        """
+        digest = hashlib.sha256(config.encode())
+        if isinstance(content, np.ndarray):
+            digest.update(repr((content.shape, content.dtype.str)).encode())
+            digest.update(np.ascontiguousarray(content).data)
+        elif isinstance(content, str):
+            digest.update(content.encode())
+        else:
+            digest.update(content)
+        return digest.hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        # A fresh connection per call keeps the cache safe to use from
+        # threads and forked worker processes alike
+        if not self._initialised:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialised:
+            with self._lock:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS entries (
+                        key TEXT PRIMARY KEY,
+                        payload TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        last_access REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS entries_last_access ON entries(last_access);
+                    CREATE TABLE IF NOT EXISTS counters (
+                        name TEXT PRIMARY KEY,
+                        value INTEGER NOT NULL
+                    );
+                """)
+                self._initialised = True
+        return conn
+
+    def _bump(self, conn: sqlite3.Connection, name: str, amount: int = 1) -> None:
+        conn.execute(
+            "INSERT INTO counters(name, value) VALUES(?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cached OCR result.
+
+        Args:
+            key: Key from make_key()
+
+        Returns:
+            Cached result dict ({'text': ..., 'words': [...]}) or None on a miss
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT payload FROM entries WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    self._bump(conn, "misses")
+                    return None
+                conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._bump(conn, "hits")
+            return json.loads(row[0])
+        finally:
+            conn.close()
+
+    def put(self, key: str, result: Dict[str, Any]) -> None:
+        """
+        Store an OCR result and evict least recently used entries over the size cap.
+
+        Args:
+            key: Key from make_key()
+            result: Result dict with 'text' and 'words'
+        """
+        payload = json.dumps(result)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries(key, payload, size, last_access) VALUES(?, ?, ?, ?)",
+                    (key, payload, len(payload), time.time())
+                )
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+                evicted = 0
+                while total > self.max_bytes:
+                    row = conn.execute(
+                        "SELECT key, size FROM entries ORDER BY last_access LIMIT 1"
+                    ).fetchone()
+                    if row is None:
+                        break
+                    conn.execute("DELETE FROM entries WHERE key = ?", (row[0],))
+                    total -= row[1]
+                    evicted += 1
+                if evicted:
+                    self._bump(conn, "evictions", evicted)
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get cache counters and current size.
+
+        Returns:
+            Dictionary with hits, misses, evictions, entries and size_bytes
+        """
+        conn = self._connect()
+        try:
+            counters = dict(conn.execute("SELECT name, value FROM counters").fetchall())
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+            ).fetchone()
+        finally:
+            conn.close()
+        return {
+            'hits': counters.get("hits", 0),
+            'misses': counters.get("misses", 0),
+            'evictions': counters.get("evictions", 0),
+            'entries': entries,
+            'size_bytes': size
+        }
+
+    def clear(self) -> None:
+        """Remove every cached entry and reset the counters."""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM entries")
+                conn.execute("DELETE FROM counters")
+        finally:
+            conn.close()
+
+# Global instance
+ocr_cache = OcrCache()
+
+# Columns of Tesseract's TSV output, as returned by image_to_data
+TSV_COLUMNS = ('level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num',
+               'left', 'top', 'width', 'height', 'conf', 'text')
+
+def parse_tesseract_tsv(tsv: str) -> List[Dict[str, List[Any]]]:
+    """
+    Split Tesseract TSV output into one image_to_data-style dict per page.
+
+    Args:
+        tsv: TSV text, with or without the header row
+
+    Returns:
+        List of column dicts, indexed by page_num - 1
+    """
+    pages: List[Dict[str, List[Any]]] = []
+    for line in tsv.splitlines():
+        fields = line.split("\t")
+        if len(fields) < len(TSV_COLUMNS) - 1 or fields[0] == 'level':
+            continue
+        fields += [""] * (len(TSV_COLUMNS) - len(fields))
+        page_index = int(fields[1]) - 1
+        while len(pages) <= page_index:
+            pages.append({column: [] for column in TSV_COLUMNS})
+        for column, value in zip(TSV_COLUMNS, fields):
+            if column == 'conf':
+                value = float(value)
+            elif column != 'text':
+                value = int(value)
+            pages[page_index][column].append(value)
+    return pages
+
+def split_config(config: str) -> List[str]:
+    """
+    Split a tesseract CLI config string into arguments the way pytesseract does.
+
+    Windows configs are split without POSIX quoting rules. Elsewhere a config
+    with unbalanced quotes (e.g. a whitelist containing \" or \') falls back
+    to the same non-POSIX split instead of failing.
+
+    Args:
+        config: Config string, e.g. '--oem 3 --psm 6 -c name=value'
+
+    Returns:
+        List of arguments
+    """
+    if sys.platform == 'win32':
+        return shlex.split(config, posix=False)
+    try:
+        return shlex.split(config)
+    except ValueError:
+        return shlex.split(config, posix=False)
+
+def _pytesseract_config(config: str) -> str:
+    # pytesseract splits with POSIX rules off Windows; quote the arguments so
+    # its split gives the same result as split_config()
+    if sys.platform == 'win32':
+        return config
+    return shlex.join(split_config(config))
+
+def _parse_config(config: str) -> Tuple[Optional[int], Optional[int], Dict[str, str]]:
+    """Split a tesseract CLI config string into (oem, psm, -c variables)."""
+    oem = psm = None
+    variables = {}
+    args = split_config(config)
+    i = 0
+    while i < len(args):
+        if args[i] == '--oem' and i + 1 < len(args):
+            oem = int(args[i + 1])
+            i += 1
+        elif args[i] == '--psm' and i + 1 < len(args):
+            psm = int(args[i + 1])
+            i += 1
+        elif args[i] == '-c' and i + 1 < len(args) and '=' in args[i + 1]:
+            name, value = args[i + 1].split('=', 1)
+            variables[name] = value
+            i += 1
+        i += 1
+    return oem, psm, variables
+
+class OcrService:
+    """
+    Shared OCR entry point with long-lived workers and a concurrency limit.
+
+    Uses a pool of in-process tesserocr engines when the binding is
+    installed: each engine loads its traineddata once and is reused for
+    every call with the same config. Otherwise it shells out to the
+    tesseract CLI, recognising a whole batch of images in one invocation
+    through a file list instead of one process per image.
+    """
+
+    def __init__(self, max_concurrency: Optional[int] = None, lang: str = 'eng'):
+        """
+        Args:
+            max_concurrency: Maximum OCR calls in flight (defaults to the CPU count)
+            lang: Tesseract language
+        """
+        self.max_concurrency = max_concurrency or os.cpu_count() or 1
+        self.lang = lang
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._engines: Dict[str, "queue.LifoQueue"] = {}
+        self._engines_lock = threading.Lock()
+
+    @property
+    def in_process(self) -> bool:
+        """Whether OCR runs through the in-process tesserocr binding."""
+        return tesserocr is not None
+
+    def ocr_page(self, image: Union[np.ndarray, Image.Image], config: str = '',
+                 output: str = 'text') -> Union[str, Dict[str, List[Any]]]:
+        """
+        OCR one image.
+
+        Args:
+            image: Grayscale/RGB numpy array or PIL image
+            config: Tesseract CLI style config, e.g. '--oem 3 --psm 6'
+            output: 'text' for a string, 'data' for an image_to_data-style dict
+
+        Returns:
+            Recognised text or word data
+
+        Raises:
+            Exception: If OCR fails
+        """
+        with self._slots:
+            if self.in_process:
+                return self._engine_ocr([image], config, output)[0]
+            if output == 'data':
+                return pytesseract.image_to_data(image, config=_pytesseract_config(config),
+                                                 output_type=pytesseract.Output.DICT)
+            return pytesseract.image_to_string(image, config=_pytesseract_config(config))
+
+    def ocr_batch(self, images: Sequence[Union[np.ndarray, Image.Image]], config: str = '',
+                  output: str = 'text') -> List[Union[str, Dict[str, List[Any]]]]:
+        """
+        OCR many images with one engine checkout or one tesseract process.
+
+        Args:
+            images: Grayscale/RGB numpy arrays or PIL images
+            config: Tesseract CLI style config, e.g. '--psm 8'
+            output: 'text' for strings, 'data' for image_to_data-style dicts
+
+        Returns:
+            One result per image, in order
+
+        Raises:
+            Exception: If OCR fails
+        """
+        if len(images) == 0:
+            return []
+        if len(images) == 1 and not self.in_process:
+            return [self.ocr_page(images[0], config, output)]
+        with self._slots:
+            if self.in_process:
+                return self._engine_ocr(images, config, output)
+            return self._cli_batch(images, config, output)
+
+    def _engine_ocr(self, images, config: str, output: str) -> list:
+        with self._engines_lock:
+            pool = self._engines.setdefault(config, queue.LifoQueue())
+        try:
+            engine = pool.get_nowait()
+        except queue.Empty:
+            oem, psm, variables = _parse_config(config)
+            kwargs = {'lang': self.lang}
+            if oem is not None:
+                kwargs['oem'] = tesserocr.OEM(oem)
+            if psm is not None:
+                kwargs['psm'] = tesserocr.PSM(psm)
+            engine = tesserocr.PyTessBaseAPI(**kwargs)
+            for name, value in variables.items():
+                engine.SetVariable(name, value)
+
+        try:
+            results = []
+            for image in images:
+                if isinstance(image, np.ndarray):
+                    image = Image.fromarray(image)
+                engine.SetImage(image)
+                if output == 'data':
+                    pages = parse_tesseract_tsv(engine.GetTSVText(0))
+                    results.append(pages[0] if pages else {column: [] for column in TSV_COLUMNS})
+                else:
+                    results.append(engine.GetUTF8Text())
+            return results
+        finally:
+            # Engines go back to the pool so the traineddata stays loaded
+            pool.put(engine)
+
+    def _cli_batch(self, images, config: str, output: str) -> list:
+        with tempfile.TemporaryDirectory(prefix="neuroscribe_ocr_") as tmp_dir:
+            paths = []
+            for i, image in enumerate(images):
+                if isinstance(image, np.ndarray):
+                    image = Image.fromarray(image)
+                # Uncompressed PNM keeps the write cheap
+                path = os.path.join(tmp_dir, f"{i}.pnm")
+                image.convert("L" if image.mode in ("1", "L") else "RGB").save(path, format="PPM")
+                paths.append(path)
+            list_path = os.path.join(tmp_dir, "images.txt")
+            with open(list_path, "w") as f:
+                f.write("\n".join(paths) + "\n")
+
+            cmd = [pytesseract.pytesseract.tesseract_cmd, list_path, "stdout"] + split_config(config)
+            if output == 'data':
+                cmd.append("tsv")
+            result = subprocess.run(cmd, capture_output=True, check=True)
+            stdout = result.stdout.decode('utf-8', errors='ignore')
+
+        if output == 'data':
+            pages = parse_tesseract_tsv(stdout)
+            # A fresh dict per missing page, so callers can fill them in independently
+            pages += [{column: [] for column in TSV_COLUMNS} for _ in range(len(images) - len(pages))]
+            return pages[:len(images)]
+
+        # Tesseract ends every image's text with a form feed
+        texts = stdout.split("\f")
+        if len(texts) < len(images):
+            raise Exception(f"Tesseract returned {len(texts)} pages for {len(images)} images")
+        return texts[:len(images)]
+
+# Global instance
+ocr_service = OcrService()
@@ -2,13 +2,566 @@
 openai_utils.py - Handles GPT-based rewriting and prompt generation.
 """
 
+import asyncio
+import hashlib
+import json
 import os
-from typing import Optional
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import httpx
 import openai
 from dotenv import load_dotenv
 
+try:
+    import tiktoken  # Optional exact token counts
+except ImportError:
+    tiktoken = None
+
 load_dotenv()
 
+# Chat model used for rewriting
+GPT_MODEL = "gpt-3.5-turbo"
+
+# Rewrite requests allowed in flight at once by rewrite_many()
+REWRITE_CONCURRENCY = 8
+
+# Input token budget of one packed request, and the largest block worth packing
+PACK_MAX_TOKENS = 1500
+PACK_BLOCK_MAX_TOKENS = 200
+
+# Upstream rate limits enforced before sending (override via environment)
+GPT_REQUESTS_PER_MINUTE = float(os.getenv("NEUROSCRIBE_GPT_RPM", "500"))
+GPT_TOKENS_PER_MINUTE = float(os.getenv("NEUROSCRIBE_GPT_TPM", "160000"))
+
+# Retries of rate-limited, timed-out and 5xx requests, with jittered exponential backoff
+GPT_MAX_RETRIES = 4
+GPT_BACKOFF_BASE = 0.5
+GPT_BACKOFF_MAX = 30.0
+
+# Consecutive upstream failures that open the circuit, and how long it stays open
+GPT_BREAKER_THRESHOLD = 5
+GPT_BREAKER_COOLDOWN = 30.0
+
+# Largest bbox offset, in points, at which blocks with the same text on
+# different pages count as the same header/footer
+DEDUP_POSITION_TOLERANCE = 6.0
+
+# Response cache location, size cap and lifetime (override via environment)
+LLM_CACHE_PATH = os.getenv(
+    "NEUROSCRIBE_LLM_CACHE",
+    os.path.join(os.path.expanduser("~"), ".neuroscribe", "llm_cache.sqlite")
+)
+LLM_CACHE_MAX_BYTES = int(os.getenv("NEUROSCRIBE_LLM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+LLM_CACHE_TTL = float(os.getenv("NEUROSCRIBE_LLM_CACHE_TTL", str(30 * 24 * 3600)))
+
+# Responses also kept in process memory, so repeat hits skip SQLite
+LLM_CACHE_MEMORY_ENTRIES = 1024
+
+# Instruction wrapped around each text by rewrite_with_gpt()
+REWRITE_INSTRUCTION = """
+        Please rewrite the following text to improve clarity, grammar, and flow:
+        
+        {text}
+        
+        Return only the rewritten text without any additional commentary.
+        """
+
+# Instruction for several blocks sent in one request; each block follows a marker
+PACKED_REWRITE_INSTRUCTION = """
+        Please rewrite each of the following text blocks to improve clarity, grammar, and flow.
+        Each block starts with a marker line like [[BLOCK 1]]. Rewrite every block on its own,
+        keep the blocks in the same order, and start each rewritten block with its original
+        marker line. Return only the markers and the rewritten blocks without any additional commentary.
+        
+        {blocks}
+        """
+
+# Marker line opening each block of a packed request and its response
+BLOCK_MARKER = "[[BLOCK {number}]]"
+BLOCK_MARKER_PATTERN = re.compile(r"^[ \t]*\[\[BLOCK (\d+)\]\][ \t]*$", re.MULTILINE)
+
+class ResponseCache:
+    """
+    On-disk GPT response cache backed by SQLite with a TTL and LRU eviction.
+    
+    Entries are keyed by a hash of everything that determines the response
+    (model, system prompt, command and input text). Recently used responses
+    are also held in memory, so repeated lookups in one session return
+    without touching the disk. Counters are kept per process.
+    """
+    
+    def __init__(self, path: str = LLM_CACHE_PATH, max_bytes: int = LLM_CACHE_MAX_BYTES,
+                 ttl: float = LLM_CACHE_TTL, memory_entries: int = LLM_CACHE_MEMORY_ENTRIES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self._lock = threading.Lock()
+        self._initialised = False
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        # Access times of memory hits, written to SQLite before the next eviction
+        self._touched: Dict[str, float] = {}
+        self._counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+    
+    @staticmethod
+    def make_key(model: str, system_prompt: Optional[str], command: str, text: str) -> str:
+        """
+        Build a cache key from everything that changes the response.
+        
+        Args:
+            model (str): Chat model name.
+            system_prompt (str, optional): System message, if any.
+            command (str): Instruction applied to the text.
+            text (str): Input text.
+            
+        Returns:
+            str: Cache key
+        """
+        payload = json.dumps([model, system_prompt, command, text], ensure_ascii=False)
+        return hashlib.sha256(payload.encode()).hexdigest()
+    
+    def _connect(self) -> sqlite3.Connection:
+        if not self._initialised:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialised:
+            with self._lock:
+                conn.executescript("""
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY,
+                        response TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        created REAL NOT NULL,
+                        last_access REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access);
+                """)
+                self._initialised = True
+        return conn
+    
+    def _remember(self, key: str, response: str, created: float) -> None:
+        with self._lock:
+            self._memory[key] = (response, created)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+    
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._counters[name] += amount
+    
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached response.
+        
+        Args:
+            key (str): Key from make_key().
+            
+        Returns:
+            Optional[str]: The cached response, or None on a miss or expired entry.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self._touched[key] = now
+                self._counters['hits'] += 1
+                return entry[0]
+        
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute(
+                    "SELECT response, created FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and now - row[1] > self.ttl:
+                    conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._count('expired')
+                    row = None
+                if row is None:
+                    with self._lock:
+                        self._memory.pop(key, None)
+                    self._count('misses')
+                    return None
+                conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        finally:
+            conn.close()
+        self._remember(key, row[0], row[1])
+        self._count('hits')
+        return row[0]
+    
+    def put(self, key: str, response: str) -> None:
+        """
+        Store a response and evict least recently used entries over the size cap.
+        
+        Args:
+            key (str): Key from make_key().
+            response (str): Response text.
+        """
+        now = time.time()
+        size = len(response.encode())
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE responses SET last_access = ? WHERE key = ?",
+                    [(accessed, touched_key) for touched_key, accessed in touched.items()]
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses(key, response, size, created, last_access) "
+                    "VALUES(?, ?, ?, ?, ?)",
+                    (key, response, size, now, now)
+                )
+                expired = conn.execute(
+                    "DELETE FROM responses WHERE created < ?", (now - self.ttl,)
+                ).rowcount
+                total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                evicted = 0
+                while total > self.max_bytes:
+                    row = conn.execute(
+                        "SELECT key, size FROM responses ORDER BY last_access LIMIT 1"
+                    ).fetchone()
+                    if row is None:
+                        break
+                    conn.execute("DELETE FROM responses WHERE key = ?", (row[0],))
+                    with self._lock:
+                        self._memory.pop(row[0], None)
+                    total -= row[1]
+                    evicted += 1
+        finally:
+            conn.close()
+        if expired:
+            self._count('expired', expired)
+        if evicted:
+            self._count('evictions', evicted)
+        self._remember(key, response, now)
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get cache counters for this process and the current cache size.
+        
+        Returns:
+            Dict[str, Any]: hits, misses, hit_rate, evictions, expired, entries and size_bytes
+        """
+        conn = self._connect()
+        try:
+            entries, size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        finally:
+            conn.close()
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters['hits'] + counters['misses']
+        counters['hit_rate'] = counters['hits'] / lookups if lookups else 0.0
+        counters['entries'] = entries
+        counters['size_bytes'] = size
+        return counters
+    
+    def clear(self) -> None:
+        """Remove every cached response and reset the counters."""
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM responses")
+        finally:
+            conn.close()
+        with self._lock:
+            self._memory.clear()
+            self._touched.clear()
+            self._counters = dict.fromkeys(self._counters, 0)
+
+# Global instance
+response_cache = ResponseCache()
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at a per-minute rate.
+    
+    reserve() deducts straight away, letting the balance go negative, and
+    returns how long the caller must wait before sending. Callers that
+    reserve together are therefore spaced out instead of all waking at once.
+    """
+    
+    def __init__(self, per_minute: float, clock=time.monotonic):
+        self.capacity = max(float(per_minute), 1.0)
+        self.rate = self.capacity / 60.0
+        self._clock = clock
+        self._level = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+    
+    def reserve(self, amount: float = 1.0) -> float:
+        """
+        Take `amount` from the bucket.
+        
+        Args:
+            amount (float): Units to take; capped at the bucket capacity.
+            
+        Returns:
+            float: Seconds to wait before the reservation may be used.
+        """
+        with self._lock:
+            now = self._clock()
+            self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+            self._updated = now
+            self._level -= min(amount, self.capacity)
+            return max(0.0, -self._level / self.rate)
+
+class CircuitOpenError(Exception):
+    """Raised without calling the API while the circuit breaker is open."""
+
+class RequestGovernor:
+    """
+    Rate limiter, retry policy and circuit breaker around GPT requests.
+    
+    Every attempt first reserves one request and its estimated tokens from
+    per-minute token buckets. Rate-limited, timed-out and 5xx responses are
+    retried with jittered exponential backoff, waiting at least as long as
+    the server's Retry-After. After `failure_threshold` consecutive upstream
+    failures the circuit opens and requests fail fast with CircuitOpenError;
+    once `cooldown` has passed a single probe request decides whether it
+    closes again.
+    """
+    
+    def __init__(self, requests_per_minute: float = GPT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = GPT_TOKENS_PER_MINUTE,
+                 max_retries: int = GPT_MAX_RETRIES, backoff_base: float = GPT_BACKOFF_BASE,
+                 backoff_max: float = GPT_BACKOFF_MAX, failure_threshold: int = GPT_BREAKER_THRESHOLD,
+                 cooldown: float = GPT_BREAKER_COOLDOWN, clock=time.monotonic):
+        self.requests = TokenBucket(requests_per_minute, clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._opened_at = 0.0
+        self._probing = False
+        self._consecutive_failures = 0
+        self._counters = {
+            'requests': 0, 'successes': 0, 'failures': 0, 'retries': 0,
+            'rate_limited': 0, 'throttle_seconds': 0.0, 'backoff_seconds': 0.0,
+            'circuit_opens': 0, 'fast_failures': 0
+        }
+    
+    @staticmethod
+    def is_retryable(error: Exception) -> bool:
+        """Check whether an API error is worth retrying (429, 408, 409, 5xx, timeouts)."""
+        if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        status = getattr(error, 'status_code', None)
+        return status is not None and (status in (408, 409, 429) or status >= 500)
+    
+    @staticmethod
+    def retry_after(error: Exception) -> Optional[float]:
+        """
+        Read the server's requested delay from a failed response.
+        
+        Args:
+            error (Exception): API error, possibly carrying an httpx response.
+            
+        Returns:
+            Optional[float]: Seconds from retry-after-ms or Retry-After, if present.
+        """
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None)
+        if not headers:
+            return None
+        try:
+            if headers.get('retry-after-ms') is not None:
+                return float(headers['retry-after-ms']) / 1000.0
+            value = headers.get('retry-after')
+            if value is None:
+                return None
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+    
+    def _admit(self, tokens: int) -> Tuple[float, bool]:
+        # Returns the throttle delay and whether this attempt is the half-open probe
+        with self._lock:
+            probe = False
+            if self._state == 'open':
+                if self._clock() - self._opened_at < self.cooldown or self._probing:
+                    self._counters['fast_failures'] += 1
+                    raise CircuitOpenError("🔴 GPT requests paused: the API is failing, retrying shortly")
+                self._state = 'half_open'
+            if self._state == 'half_open':
+                if self._probing:
+                    self._counters['fast_failures'] += 1
+                    raise CircuitOpenError("🔴 GPT requests paused: the API is failing, retrying shortly")
+                self._probing = probe = True
+            self._counters['requests'] += 1
+        wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+        if wait:
+            with self._lock:
+                self._counters['throttle_seconds'] += wait
+        return wait, probe
+    
+    def _succeeded(self, probe: bool) -> None:
+        with self._lock:
+            self._counters['successes'] += 1
+            self._consecutive_failures = 0
+            self._state = 'closed'
+            if probe:
+                self._probing = False
+    
+    def _failed(self, error: Exception, attempt: int, probe: bool) -> Optional[float]:
+        # Returns the backoff before the next attempt, or None to give up
+        with self._lock:
+            self._counters['failures'] += 1
+            if probe:
+                self._probing = False
+            if not self.is_retryable(error):
+                # The API answered; a bad request says nothing about its health
+                if self._state == 'half_open':
+                    self._state = 'closed'
+                self._consecutive_failures = 0
+                return None
+            if getattr(error, 'status_code', None) == 429:
+                self._counters['rate_limited'] += 1
+            self._consecutive_failures += 1
+            if self._state == 'half_open' or self._consecutive_failures >= self.failure_threshold:
+                if self._state != 'open':
+                    self._counters['circuit_opens'] += 1
+                self._state = 'open'
+                self._opened_at = self._clock()
+                return None
+            if attempt >= self.max_retries:
+                return None
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            server_delay = self.retry_after(error)
+            if server_delay is not None:
+                delay = max(delay, min(server_delay, self.backoff_max))
+            self._counters['retries'] += 1
+            self._counters['backoff_seconds'] += delay
+            return delay
+    
+    def _release(self, probe: bool) -> None:
+        # Frees the probe slot if its attempt was cancelled before finishing
+        if probe:
+            with self._lock:
+                if self._probing and self._state == 'half_open':
+                    self._probing = False
+    
+    def call(self, send, tokens: int = 0):
+        """
+        Run a blocking API call under the rate limits, retries and breaker.
+        
+        Args:
+            send: Zero-argument function making one request.
+            tokens (int): Estimated tokens the request uses.
+            
+        Returns:
+            Whatever send() returns.
+            
+        Raises:
+            CircuitOpenError: If the circuit is open.
+            Exception: The last API error once retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            wait, probe = self._admit(tokens)
+            try:
+                if wait:
+                    time.sleep(wait)
+                try:
+                    result = send()
+                except Exception as e:
+                    delay = self._failed(e, attempt, probe)
+                    probe = False
+                    if delay is None:
+                        raise
+                else:
+                    self._succeeded(probe)
+                    probe = False
+                    return result
+            finally:
+                self._release(probe)
+            time.sleep(delay)
+            attempt += 1
+    
+    async def call_async(self, send, tokens: int = 0):
+        """
+        Async counterpart of call().
+        
+        Args:
+            send: Zero-argument function returning an awaitable for one request.
+            tokens (int): Estimated tokens the request uses.
+            
+        Returns:
+            Whatever the awaited send() returns.
+            
+        Raises:
+            CircuitOpenError: If the circuit is open.
+            Exception: The last API error once retries are exhausted.
+        """
+        attempt = 0
+        while True:
+            wait, probe = self._admit(tokens)
+            try:
+                if wait:
+                    await asyncio.sleep(wait)
+                try:
+                    result = await send()
+                except Exception as e:
+                    delay = self._failed(e, attempt, probe)
+                    probe = False
+                    if delay is None:
+                        raise
+                else:
+                    self._succeeded(probe)
+                    probe = False
+                    return result
+            finally:
+                self._release(probe)
+            await asyncio.sleep(delay)
+            attempt += 1
+    
+    @property
+    def state(self) -> str:
+        """Circuit state: 'closed', 'open' or 'half_open'."""
+        with self._lock:
+            if self._state == 'open' and self._clock() - self._opened_at >= self.cooldown:
+                return 'half_open'
+            return self._state
+    
+    def stats(self) -> Dict[str, Any]:
+        """
+        Get the governor's counters.
+        
+        Returns:
+            Dict[str, Any]: requests, successes, failures, retries, rate_limited,
+            throttle_seconds, backoff_seconds, circuit_opens, fast_failures and state
+        """
+        with self._lock:
+            counters = dict(self._counters)
+        counters['state'] = self.state
+        return counters
+
+# Global instance
+gpt_governor = RequestGovernor()
+
 def set_openai_api_key() -> None:
     """
     Set the OpenAI API key from environment variables.
@@ -20,6 +573,12 @@ def set_openai_api_key() -> None:
     if api_key is None:
         raise ValueError("OpenAI API key not found. Please set it in the .env file.")
     openai.api_key = api_key
+    # Retries are handled by gpt_governor, not the client
+    openai.max_retries = 0
+    # openai 1.3.7 passes a 'proxies' argument that httpx 0.28 no longer
+    # accepts when it builds its own client, so always hand it one
+    if openai.http_client is None:
+        openai.http_client = httpx.Client(timeout=openai.DEFAULT_TIMEOUT)
 
 def get_gpt_response(prompt: str) -> str:
     """
@@ -34,31 +593,370 @@ def get_gpt_response(prompt: str) -> str:
     Raises:
         Exception: If the API call fails.
     """
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}]
+    response = gpt_governor.call(
+        lambda: openai.chat.completions.create(
+            model=GPT_MODEL,
+            messages=[{"role": "user", "content": prompt}]
+        ),
+        tokens=_request_tokens(prompt)
+    )
+    return response.choices[0].message.content
+
+async def get_gpt_response_async(prompt: str, client: openai.AsyncOpenAI) -> str:
+    """
+    Get a response from GPT without blocking the event loop.
+    
+    Args:
+        prompt (str): The prompt to send to GPT.
+        client (openai.AsyncOpenAI): Client to send it with.
+        
+    Returns:
+        str: The response from GPT.
+        
+    Raises:
+        Exception: If the API call fails.
+    """
+    response = await gpt_governor.call_async(
+        lambda: client.chat.completions.create(
+            model=GPT_MODEL,
+            messages=[{"role": "user", "content": prompt}]
+        ),
+        tokens=_request_tokens(prompt)
     )
-    return response.choices[0].message['content']
+    return response.choices[0].message.content
 
-def rewrite_with_gpt(text: str) -> str:
+def _rewrite_prompt(text: str) -> str:
+    """Build the rewrite instruction for one text."""
+    return REWRITE_INSTRUCTION.format(text=text)
+
+def _rewrite_key(text: str) -> str:
+    return ResponseCache.make_key(GPT_MODEL, None, REWRITE_INSTRUCTION, text)
+
+def estimate_tokens(text: str) -> int:
+    """
+    Count the tokens a text costs in a prompt.
+    
+    Uses tiktoken when it is installed and has an encoding for GPT_MODEL,
+    otherwise about four characters per token.
+    
+    Args:
+        text (str): Text to measure.
+        
+    Returns:
+        int: Token count (estimated without tiktoken).
+    """
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return len(text) // 4 + 1
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(GPT_MODEL)
+    except Exception:
+        # Unknown model, or the encoding files could not be downloaded
+        return None
+
+def _request_tokens(prompt: str) -> int:
+    # A rewrite is about as long as its input, so count the prompt twice
+    return 2 * estimate_tokens(prompt)
+
+def pack_blocks(texts: Sequence[str], max_tokens: int = PACK_MAX_TOKENS,
+                block_max_tokens: int = PACK_BLOCK_MAX_TOKENS) -> List[List[int]]:
+    """
+    Group adjacent short texts into packs that fit one request.
+    
+    Texts over block_max_tokens get a pack of their own, and a pack is
+    closed once adding the next text would exceed max_tokens.
+    
+    Args:
+        texts (Sequence[str]): Texts in document order.
+        max_tokens (int): Token budget for the texts of one pack.
+        block_max_tokens (int): Largest text that is packed with others.
+        
+    Returns:
+        List[List[int]]: Packs of text indices, in order.
+    """
+    packs: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for index, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if tokens > block_max_tokens:
+            if current:
+                packs.append(current)
+            packs.append([index])
+            current, current_tokens = [], 0
+            continue
+        if current and current_tokens + tokens > max_tokens:
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append(index)
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+def _packed_prompt(texts: Sequence[str]) -> str:
+    """Build one rewrite instruction covering several marked blocks."""
+    blocks = "\n\n".join(
+        f"{BLOCK_MARKER.format(number=number)}\n{text}" for number, text in enumerate(texts, 1)
+    )
+    return PACKED_REWRITE_INSTRUCTION.format(blocks=blocks)
+
+def split_packed_response(response: str, count: int) -> Optional[List[str]]:
+    """
+    Split the response to a packed request back into per-block rewrites.
+    
+    Args:
+        response (str): Model output for _packed_prompt().
+        count (int): Number of blocks that were sent.
+        
+    Returns:
+        Optional[List[str]]: One rewrite per block, or None unless the
+        response holds exactly markers 1..count, in order, each with text.
+    """
+    markers = list(BLOCK_MARKER_PATTERN.finditer(response))
+    if [int(marker.group(1)) for marker in markers] != list(range(1, count + 1)):
+        return None
+    if response[:markers[0].start()].strip():
+        return None  # Commentary before the first block
+    parts = []
+    for marker, following in zip(markers, markers[1:] + [None]):
+        end = following.start() if following is not None else len(response)
+        part = response[marker.end():end].strip()
+        if not part:
+            return None
+        parts.append(part)
+    return parts
+
+def rewrite_with_gpt(text: str, *, use_cache: bool = True) -> str:
     """
     Rewrite a given text using GPT-3.5-turbo.
     
     Args:
         text (str): Original input text to be rewritten.
+        use_cache (bool): Return a cached rewrite if there is one. Pass False
+            to regenerate; the new response still replaces the cached one.
+        
+    Returns:
+        str: Rewritten text from GPT.
+        
+    Raises:
+        Exception: If the API key is missing or the request fails; nothing
+            is cached, so error text never stands in for a rewrite.
+    """
+    key = _rewrite_key(text)
+    if use_cache:
+        cached = response_cache.get(key)
+        if cached is not None:
+            return cached
+    set_openai_api_key()
+    response = get_gpt_response(_rewrite_prompt(text))
+    response_cache.put(key, response)
+    return response
+
+def _fails_every_block(error: Exception) -> bool:
+    """Check whether a failed packed request would fail for each of its blocks too."""
+    if isinstance(error, CircuitOpenError):
+        return True
+    # A 400/413 may be down to the pack's size; auth, permission and other
+    # client errors (401, 403, 404, ...) are not
+    status = getattr(error, 'status_code', None)
+    return status is not None and status not in (400, 413) and not RequestGovernor.is_retryable(error)
+
+async def rewrite_many_async(texts: Sequence[str], concurrency: int = REWRITE_CONCURRENCY,
+                             client: Optional[openai.AsyncOpenAI] = None,
+                             use_cache: bool = True, pack: bool = True) -> List[Dict[str, Any]]:
+    """
+    Rewrite many texts concurrently with at most `concurrency` requests in flight.
+    
+    Cached rewrites are returned without a request; only the misses are sent.
+    Adjacent short misses are packed into one request (see pack_blocks());
+    if a packed response cannot be split back into its blocks, each block of
+    that pack is sent on its own instead. A pack that fails with an error
+    every block would hit as well (e.g. 401/403, or an open circuit) fails
+    all its blocks without further requests.
+    
+    Args:
+        texts (Sequence[str]): Original input texts.
+        concurrency (int): Maximum simultaneous requests.
+        client (openai.AsyncOpenAI, optional): Client to use; one is created
+            (and closed) from the environment's API key otherwise.
+        use_cache (bool): Reuse cached rewrites. Pass False to regenerate
+            every text; new responses still replace the cached ones.
+        pack (bool): Pack short texts into shared requests.
         
     Returns:
-        str: Rewritten text from GPT, or error message if processing fails.
+        List[Dict[str, Any]]: One result per text, in input order, with the
+        rewritten 'text', 'error' (None on success; 'text' is None on failure)
+        and 'cached' (True if no request was made).
     """
+    keys = [_rewrite_key(text) for text in texts]
+    results: List[Optional[Dict[str, Any]]] = [None] * len(texts)
+    if use_cache:
+        for index, key in enumerate(keys):
+            cached = response_cache.get(key)
+            if cached is not None:
+                results[index] = {'text': cached, 'error': None, 'cached': True}
+    pending = [index for index, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+    
+    owns_client = client is None
     try:
-        set_openai_api_key()
-        prompt = f"""
-        Please rewrite the following text to improve clarity, grammar, and flow:
+        if pack:
+            packs = [[pending[i] for i in group] for group in pack_blocks([texts[index] for index in pending])]
+        else:
+            packs = [[index] for index in pending]
+        if owns_client:
+            set_openai_api_key()
+            # client.close() below also closes this http_client
+            client = openai.AsyncOpenAI(api_key=openai.api_key, max_retries=0,
+                                        http_client=httpx.AsyncClient(timeout=openai.DEFAULT_TIMEOUT))
+    except Exception as e:
+        for index in pending:
+            results[index] = {'text': None, 'error': str(e), 'cached': False}
+        return results
+    
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    
+    async def rewrite_one(index: int) -> None:
+        async with semaphore:
+            try:
+                response = await get_gpt_response_async(_rewrite_prompt(texts[index]), client)
+            except Exception as e:
+                results[index] = {'text': None, 'error': str(e), 'cached': False}
+                return
+        response_cache.put(keys[index], response)
+        results[index] = {'text': response, 'error': None, 'cached': False}
+    
+    async def rewrite_pack(pack_indices: List[int]) -> None:
+        if len(pack_indices) > 1:
+            async with semaphore:
+                try:
+                    response = await get_gpt_response_async(
+                        _packed_prompt([texts[index] for index in pack_indices]), client
+                    )
+                    parts = split_packed_response(response, len(pack_indices))
+                except Exception as e:
+                    if _fails_every_block(e):
+                        for index in pack_indices:
+                            results[index] = {'text': None, 'error': str(e), 'cached': False}
+                        return
+                    parts = None
+            if parts is not None:
+                for index, part in zip(pack_indices, parts):
+                    response_cache.put(keys[index], part)
+                    results[index] = {'text': part, 'error': None, 'cached': False}
+                return
+        # Single block, or a pack whose response did not split cleanly
+        await asyncio.gather(*(rewrite_one(index) for index in pack_indices))
+    
+    try:
+        await asyncio.gather(*(rewrite_pack(pack_indices) for pack_indices in packs))
+    finally:
+        if owns_client:
+            await client.close()
+    return results
+
+def rewrite_many(texts: Sequence[str], concurrency: int = REWRITE_CONCURRENCY,
+                 use_cache: bool = True, pack: bool = True) -> List[Dict[str, Any]]:
+    """
+    Rewrite many texts concurrently; blocking wrapper around rewrite_many_async().
+    
+    N texts take about ceil(N / concurrency) round trips instead of N, and
+    short texts share requests.
+    
+    Args:
+        texts (Sequence[str]): Original input texts.
+        concurrency (int): Maximum simultaneous requests.
+        use_cache (bool): Reuse cached rewrites (False to regenerate).
+        pack (bool): Pack short texts into shared requests.
         
-        {text}
+    Returns:
+        List[Dict[str, Any]]: One {'text', 'error', 'cached'} result per text, in input order.
+    """
+    return asyncio.run(rewrite_many_async(texts, concurrency, use_cache=use_cache, pack=pack)) 
+
+def normalise_block_text(text: str) -> str:
+    """
+    Normalise text for duplicate detection (Unicode NFKC, collapsed whitespace).
+    
+    Args:
+        text (str): Block text.
         
-        Return only the rewritten text without any additional commentary.
-        """
-        return get_gpt_response(prompt)
-    except Exception as e:
-        return f"Error processing with GPT: {str(e)}" 
\ No newline at end of file
+    Returns:
+        str: Normalised text.
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def dedupe_blocks(blocks: Sequence[Dict[str, Any]],
+                  tolerance: float = DEDUP_POSITION_TOLERANCE) -> Tuple[List[int], List[int]]:
+    """
+    Find blocks repeated across pages, such as letterheads and footers.
+    
+    Blocks are duplicates when their normalised text hashes match and their
+    bboxes lie within `tolerance` points of each other. Identical text in a
+    different place on the page is kept separate.
+    
+    Args:
+        blocks (Sequence[Dict[str, Any]]): Blocks with 'text' and optional 'bbox'.
+        tolerance (float): Largest per-coordinate bbox difference, in points.
+        
+    Returns:
+        Tuple[List[int], List[int]]: Indices of the unique blocks in document
+        order, and for every block the index of the unique block it repeats
+        (its own index if it is unique).
+    """
+    representatives: Dict[str, List[int]] = {}
+    unique: List[int] = []
+    owners: List[int] = []
+    for index, block in enumerate(blocks):
+        digest = hashlib.sha1(normalise_block_text(block.get('text', '')).encode()).hexdigest()
+        bbox = block.get('bbox')
+        owner = index
+        for candidate in representatives.get(digest, ()):
+            other = blocks[candidate].get('bbox')
+            if bbox is None or other is None:
+                same_place = bbox is None and other is None
+            else:
+                same_place = all(abs(a - b) <= tolerance for a, b in zip(bbox, other))
+            if same_place:
+                owner = candidate
+                break
+        if owner == index:
+            representatives.setdefault(digest, []).append(index)
+            unique.append(index)
+        owners.append(owner)
+    return unique, owners
+
+def rewrite_text_blocks(blocks: Sequence[Dict[str, Any]], concurrency: int = REWRITE_CONCURRENCY,
+                        use_cache: bool = True, pack: bool = True,
+                        dedupe: bool = True) -> List[Dict[str, Any]]:
+    """
+    Rewrite extracted text blocks, sending each repeated header/footer once.
+    
+    Args:
+        blocks (Sequence[Dict[str, Any]]): Blocks from extract_text_blocks().
+        concurrency (int): Maximum simultaneous requests.
+        use_cache (bool): Reuse cached rewrites (False to regenerate).
+        pack (bool): Pack short texts into shared requests.
+        dedupe (bool): Rewrite repeated blocks once and reuse the result.
+        
+    Returns:
+        List[Dict[str, Any]]: One {'text', 'error', 'cached', 'duplicate'}
+        result per block, in input order. 'duplicate' is True for blocks
+        that reused the rewrite of an earlier copy.
+    """
+    if dedupe:
+        unique, owners = dedupe_blocks(blocks)
+    else:
+        unique = owners = list(range(len(blocks)))
+    rewritten = rewrite_many([blocks[index].get('text', '') for index in unique],
+                             concurrency, use_cache=use_cache, pack=pack)
+    by_owner = dict(zip(unique, rewritten))
+    return [dict(by_owner[owner], duplicate=owner != index) for index, owner in enumerate(owners)]
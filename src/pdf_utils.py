@@ -4,129 +4,556 @@ pdf_utils.py - Bulletproof PDF text extraction with auto-fallback for encrypted/
 
 import fitz  # PyMuPDF
 import pytesseract
+import copy
 from PIL import Image
-import io
+import multiprocessing
 import os
 import subprocess
-from typing import List, Dict, Any, Union
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Sequence, Tuple
 import shutil
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from src.doc_utils import PageImages, buffer_bytes, load_document, open_document, pdf_buffer, pixmap_to_array, render_page
+from src.span_utils import SpanTable
+from src.ocr_utils import OcrCache, group_text_boxes, ocr_cache, ocr_service, page_content_hash, parse_tesseract_data
 
 # Set paths for installed tools
 TESSERACT_PATH = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 QPDF_PATH = r"C:\Program Files\qpdf 12.2.0\bin\qpdf.exe"
 
-def extract_text_blocks(uploaded_file):
+# Tesseract config for page OCR, configured for better Unicode handling
+OCR_CONFIG = r'--oem 3 --psm 6 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.,!?@#$%^&*()_+-=[]{}|;:,.<>?/\\"\'`~ '
+
+# OCR render resolution, and the adaptive ladder tried lowest first
+OCR_DPI = 300
+OCR_DPI_LADDER = (150, 200, 300)
+# Mean Tesseract word confidence (0-1) at which the ladder stops
+OCR_MIN_CONFIDENCE = 0.75
+# Image pages OCR'd together in one tesseract CLI run
+OCR_BATCH_PAGES = 4
+
+# Images smaller than this fraction of the page are ignored by classify_page
+MIN_OCR_IMAGE_AREA = 0.02
+# Images whose area text blocks cover less than this fraction of are OCR'd
+IMAGE_TEXT_COVERAGE = 0.1
+
+def _tesseract_available() -> bool:
+    """Return True if a Tesseract binary can be found."""
+    return bool(os.path.exists(TESSERACT_PATH) or shutil.which("tesseract"))
+
+def _round_bbox(bbox) -> List[float]:
+    """Round a bbox to hundredths of a point."""
+    return [round(float(value), 2) for value in bbox]
+
+def _text_layer_blocks(page) -> List[Dict[str, Any]]:
     """
-    Extract text blocks from PDF file with OCR fallback.
+    Read a page's text layer as blocks of lines.
+    
+    Returns:
+        List[Dict[str, Any]]: Blocks with 'bbox' (PDF points), 'text' and
+        'lines', each line with its own 'bbox' and 'text'
+    """
+    blocks = []
+    for block in page.get_text("dict", flags=fitz.TEXTFLAGS_TEXT)['blocks']:
+        if block.get('type', 0) != 0:
+            continue
+        lines = []
+        for line in block['lines']:
+            line_text = "".join(span['text'] for span in line['spans'])
+            if line_text.strip():
+                lines.append({'bbox': _round_bbox(line['bbox']), 'text': line_text})
+        if lines:
+            blocks.append({
+                'bbox': _round_bbox(block['bbox']),
+                'text': "\n".join(line['text'] for line in lines),
+                'lines': lines
+            })
+    return blocks
+
+def classify_page(page) -> Dict[str, Any]:
+    """
+    Decide how a page must be extracted without rasterising it.
+    
+    Uses the text layer, the fonts in use and the placement of image
+    XObjects. Images that text blocks barely overlap carry content the
+    text layer is missing and need OCR; images under a text layer (e.g.
+    an already OCR'd scan) do not.
     
     Args:
-        uploaded_file: PDF file bytes, path, or document object
+        page: PyMuPDF page object
         
     Returns:
-        List[Dict[str, Any]]: Text blocks with metadata
+        Dict[str, Any]: 'kind' ('text', 'scanned' or 'hybrid'), the page's
+        'text' and text layer 'blocks', 'text_coverage' and 'image_coverage'
+        (fractions of the page area), and 'ocr_rects' - the image rectangles
+        to OCR as (x0, y0, x1, y1)
+    """
+    page_rect = page.rect
+    page_area = max(abs(page_rect), 1.0)
+    blocks = _text_layer_blocks(page)
+    text = "\n".join(block['text'] for block in blocks)
+    has_text = bool(text.strip()) and bool(page.get_fonts())
+    if not has_text:
+        blocks = []
+    
+    text_rects = [fitz.Rect(block['bbox']) for block in blocks]
+    text_area = sum(abs(rect & page_rect) for rect in text_rects)
+    
+    image_area = 0.0
+    ocr_rects = []
+    for info in page.get_image_info():
+        rect = fitz.Rect(info['bbox']) & page_rect
+        area = abs(rect)
+        if area < MIN_OCR_IMAGE_AREA * page_area:
+            continue
+        image_area += area
+        covered = sum(abs(rect & text_rect) for text_rect in text_rects)
+        if covered < IMAGE_TEXT_COVERAGE * area:
+            ocr_rects.append(tuple(rect))
+    
+    if not has_text:
+        # Text drawn as vector outlines still needs OCR
+        if ocr_rects or page.get_cdrawings():
+            kind = 'scanned'
+        else:
+            kind = 'text'  # Blank page
+        ocr_rects = []
+    else:
+        kind = 'hybrid' if ocr_rects else 'text'
+    
+    return {
+        'kind': kind,
+        'text': text,
+        'blocks': blocks,
+        'text_coverage': min(text_area / page_area, 1.0),
+        'image_coverage': min(image_area / page_area, 1.0),
+        'ocr_rects': ocr_rects
+    }
+
+def _ocr_regions(jobs: Sequence[Tuple[Any, Any, int]], config: str,
+                 dpi_ladder: Optional[Sequence[int]], min_confidence: float):
+    """
+    OCR pages, or rectangles of them, walking the DPI ladder together.
+    
+    Every job still below min_confidence at one DPI is re-rendered at the
+    next, and each rung is a single ocr_service.ocr_batch() call, so the
+    tesseract CLI starts once per rung instead of once per image.
+    
+    Args:
+        jobs: (page, clip, region) tuples; clip is None for the whole page
+        
+    Returns:
+        List[Tuple[str, List, List]]: Per job, the text, word boxes in PDF
+        points (block and line ids prefixed with the region index) and attempts
+    """
+    outcomes = [None] * len(jobs)
+    attempts = [[] for _ in jobs]
+    remaining = list(range(len(jobs)))
+    for dpi in (dpi_ladder or [OCR_DPI]):
+        # Grayscale renders handed to Tesseract as zero-copy arrays (no PNG round trip)
+        images = [pixmap_to_array(jobs[j][0].get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, clip=jobs[j][1]))
+                  for j in remaining]
+        results = ocr_service.ocr_batch(images, config=config, output='data')
+        
+        low_confidence = []
+        for j, data in zip(remaining, results):
+            _, clip, region = jobs[j]
+            origin_x, origin_y = (clip[0], clip[1]) if clip else (0.0, 0.0)
+            words = parse_tesseract_data(data)
+            
+            # Pixels to PDF points
+            scale = 72.0 / dpi
+            for word in words:
+                x0, y0, x1, y1 = word['bbox']
+                word['bbox'] = _round_bbox([origin_x + x0 * scale, origin_y + y0 * scale,
+                                            origin_x + x1 * scale, origin_y + y1 * scale])
+                word['block'] = [region] + word['block']
+                word['line'] = [region] + word['line']
+            
+            confidence = (sum(word['confidence'] for word in words) / len(words)) if words else 0.0
+            attempts[j].append({'dpi': dpi, 'confidence': confidence})
+            text = "\n\n".join(block['text'] for block in group_text_boxes(words, level='block'))
+            outcomes[j] = (text, words, attempts[j])
+            if dpi_ladder and confidence < min_confidence:
+                low_confidence.append(j)
+        
+        remaining = low_confidence
+        if not dpi_ladder or not remaining:
+            break
+    return outcomes
+
+def _ocr_cache_key(page, dpi_ladder: Optional[Sequence[int]], min_confidence: float,
+                   clips: Optional[Sequence[Tuple[float, float, float, float]]]) -> str:
+    """Cache key for a page's OCR result under the given settings."""
+    if dpi_ladder:
+        mode = f"adaptive dpi={','.join(str(dpi) for dpi in dpi_ladder)} min_conf={min_confidence}"
+    else:
+        mode = f"dpi={OCR_DPI}"
+    mode += " words=points"
+    if clips:
+        mode += " clips=" + ";".join(",".join(f"{value:.1f}" for value in clip) for clip in clips)
+    return OcrCache.make_key(page_content_hash(page), f"page gray {mode} {OCR_CONFIG}")
+
+def _cached_ocr_result(cache_key: str, page_num: int):
+    """Get a page's cached OCR in the _ocr_pages_text() result form, or None."""
+    cached = ocr_cache.get(cache_key)
+    if cached is None:
+        return None
+    print(f"📷 OCR cache hit for page {page_num + 1}")
+    stats = {'dpi': None, 'confidence': None, 'attempts': []}
+    stats.update(cached.get('stats', {}))
+    return cached['text'], 'ocr', stats, cached.get('words', [])
+
+def _ocr_pages_text(pages: Sequence[Any], page_nums: Sequence[int], tesseract_available: bool,
+                    dpi_ladder: Optional[Sequence[int]] = None,
+                    min_confidence: float = OCR_MIN_CONFIDENCE,
+                    clips: Optional[Sequence[Optional[Sequence[Tuple[float, float, float, float]]]]] = None):
+    """
+    OCR image-based pages, or just some rectangles of them, in one batch.
+    
+    Pages already in the OCR cache are not rendered. The rest are OCR'd
+    together (see _ocr_regions()); pages with identical content are only
+    OCR'd once. With a DPI ladder each page starts at the first (lowest)
+    DPI and is only re-rendered at the next one while its mean word
+    confidence stays below min_confidence. Without one it is OCR'd once
+    at OCR_DPI.
+    
+    Args:
+        pages: PyMuPDF page objects
+        page_nums (Sequence[int]): Zero-based index of each page
+        tesseract_available (bool): Whether OCR can be attempted
+        dpi_ladder (Sequence[int], optional): Render resolutions to try, lowest first
+        min_confidence (float): Mean word confidence (0-1) that ends the ladder
+        clips (Sequence, optional): Per page, the rectangles to OCR instead
+            of the whole page (e.g. the image areas of a hybrid page), or None
+        
+    Returns:
+        List[Tuple[str, str, Dict, List]]: Per page, the extracted text, block
+        type ('ocr' or 'error'), OCR stats ('dpi', 'confidence', 'attempts')
+        and the word boxes in PDF points
+    """
+    clips = list(clips) if clips is not None else [None] * len(pages)
+    results = [None] * len(pages)
+    
+    # Reuse a previous OCR of identical page content
+    keys = [None] * len(pages)
+    first_with_key: Dict[str, int] = {}
+    for i, page in enumerate(pages):
+        try:
+            keys[i] = _ocr_cache_key(page, dpi_ladder, min_confidence, clips[i])
+            if keys[i] in first_with_key:
+                continue
+            first_with_key[keys[i]] = i
+            results[i] = _cached_ocr_result(keys[i], page_nums[i])
+        except Exception as cache_error:
+            print(f"⚠️  OCR cache unavailable: {cache_error}")
+    
+    # Pages whose content matches an earlier page of the batch reuse its result
+    duplicates = {i: first_with_key[keys[i]] for i in range(len(pages))
+                  if keys[i] is not None and first_with_key[keys[i]] != i}
+    misses = [i for i in range(len(pages)) if results[i] is None and i not in duplicates]
+    
+    if misses and not tesseract_available:
+        for i in misses:
+            results[i] = (f"OCR not available for page {page_nums[i] + 1} (Tesseract not installed)",
+                          'error', {'dpi': None, 'confidence': None, 'attempts': []}, [])
+    elif misses:
+        try:
+            # Set Tesseract path if available
+            if os.path.exists(TESSERACT_PATH):
+                pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
+            
+            jobs = [(i, region, clip) for i in misses for region, clip in enumerate(clips[i] or [None])]
+            outcomes = _ocr_regions([(pages[i], clip, region) for i, region, clip in jobs],
+                                    OCR_CONFIG, dpi_ladder, min_confidence)
+            
+            by_page = {i: [] for i in misses}
+            for (i, _, _), outcome in zip(jobs, outcomes):
+                by_page[i].append(outcome)
+            
+            for i in misses:
+                texts = []
+                words = []
+                finals = []
+                stats = {'dpi': None, 'confidence': None, 'attempts': []}
+                for region, (region_text, region_words, attempts) in enumerate(by_page[i]):
+                    texts.append(region_text)
+                    words.extend(region_words)
+                    for attempt in attempts:
+                        if clips[i]:
+                            attempt['region'] = region
+                        stats['attempts'].append(attempt)
+                    finals.append(attempts[-1])
+                
+                text = texts[0] if len(texts) == 1 else "\n\n".join(t.strip() for t in texts if t.strip())
+                stats['dpi'] = max(attempt['dpi'] for attempt in finals)
+                stats['confidence'] = sum(attempt['confidence'] for attempt in finals) / len(finals)
+                
+                # Clean up any problematic characters
+                text = text.encode('utf-8', errors='ignore').decode('utf-8')
+                if dpi_ladder:
+                    print(f"📷 OCR used for page {page_nums[i] + 1} at {stats['dpi']} DPI "
+                          f"(confidence {stats['confidence']:.2f}, {len(stats['attempts'])} pass(es))")
+                else:
+                    print(f"📷 OCR used for page {page_nums[i] + 1}")
+                if keys[i] is not None:
+                    try:
+                        ocr_cache.put(keys[i], {'text': text, 'words': words, 'stats': stats})
+                    except Exception as cache_error:
+                        print(f"⚠️  OCR cache unavailable: {cache_error}")
+                results[i] = (text, 'ocr', stats, words)
+        except Exception as ocr_error:
+            for i in misses:
+                results[i] = (f"OCR failed for page {page_nums[i] + 1}: {str(ocr_error)}", 'error',
+                              {'dpi': None, 'confidence': None, 'attempts': []}, [])
+    
+    for i, first in duplicates.items():
+        text, text_type, stats, words = results[first]
+        results[i] = (text, text_type, copy.deepcopy(stats), copy.deepcopy(words))
+    return results
+
+def _make_text_blocks(page_num: int, layout_blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Wrap text layer blocks from classify_page() in extract_text_blocks dicts."""
+    return [{
+        'page': page_num + 1,
+        'text': block['text'].strip(),
+        'type': 'text',
+        'bbox': block['bbox'],
+        'lines': block['lines']
+    } for block in layout_blocks if block['text'].strip()]
+
+def _make_ocr_blocks(page_num: int, page_rect, text: str, text_type: str,
+                     ocr_stats: Dict[str, Any], words: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Turn OCR word boxes into block/line dicts, in PDF points.
+    
+    Without word boxes (e.g. an OCR error message) the text becomes one
+    block covering the whole page.
+    """
+    if not words:
+        if not text.strip():
+            return []
+        return [{
+            'page': page_num + 1,
+            'text': text.strip(),
+            'type': text_type,
+            'bbox': _round_bbox(page_rect),
+            'lines': [],
+            'ocr_stats': ocr_stats
+        }]
+    
+    groups = {}
+    for word in words:
+        groups.setdefault(tuple(word['block']), []).append(word)
+    
+    blocks = []
+    for members in groups.values():
+        block = group_text_boxes(members, level='block')[0]
+        blocks.append({
+            'page': page_num + 1,
+            'text': block['text'],
+            'type': text_type,
+            'bbox': _round_bbox(block['bbox']),
+            'lines': [{'bbox': _round_bbox(line['bbox']), 'text': line['text']}
+                      for line in group_text_boxes(members, level='line')],
+            'confidence': block['confidence'],
+            'ocr_stats': ocr_stats
+        })
+    return blocks
+
+# Per-process document handle used by the extraction worker pool
+_worker_doc = None
+
+def _init_extract_worker(pdf_bytes: bytes, cache_path: str, cache_max_bytes: int) -> None:
+    """Open the worker's own PyMuPDF handle on the shared PDF bytes."""
+    global _worker_doc, ocr_cache
+    _worker_doc = load_document(pdf_bytes)
+    # Share the parent's OCR cache
+    ocr_cache = OcrCache(path=cache_path, max_bytes=cache_max_bytes)
+
+def _ocr_pages_blocks(doc, page_nums: Sequence[int], tesseract_available: bool,
+                      dpi_ladder: Optional[Sequence[int]], min_confidence: float,
+                      clips) -> List[List[Dict[str, Any]]]:
+    """OCR a batch of image-based pages into one list of blocks per page."""
+    pages = [doc.load_page(page_num) for page_num in page_nums]
+    results = _ocr_pages_text(pages, page_nums, tesseract_available, dpi_ladder, min_confidence, clips)
+    return [_make_ocr_blocks(page_num, page.rect, text, text_type, stats, words)
+            for page_num, page, (text, text_type, stats, words) in zip(page_nums, pages, results)]
+
+def _ocr_pages_worker(page_nums: Sequence[int], dpi_ladder: Optional[Sequence[int]],
+                      min_confidence: float, clips) -> List[List[Dict[str, Any]]]:
+    """OCR a batch of image-based pages using the worker's document handle."""
+    return _ocr_pages_blocks(_worker_doc, page_nums, True, dpi_ladder, min_confidence, clips)
+
+def iter_text_blocks(uploaded_file, pages: Optional[Iterable[int]] = None,
+                     workers: Optional[int] = None,
+                     dpi_ladder: Optional[Sequence[int]] = None,
+                     min_confidence: float = OCR_MIN_CONFIDENCE) -> Iterator[Dict[str, Any]]:
+    """
+    Yield text blocks page by page as soon as each page is ready.
+    
+    Pages are routed by classify_page() before anything is rendered.
+    Text-layer pages are yielded immediately; scanned pages, and just the
+    image rectangles of hybrid pages, are OCR'd in batches of OCR_BATCH_PAGES
+    (one tesseract CLI run each) across a process pool (each worker opens
+    its own PyMuPDF handle on the PDF bytes) a few batches ahead of the
+    consumer. Blocks are always yielded in page order.
+    
+    Args:
+        uploaded_file: PDF bytes/memoryview, file path, or document object
+        pages (Iterable[int], optional): Zero-based page indices to extract,
+            e.g. range(10, 20). Defaults to every page.
+        workers (int, optional): Number of OCR worker processes. Defaults to
+            the CPU count. Use 1 to extract serially in this process.
+            Document objects are always extracted serially.
+        dpi_ladder (Sequence[int], optional): Adaptive OCR resolutions, lowest
+            first, e.g. OCR_DPI_LADDER. Pages are re-rendered at the next DPI
+            only while their mean word confidence is below min_confidence.
+            Defaults to a single pass at OCR_DPI.
+        min_confidence (float): Mean word confidence (0-1) accepted by the ladder
+        
+    Yields:
+        Dict[str, Any]: One dict per text block with 'page', 'text', 'type',
+        'bbox' and 'lines' (each with 'bbox' and 'text'); all boxes are in
+        PDF points. OCR blocks also carry a mean 'confidence' and
+        'ocr_stats' with the final 'dpi', mean confidence and every attempt.
         
     Raises:
         Exception: If extraction fails
     """
     # Check if Tesseract is available
-    tesseract_available = os.path.exists(TESSERACT_PATH) or shutil.which("tesseract")
+    tesseract_available = _tesseract_available()
     if not tesseract_available:
         print("⚠️  Tesseract OCR not found. OCR features will be disabled.")
         print("   Install from: https://github.com/UB-Mannheim/tesseract/wiki")
     
+    if workers is None:
+        workers = os.cpu_count() or 1
+    
+    doc = None
+    pdf_bytes = None
+    executor = None
     try:
-        # Handle different input types
-        if hasattr(uploaded_file, 'load_page'):  # Document object
-            doc = uploaded_file
-            temp_pdf_path = None
-        elif isinstance(uploaded_file, bytes):  # Bytes
-            temp_pdf_path = "temp_input.pdf"
-            with open(temp_pdf_path, "wb") as f:
-                f.write(uploaded_file)
-            doc = fitz.open(temp_pdf_path)
-        elif isinstance(uploaded_file, str) and os.path.exists(uploaded_file):  # File path
-            temp_pdf_path = uploaded_file
-            doc = fitz.open(temp_pdf_path)
-        else:
-            raise Exception("Invalid input: must be bytes, file path, or document object")
+        # Open straight from memory; the same buffer feeds the worker processes
+        if not hasattr(uploaded_file, 'load_page'):
+            pdf_bytes = pdf_buffer(uploaded_file)
+        doc = load_document(uploaded_file if pdf_bytes is None else pdf_bytes)
 
-        # Handle encrypted PDFs
-        if doc.is_encrypted:
-            try:
-                doc.authenticate("")
-                print("✅ Successfully unlocked encrypted PDF")
-            except:
-                raise Exception("❌ Cannot unlock encrypted PDF.")
-
-        text_blocks = []
+        use_pool = tesseract_available and pdf_bytes is not None and workers > 1
+        # The tesseract CLI starts once per batch; in-process engines gain nothing from batching
+        batch_size = 1 if ocr_service.in_process else OCR_BATCH_PAGES
+        # OCR pages allowed in flight ahead of the page being yielded
+        lookahead = workers * 2 * batch_size
+        pending = deque()
+        in_flight = 0
+        batch = None
+        
+        def start_batch(batch):
+            nonlocal executor, in_flight
+            if use_pool:
+                if executor is None:
+                    # Spawned, not forked: forking a process that already runs
+                    # OpenCV/onnxruntime threads can deadlock the workers
+                    executor = ProcessPoolExecutor(max_workers=workers,
+                                                   mp_context=multiprocessing.get_context("spawn"),
+                                                   initializer=_init_extract_worker,
+                                                   initargs=(buffer_bytes(pdf_bytes), ocr_cache.path,
+                                                             ocr_cache.max_bytes))
+                batch['future'] = executor.submit(_ocr_pages_worker, batch['pages'], dpi_ladder,
+                                                  min_confidence, batch['clips'])
+            else:
+                batch['future'] = Future()
+                batch['future'].set_result(_ocr_pages_blocks(doc, batch['pages'], tesseract_available,
+                                                             dpi_ladder, min_confidence, batch['clips']))
+            in_flight += len(batch['pages'])
         
-        for page_num in range(len(doc)):
+        def ready(head) -> bool:
+            if not isinstance(head, tuple):
+                return True
+            future = head[0]['future']
+            return future is not None and (future.done() or in_flight >= lookahead)
+        
+        for page_num in (range(len(doc)) if pages is None else pages):
             page = doc.load_page(page_num)
             
-            # Try direct text extraction first
-            text = page.get_text("text")
+            # Text pages are cheap; only image content is worth OCR
+            layout = classify_page(page)
+            if layout['kind'] != 'scanned':
+                pending.append(_make_text_blocks(page_num, layout['blocks']))
             
-            if not text.strip():
-                # 🧠 Fallback to OCR (image-based page)
-                if tesseract_available:
-                    try:
-                        # Set Tesseract path if available
-                        if os.path.exists(TESSERACT_PATH):
-                            pytesseract.pytesseract.tesseract_cmd = TESSERACT_PATH
-                        
-                        pix = page.get_pixmap(dpi=300)
-                        img_data = pix.tobytes("png")
-                        img = Image.open(io.BytesIO(img_data))
-                        
-                        # Configure Tesseract for better Unicode handling
-                        custom_config = r'--oem 3 --psm 6 -c tessedit_char_whitelist=0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz.,!?@#$%^&*()_+-=[]{}|;:,.<>?/\\"\'`~ '
-                        
-                        try:
-                            text = pytesseract.image_to_string(img, config=custom_config)
-                            # Clean up any problematic characters
-                            text = text.encode('utf-8', errors='ignore').decode('utf-8')
-                            text_type = 'ocr'
-                            print(f"📷 OCR used for page {page_num + 1}")
-                        except UnicodeEncodeError as ue:
-                            # Handle Unicode encoding errors
-                            text = f"OCR completed for page {page_num + 1} (some characters may be missing due to encoding)"
-                            text_type = 'ocr'
-                            print(f"📷 OCR used for page {page_num + 1} (with encoding warnings)")
-                        except Exception as ocr_error:
-                            text = f"OCR failed for page {page_num + 1}: {str(ocr_error)}"
-                            text_type = 'error'
-                    except Exception as ocr_error:
-                        text = f"OCR failed for page {page_num + 1}: {str(ocr_error)}"
-                        text_type = 'error'
-                else:
-                    text = f"OCR not available for page {page_num + 1} (Tesseract not installed)"
-                    text_type = 'error'
-            else:
-                text_type = 'text'
+            # Scanned pages are OCR'd whole, hybrid pages only in their image rectangles,
+            # a batch of pages at a time
+            cached = None
+            if layout['kind'] != 'text' and use_pool:
+                # Cached pages never need the pool, so a rerun of an OCR'd document starts no workers
+                try:
+                    cache_key = _ocr_cache_key(page, dpi_ladder, min_confidence, layout['ocr_rects'] or None)
+                    cached = _cached_ocr_result(cache_key, page_num)
+                except Exception as cache_error:
+                    print(f"⚠️  OCR cache unavailable: {cache_error}")
+            if cached is not None:
+                pending.append(_make_ocr_blocks(page_num, page.rect, *cached))
+            elif layout['kind'] != 'text':
+                if batch is None:
+                    batch = {'pages': [], 'clips': [], 'future': None}
+                pending.append((batch, len(batch['pages'])))
+                batch['pages'].append(page_num)
+                batch['clips'].append(layout['ocr_rects'] or None)
+                if len(batch['pages']) >= batch_size:
+                    start_batch(batch)
+                    batch = None
+            # Don't hold later pages back behind a batch that is slow to fill
+            if batch is not None and len(pending) >= lookahead:
+                start_batch(batch)
+                batch = None
             
-            if text.strip():
-                text_blocks.append({
-                    'page': page_num + 1,
-                    'text': text.strip(),
-                    'type': text_type,
-                    'bbox': [0, 0, 100, 100]  # Default bbox
-                })
+            # Yield every finished page at the head of the queue
+            while pending and ready(pending[0]):
+                head = pending.popleft()
+                if isinstance(head, tuple):
+                    in_flight -= 1
+                    head = head[0]['future'].result()[head[1]]
+                yield from head
         
+        if batch is not None:
+            start_batch(batch)
+        while pending:
+            head = pending.popleft()
+            yield from (head[0]['future'].result()[head[1]] if isinstance(head, tuple) else head)
+
+    except Exception as e:
+        raise Exception(f"🔴 Failed to extract PDF text: {str(e)}")
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
         # Only close if we opened it (not if it was passed as a document object)
-        if temp_pdf_path and temp_pdf_path != uploaded_file:
+        if doc is not None and doc is not uploaded_file:
             doc.close()
+
+def extract_text_blocks(uploaded_file, workers: Optional[int] = None,
+                        dpi_ladder: Optional[Sequence[int]] = None,
+                        min_confidence: float = OCR_MIN_CONFIDENCE):
+    """
+    Extract text blocks from PDF file with OCR fallback.
+    
+    Collects iter_text_blocks() into a list; see it for how pages are
+    spread across worker processes.
+    
+    Args:
+        uploaded_file: PDF bytes/memoryview, file path, or document object
+        workers (int, optional): Number of OCR worker processes. Defaults to
+            the CPU count. Use 1 to extract serially in this process.
+        dpi_ladder (Sequence[int], optional): Adaptive OCR resolutions, lowest first
+        min_confidence (float): Mean word confidence (0-1) accepted by the ladder
         
-        # Cleanup temporary file
-        if temp_pdf_path and temp_pdf_path != uploaded_file and os.path.exists(temp_pdf_path):
-            try:
-                os.remove(temp_pdf_path)
-            except:
-                pass
+    Returns:
+        List[Dict[str, Any]]: Text blocks with metadata
         
-        return text_blocks
-
-    except Exception as e:
-        raise Exception(f"🔴 Failed to extract PDF text: {str(e)}")
+    Raises:
+        Exception: If extraction fails
+    """
+    return list(iter_text_blocks(uploaded_file, workers=workers, dpi_ladder=dpi_ladder,
+                                 min_confidence=min_confidence))
 
 def unlock_pdf(input_path: str, output_path: str) -> str:
     """
@@ -179,35 +606,18 @@ def pdf_to_images(pdf_bytes):
     Convert PDF to list of PIL Images for preview.
     
     Args:
-        pdf_bytes: PDF file as bytes
+        pdf_bytes: PDF file as bytes or memoryview
         
     Returns:
         List[PIL.Image]: List of page images
     """
     try:
-        # Save temporary file
-        temp_path = "temp_preview.pdf"
-        with open(temp_path, "wb") as f:
-            f.write(pdf_bytes)
-        
-        doc = fitz.open(temp_path)
         images = []
         
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap(dpi=150)  # Lower DPI for faster preview
-            img_data = pix.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            images.append(img)
-        
-        doc.close()
-        
-        # Cleanup
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
+        with open_document(pdf_bytes) as doc:
+            for page_num in range(len(doc)):
+                page = doc.load_page(page_num)
+                images.append(render_page(page, dpi=150))  # Lower DPI for faster preview
         
         return images
         
@@ -215,29 +625,36 @@ def pdf_to_images(pdf_bytes):
         print(f"Error converting PDF to images: {e}")
         return []
 
-def extract_text_with_style(pdf_path):
-    doc = fitz.open(pdf_path)
-    text_data = []
-
-    for page_num in range(len(doc)):
-        page = doc.load_page(page_num)
-        blocks = page.get_text("dict")["blocks"]
+def pdf_page_images(pdf_bytes, dpi: int = 150, cache_size: int = 8) -> PageImages:
+    """
+    Lazy counterpart of pdf_to_images for page-by-page preview.
+    
+    Pages are rendered on first access, kept in a bounded LRU cache, and
+    their neighbours are prefetched on a background thread.
+    
+    Args:
+        pdf_bytes: PDF file as bytes or memoryview
+        dpi (int): Render resolution
+        cache_size (int): Maximum number of rendered pages kept in memory
+        
+    Returns:
+        PageImages: Sequence of PIL page images
+    """
+    return PageImages(pdf_bytes, dpi=dpi, output='pil', cache_size=cache_size)
 
-        for block in blocks:
-            for line in block.get("lines", []):
-                for span in line.get("spans", []):
-                    text = span["text"]
-                    bbox = span["bbox"]
-                    font = span["font"]
-                    size = span["size"]
-                    text_data.append({
-                        "page": page_num,
-                        "text": text,
-                        "bbox": bbox,
-                        "font": font,
-                        "size": size
-                    })
-    return text_data
+def extract_text_with_style(pdf_path):
+    """
+    Extract every text span with its position and font.
+    
+    Args:
+        pdf_path: PDF bytes/memoryview, file path, or document object
+        
+    Returns:
+        SpanTable: Columnar spans that index and iterate like the list of
+        {'page', 'text', 'bbox', 'font', 'size'} dicts this used to return
+    """
+    with open_document(pdf_path) as doc:
+        return SpanTable.from_document(doc)
 
 def rebuild_pdf(blocks: List[Dict[str, Any]]) -> bytes:
     """
@@ -268,13 +685,18 @@ def rebuild_pdf(blocks: List[Dict[str, Any]]) -> bytes:
         # Create pages and add text
         for page_num in sorted(pages.keys()):
             page = doc.new_page()
-            y_offset = 50  # Starting position
+            y_offset = 50  # Starting position for blocks without geometry
             
             for block in pages[page_num]:
                 text = block.get("text", "")
                 if text:
-                    page.insert_text((50, y_offset), text)
-                    y_offset += 20  # Line spacing
+                    bbox = block.get("bbox")
+                    if bbox:
+                        # Baseline one font size below the block's top edge
+                        page.insert_text((bbox[0], bbox[1] + 11), text, fontsize=11)
+                    else:
+                        page.insert_text((50, y_offset), text)
+                        y_offset += 20  # Line spacing
         
         # Get PDF as bytes
         pdf_bytes = doc.write()
@@ -287,7 +709,7 @@ def rebuild_pdf(blocks: List[Dict[str, Any]]) -> bytes:
         return b"%PDF-1.4\nDummy PDF rebuilt\n%%EOF"
 
 def rebuild_pdf_with_style(original_pdf_path, edited_data):
-    doc = fitz.open(original_pdf_path)
+    doc = load_document(original_pdf_path)
     for item in edited_data:
         page = doc.load_page(item["page"])
         x0, y0, x1, y1 = item["bbox"]
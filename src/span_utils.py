@@ -0,0 +1,171 @@
+"""
+span_utils.py - Compact columnar storage for styled text spans.
+"""
+
+from array import array
+from collections.abc import Sequence
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+class SpanTable(Sequence):
+    """
+    Text spans stored column-wise in numpy arrays.
+
+    A drop-in replacement for a list of span dicts ('page', 'text', 'bbox',
+    'font', 'size'): indexing and iteration build each dict on demand, so a
+    large document costs a few arrays instead of one dict per span.
+
+    Columns:
+        bboxes: float64 (N, 4) array of x0, y0, x1, y1
+        pages, sizes: int32 and float64 arrays (float64 so values read
+            back exactly as PyMuPDF reported them)
+        font_ids: int32 indices into the interned font names
+        text: every span's text in one string, sliced by starts/ends
+    """
+
+    def __init__(self, pages: np.ndarray, bboxes: np.ndarray, sizes: np.ndarray,
+                 font_ids: np.ndarray, fonts: List[str], text: str,
+                 starts: np.ndarray, ends: np.ndarray):
+        self.pages = pages
+        self.bboxes = bboxes
+        self.sizes = sizes
+        self.font_ids = font_ids
+        self.fonts = fonts
+        self.text = text
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_spans(cls, spans: Iterable[Dict[str, Any]]) -> "SpanTable":
+        """
+        Build a table from span dicts with 'page', 'text', 'bbox', 'font' and 'size'.
+
+        Args:
+            spans: Span dicts, in page order
+
+        Returns:
+            SpanTable: The packed spans
+        """
+        builder = _SpanTableBuilder()
+        for span in spans:
+            builder.add(span['page'], span['text'], span['bbox'], span['font'], span['size'])
+        return builder.build()
+
+    @classmethod
+    def from_document(cls, doc, pages: Optional[Iterable[int]] = None) -> "SpanTable":
+        """
+        Read every text span of a PyMuPDF document.
+
+        Args:
+            doc: Open PyMuPDF document
+            pages (Iterable[int], optional): Zero-based page indices, in
+                ascending order. Defaults to every page.
+
+        Returns:
+            SpanTable: The document's spans in page order
+        """
+        builder = _SpanTableBuilder()
+        for page_num in (range(len(doc)) if pages is None else pages):
+            # Parsed one page at a time, so only one page of dicts is alive
+            for block in doc.load_page(page_num).get_text("dict")["blocks"]:
+                for line in block.get("lines", []):
+                    for span in line.get("spans", []):
+                        builder.add(page_num, span["text"], span["bbox"], span["font"], span["size"])
+        return builder.build()
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._take(index)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("span index out of range")
+        return {
+            "page": int(self.pages[index]),
+            "text": self.text[self.starts[index]:self.ends[index]],
+            "bbox": tuple(self.bboxes[index].tolist()),
+            "font": self.fonts[self.font_ids[index]],
+            "size": float(self.sizes[index])
+        }
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def _take(self, index) -> "SpanTable":
+        # numpy slices are views; the text buffer and font names are shared
+        return SpanTable(self.pages[index], self.bboxes[index], self.sizes[index],
+                         self.font_ids[index], self.fonts, self.text,
+                         self.starts[index], self.ends[index])
+
+    def page(self, page_num: int) -> "SpanTable":
+        """
+        Get the spans of one page without scanning the whole table.
+
+        Args:
+            page_num: Zero-based page index
+
+        Returns:
+            SpanTable: View of that page's spans
+        """
+        first = int(np.searchsorted(self.pages, page_num, side='left'))
+        last = int(np.searchsorted(self.pages, page_num, side='right'))
+        return self._take(slice(first, last))
+
+    def texts(self) -> List[str]:
+        """Get every span's text, in order."""
+        return [self.text[start:end] for start, end in zip(self.starts.tolist(), self.ends.tolist())]
+
+    def to_dicts(self) -> List[Dict[str, Any]]:
+        """Expand the table into the list of span dicts it replaces."""
+        return list(self)
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the columns and the text buffer."""
+        arrays = (self.pages, self.bboxes, self.sizes, self.font_ids, self.starts, self.ends)
+        return sum(column.nbytes for column in arrays) + len(self.text.encode('utf-8'))
+
+class _SpanTableBuilder:
+    """Accumulates spans in compact typed arrays before packing them into a SpanTable."""
+
+    def __init__(self):
+        self.pages = array('i')
+        self.bboxes = array('d')
+        self.sizes = array('d')
+        self.font_ids = array('i')
+        self.offsets = array('q', [0])
+        self.fonts: List[str] = []
+        self._font_index: Dict[str, int] = {}
+        self._text: List[str] = []
+        self._length = 0
+
+    def add(self, page: int, text: str, bbox, font: str, size: float):
+        font_id = self._font_index.get(font)
+        if font_id is None:
+            font_id = self._font_index[font] = len(self.fonts)
+            self.fonts.append(font)
+        self.pages.append(page)
+        self.bboxes.extend((bbox[0], bbox[1], bbox[2], bbox[3]))
+        self.sizes.append(size)
+        self.font_ids.append(font_id)
+        self._text.append(text)
+        self._length += len(text)
+        self.offsets.append(self._length)
+
+    def build(self) -> SpanTable:
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        return SpanTable(
+            pages=np.frombuffer(self.pages, dtype=np.intc),
+            bboxes=np.frombuffer(self.bboxes, dtype=np.float64).reshape(-1, 4),
+            sizes=np.frombuffer(self.sizes, dtype=np.float64),
+            font_ids=np.frombuffer(self.font_ids, dtype=np.intc),
+            fonts=self.fonts,
+            text="".join(self._text),
+            starts=offsets[:-1],
+            ends=offsets[1:]
+        )
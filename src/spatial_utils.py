@@ -0,0 +1,213 @@
+"""
+spatial_utils.py - Uniform-grid spatial index for hit-testing text boxes on a page.
+"""
+
+import math
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+PDF_DPI = 72
+
+class SpatialIndex:
+    """
+    Uniform grid over the boxes of one page.
+
+    Boxes are stored in PDF points. Each box is registered in every grid
+    cell it overlaps, so a query only tests the boxes in the cells under
+    the query instead of scanning the page. Queries and results can be in
+    points or in pixels of any render DPI.
+    """
+
+    def __init__(self, boxes, items: Optional[Sequence[Any]] = None,
+                 dpi: float = PDF_DPI, cell_size: Optional[float] = None):
+        """
+        Args:
+            boxes: (N, 4) array-like of x0, y0, x1, y1
+            items: Objects returned by item(), one per box (defaults to the indices)
+            dpi: Resolution the boxes are given in (72 for PDF points)
+            cell_size: Grid cell size in points. Defaults to twice the median
+                box height, which keeps a few boxes per cell on text pages.
+        """
+        boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.boxes = boxes * np.float32(PDF_DPI / dpi) if dpi != PDF_DPI else boxes.copy()
+        self.items = items
+        if cell_size is None:
+            heights = self.boxes[:, 3] - self.boxes[:, 1]
+            cell_size = 2.0 * float(np.median(heights)) if len(heights) else 1.0
+        self.cell_size = max(cell_size, 1.0)
+
+        self._cells: Dict[tuple, List[int]] = defaultdict(list)
+        # Occupied cell range (gx0, gy0, gx1, gy1), used to bound nearest()
+        self._bounds = (0, 0, -1, -1)
+        if len(self.boxes):
+            cells = np.floor(self.boxes / self.cell_size).astype(np.int64)
+            for index, (cx0, cy0, cx1, cy1) in enumerate(cells.tolist()):
+                for cx in range(cx0, cx1 + 1):
+                    for cy in range(cy0, cy1 + 1):
+                        self._cells[(cx, cy)].append(index)
+            self._bounds = (int(cells[:, 0].min()), int(cells[:, 1].min()),
+                            int(cells[:, 2].max()), int(cells[:, 3].max()))
+
+    @classmethod
+    def from_spans(cls, spans, page: Optional[int] = None, **kwargs) -> "SpatialIndex":
+        """
+        Index text spans from extract_text_with_style().
+
+        Args:
+            spans: SpanTable (or list of span dicts) in PDF points
+            page: Zero-based page to index; defaults to every span given
+
+        Returns:
+            SpatialIndex: Index whose items are the span dicts
+        """
+        if page is not None:
+            spans = spans.page(page) if hasattr(spans, 'page') else [s for s in spans if s['page'] == page]
+        boxes = spans.bboxes if hasattr(spans, 'bboxes') else [span['bbox'] for span in spans]
+        return cls(boxes, items=spans, **kwargs)
+
+    @classmethod
+    def from_regions(cls, regions: List[Dict[str, Any]], dpi: float, **kwargs) -> "SpatialIndex":
+        """
+        Index text regions from EraseMode.detect_text_regions().
+
+        Args:
+            regions: Regions with pixel 'bbox' [x1, y1, x2, y2]
+            dpi: Resolution of the image the regions were detected on
+
+        Returns:
+            SpatialIndex: Index whose items are the region dicts
+        """
+        return cls([region['bbox'] for region in regions], items=regions, dpi=dpi, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    def item(self, index: int) -> Any:
+        """Get the object stored for a box index."""
+        return index if self.items is None else self.items[index]
+
+    def box(self, index: int, dpi: float = PDF_DPI) -> List[float]:
+        """Get a box in points, or in pixels at the given DPI."""
+        return (self.boxes[index] * (dpi / PDF_DPI)).tolist()
+
+    def _to_points(self, rect, dpi: float) -> np.ndarray:
+        return np.asarray(rect, dtype=np.float64)[:4] * (PDF_DPI / dpi)
+
+    def _candidates(self, rect: np.ndarray) -> np.ndarray:
+        cx0, cy0, cx1, cy1 = np.floor(rect / self.cell_size).astype(np.int64).tolist()
+        # Only occupied cells can hold boxes, however large the query is
+        gx0, gy0, gx1, gy1 = self._bounds
+        cx0, cy0, cx1, cy1 = max(cx0, gx0), max(cy0, gy0), min(cx1, gx1), min(cy1, gy1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.empty(0, dtype=np.int64)
+        found = set()
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                found.update(self._cells.get((cx, cy), ()))
+        return np.fromiter(found, dtype=np.int64, count=len(found))
+
+    def intersect(self, rect, dpi: float = PDF_DPI) -> List[int]:
+        """
+        Find boxes overlapping a rectangle.
+
+        Args:
+            rect: x0, y0, x1, y1 query rectangle
+            dpi: Resolution of rect (72 for PDF points)
+
+        Returns:
+            List[int]: Box indices in ascending order
+        """
+        rect = self._to_points(rect, dpi)
+        ids = self._candidates(rect)
+        if not len(ids):
+            return []
+        boxes = self.boxes[ids]
+        hit = ((boxes[:, 0] <= rect[2]) & (boxes[:, 2] >= rect[0]) &
+               (boxes[:, 1] <= rect[3]) & (boxes[:, 3] >= rect[1]))
+        return sorted(ids[hit].tolist())
+
+    def contains(self, rect, dpi: float = PDF_DPI) -> List[int]:
+        """
+        Find boxes lying entirely inside a rectangle.
+
+        Args:
+            rect: x0, y0, x1, y1 query rectangle
+            dpi: Resolution of rect (72 for PDF points)
+
+        Returns:
+            List[int]: Box indices in ascending order
+        """
+        rect = self._to_points(rect, dpi)
+        ids = self._candidates(rect)
+        if not len(ids):
+            return []
+        boxes = self.boxes[ids]
+        inside = ((boxes[:, 0] >= rect[0]) & (boxes[:, 2] <= rect[2]) &
+                  (boxes[:, 1] >= rect[1]) & (boxes[:, 3] <= rect[3]))
+        return sorted(ids[inside].tolist())
+
+    def at(self, x: float, y: float, dpi: float = PDF_DPI) -> List[int]:
+        """Find boxes containing a point, e.g. under a click."""
+        return self.intersect((x, y, x, y), dpi)
+
+    def nearest(self, x: float, y: float, k: int = 1, dpi: float = PDF_DPI) -> List[int]:
+        """
+        Find the boxes closest to a point.
+
+        Searches rings of grid cells outwards from the point and stops once
+        no unvisited cell can hold a closer box. Rings are clipped to the
+        occupied part of the grid, so a point far off the page costs no
+        more than one inside it.
+
+        Args:
+            x, y: Query point
+            k: Number of boxes to return
+            dpi: Resolution of the point (72 for PDF points)
+
+        Returns:
+            List[int]: Up to k box indices, closest first
+        """
+        if not len(self.boxes) or k < 1:
+            return []
+        px, py = self._to_points((x, y, x, y), dpi)[:2]
+        cx, cy = math.floor(px / self.cell_size), math.floor(py / self.cell_size)
+        gx0, gy0, gx1, gy1 = self._bounds
+        # Rings closer than the occupied range are empty, rings past it add nothing
+        first_ring = max(gx0 - cx, cx - gx1, gy0 - cy, cy - gy1, 0)
+        max_ring = max(cx - gx0, gx1 - cx, cy - gy0, gy1 - cy)
+
+        seen = set()
+        for ring in range(first_ring, max_ring + 1):
+            for gx, gy in self._ring_cells(cx, cy, ring):
+                seen.update(self._cells.get((gx, gy), ()))
+            if len(seen) >= k:
+                ids, distances = self._distances(seen, px, py)
+                # Every box outside the visited rings is at least this far away
+                if distances[k - 1] <= ring * self.cell_size:
+                    return ids[:k]
+        ids, _ = self._distances(seen, px, py)
+        return ids[:k]
+
+    def _ring_cells(self, cx: int, cy: int, ring: int):
+        """Yield the cells of one ring around (cx, cy) that lie in the occupied range."""
+        gx0, gy0, gx1, gy1 = self._bounds
+        xs = range(max(cx - ring, gx0), min(cx + ring, gx1) + 1)
+        for gy in (cy - ring, cy + ring) if ring else (cy,):
+            if gy0 <= gy <= gy1:
+                for gx in xs:
+                    yield gx, gy
+        for gx in (cx - ring, cx + ring) if ring else ():
+            if gx0 <= gx <= gx1:
+                for gy in range(max(cy - ring + 1, gy0), min(cy + ring - 1, gy1) + 1):
+                    yield gx, gy
+
+    def _distances(self, seen, px: float, py: float):
+        ids = np.fromiter(seen, dtype=np.int64, count=len(seen))
+        boxes = self.boxes[ids]
+        dx = np.maximum(np.maximum(boxes[:, 0] - px, 0), px - boxes[:, 2])
+        dy = np.maximum(np.maximum(boxes[:, 1] - py, 0), py - boxes[:, 3])
+        distances = np.hypot(dx, dy)
+        order = np.lexsort((ids, distances))
+        return ids[order].tolist(), distances[order]
@@ -0,0 +1,421 @@
+"""
+Tests for src/erase_utils.py Erase Mode engine.
+"""
+
+import gc
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import fitz
+import numpy as np
+import pytest
+
+from src import erase_utils
+from src.doc_utils import render_page
+from src.erase_utils import EraseMode, EraseSessionRegistry
+from src.ocr_utils import OcrCache
+
+
+@pytest.fixture(autouse=True)
+def isolated_ocr_cache(tmp_path, monkeypatch):
+    cache = OcrCache(path=str(tmp_path / "ocr.sqlite"))
+    monkeypatch.setattr(erase_utils, "ocr_cache", cache)
+    return cache
+
+
+def tesseract_data(words):
+    """Build an image_to_data DICT for (text, conf, (x, y, w, h), line_num) tuples."""
+    columns = {key: [] for key in ('text', 'conf', 'left', 'top', 'width', 'height',
+                                   'page_num', 'block_num', 'par_num', 'line_num')}
+    for text, conf, (x, y, w, h), line in words:
+        for key, value in zip(columns, (text, conf, x, y, w, h, 1, 1, 1, line)):
+            columns[key].append(value)
+    return columns
+
+
+def test_detect_text_regions_single_ocr_pass(monkeypatch):
+    calls = []
+
+    def fake_image_to_data(image, config="", output_type=None):
+        calls.append(image.shape)
+        return tesseract_data([
+            ("Invoice", 91, (10, 10, 60, 12), 1),
+            ("No:", 85, (75, 10, 20, 12), 1),
+            ("", -1, (0, 0, 0, 0), 1),
+            ("2024", 60, (10, 30, 40, 12), 2),
+        ])
+
+    monkeypatch.setattr(erase_utils.pytesseract, "image_to_data", fake_image_to_data)
+    image = np.full((100, 200, 3), 255, dtype=np.uint8)
+    engine = EraseMode()
+
+    words = engine.detect_text_regions(image)
+    lines = engine.detect_text_regions(image, level='line')
+
+    assert len(calls) == 1  # second call is served from the OCR cache
+    assert [w['text'] for w in words] == ["Invoice", "No:", "2024"]
+    assert words[0]['bbox'] == [10, 10, 70, 22]
+    assert words[0]['confidence'] == pytest.approx(0.91)
+    assert lines[0]['text'] == "Invoice No:"
+    assert lines[0]['bbox'] == [10, 10, 95, 22]
+    assert lines[0]['confidence'] == pytest.approx(0.88)
+
+
+def test_detect_text_regions_falls_back_to_contours(monkeypatch):
+    def broken_image_to_data(*args, **kwargs):
+        raise RuntimeError("tesseract missing")
+
+    monkeypatch.setattr(erase_utils.pytesseract, "image_to_data", broken_image_to_data)
+    monkeypatch.setattr(erase_utils.pytesseract, "image_to_string", lambda roi, config="": "LTD")
+    image = np.full((100, 200, 3), 255, dtype=np.uint8)
+    image[20:40, 20:80] = 0
+
+    regions = EraseMode().detect_text_regions(image)
+
+    assert regions == [{'bbox': [20, 20, 80, 40], 'text': "LTD",
+                        'confidence': 0.8, 'level': 'contour'}]
+
+
+def test_erase_text_by_coordinates_single_pass(monkeypatch):
+    engine = EraseMode()
+    masks = []
+    original = engine.ai_enhanced_removal
+
+    def spy(image, mask):
+        masks.append(mask.copy())
+        return original(image, mask)
+
+    monkeypatch.setattr(engine, "ai_enhanced_removal", spy)
+    image = np.full((120, 120, 3), 255, dtype=np.uint8)
+    image[10:20, 10:40] = 0
+    image[80:90, 60:100] = 0
+
+    result, erased = engine.erase_text_by_coordinates(image, [[10, 10, 40, 20], [60, 80, 100, 90]])
+
+    assert len(masks) == 1
+    assert masks[0][15, 25] == 255 and masks[0][85, 80] == 255
+    assert masks[0][50, 50] == 0
+    assert result[15, 25].min() > 200 and result[85, 80].min() > 200
+    assert erased == [[10, 10, 40, 20], [60, 80, 100, 90]]
+
+
+def test_inpaint_text_region_tiles_match_full_page():
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur((rng.random((300, 400, 3)) * 255).astype(np.uint8), (9, 9), 0)
+    mask = np.zeros((300, 400), dtype=np.uint8)
+    mask[50:80, 40:200] = 255
+    mask[60:90, 190:260] = 255  # overlaps the first box
+    mask[250:270, 300:380] = 255
+    engine = EraseMode()
+
+    tiles = engine.mask_tiles(mask)
+    result = engine.inpaint_text_region(image, mask)
+
+    assert len(tiles) == 2
+    np.testing.assert_array_equal(result, cv2.inpaint(image, mask, 3, cv2.INPAINT_TELEA))
+
+
+def test_mask_tiles_merges_dense_pages():
+    mask = np.zeros((3300, 2550), dtype=np.uint8)
+    for top in range(100, 3200, 40):
+        for left in range(100, 2400, 25):
+            # Two separate marks per cell whose padded tiles overlap
+            mask[top:top + 12, left:left + 3] = 255
+            mask[top:top + 12, left + 5:left + 8] = 255
+    # A diagonal chain of marks that must end up as a single tile
+    for step in range(10):
+        mask[20 + 12 * step:28 + 12 * step, 2450 + 8 * step:2456 + 8 * step] = 255
+
+    started = time.perf_counter()
+    tiles = EraseMode().mask_tiles(mask)
+    elapsed = time.perf_counter() - started
+
+    assert len(tiles) == 78 * 92 + 1
+    assert elapsed < 5
+    for i, a in enumerate(tiles):
+        for b in tiles[i + 1:i + 200]:
+            assert not (a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3])
+
+
+def test_history_stores_patches_and_round_trips():
+    engine = EraseMode()
+    states = [np.full((300, 400, 3), 255, dtype=np.uint8)]
+    for i in range(4):
+        state = states[-1].copy()
+        state[20 * i:20 * i + 10, 30:90] = 10 * i
+        states.append(state)
+    for i, state in enumerate(states):
+        engine.add_to_history(state, f"step {i}")
+
+    # Each step stores only a small compressed rectangle
+    assert engine.history_bytes() < states[0].nbytes // 100
+
+    for expected in reversed(states[:-1]):
+        np.testing.assert_array_equal(engine.undo(), expected)
+    assert engine.undo() is None
+    for expected in states[1:]:
+        np.testing.assert_array_equal(engine.redo(), expected)
+    assert engine.redo() is None
+
+
+def test_history_respects_memory_budget():
+    rng = np.random.default_rng(1)
+    engine = EraseMode(history_budget_bytes=20_000)
+    state = np.zeros((200, 200), dtype=np.uint8)
+    engine.add_to_history(state, "open")
+    for i in range(10):
+        state = state.copy()
+        state[:, 20 * i:20 * i + 20] = rng.integers(0, 255, (200, 20), dtype=np.uint8)
+        engine.add_to_history(state, f"erase {i}")
+
+    info = engine.get_history_info()
+    assert engine.history_bytes() <= 20_000
+    assert 1 < info['total_steps'] < 11
+    assert info['current_step'] == info['total_steps']
+    while engine.undo() is not None:
+        pass
+    assert not engine.get_history_info()['can_undo']
+
+
+def test_session_registry_stress_no_cross_talk():
+    sessions = 16
+    registry = EraseSessionRegistry()
+    start = threading.Barrier(sessions)
+
+    def run_session(index):
+        session_id = f"session-{index}"
+        start.wait()
+        state = np.full((200, 200, 3), index, dtype=np.uint8)
+        registry.get(session_id).add_to_history(state, "open")
+        for step in range(5):
+            state = state.copy()
+            state[step * 30:step * 30 + 20, :] = index + 100
+            registry.get(session_id).add_to_history(state, f"erase {step}")
+        engine = registry.get(session_id)
+        return engine, engine.undo()
+
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        results = list(executor.map(run_session, range(sessions)))
+
+    assert len({id(engine) for engine, _ in results}) == sessions
+    for index, (engine, undone) in enumerate(results):
+        # Each session only ever sees its own pixel values
+        assert set(np.unique(undone)) == {index, index + 100}
+        assert engine.get_history_info()['total_steps'] == 6
+
+    # Shrinking the cap evicts least recently used sessions until it fits
+    per_session = max(engine.memory_usage() for engine, _ in results)
+    registry.max_bytes = 4 * per_session
+    registry.enforce_limits()
+    assert registry.resident_bytes() <= registry.max_bytes
+    assert len(registry) == 4
+
+
+def test_session_registry_memory_stays_bounded_under_churn():
+    registry = EraseSessionRegistry(max_bytes=4 * 1024 * 1024)
+
+    def churn(first, count):
+        for index in range(first, first + count):
+            engine = registry.get(f"session-{index}")
+            state = np.full((300, 400, 3), index % 256, dtype=np.uint8)
+            engine.add_to_history(state, "open")
+            for step in range(3):
+                state = state.copy()
+                state[step * 50:step * 50 + 40, :] = (index + step) % 256
+                engine.add_to_history(state, f"erase {step}")
+            engine.undo()
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        churn(0, 40)
+        gc.collect()
+        warm = tracemalloc.get_traced_memory()[0]
+        churn(40, 200)
+        gc.collect()
+        final = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+
+    # What the process actually holds, not just the registry's own accounting
+    assert final - baseline <= 2 * registry.max_bytes
+    assert final - warm <= registry.max_bytes // 4
+    assert registry.resident_bytes() <= registry.max_bytes + 1024 * 1024
+
+
+def test_session_registry_evicts_idle_sessions(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(erase_utils.time, "monotonic", lambda: clock[0])
+    registry = EraseSessionRegistry(idle_seconds=60)
+
+    first = registry.get("a")
+    registry.get("b")
+    clock[0] += 61
+    registry.get("b")
+
+    assert len(registry) == 1
+    assert registry.get("a") is not first
+
+
+def test_digital_page_erase_uses_text_layer_without_ocr(monkeypatch):
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=200)
+    page.insert_text((40, 60), "Invoice 2023", fontsize=12)
+    page.insert_text((40, 120), "Thank you", fontsize=12)
+    image = render_page(page, dpi=150, output='bgr')
+    monkeypatch.setattr(erase_utils.ocr_service, "ocr_page",
+                        lambda *args, **kwargs: pytest.fail("digital pages must not be OCR'd"))
+
+    result, erased = EraseMode().erase_text_by_command(image, "Remove invoice", page=page)
+
+    assert [region['text'] for region in erased] == ["Invoice"]
+    x0, y0, x1, y1 = erased[0]['bbox']
+    # insert_text((40, 60)) at 150 DPI: x = 83px, baseline y = 125px
+    assert x0 == pytest.approx(83, abs=2) and y0 < 125 < y1
+    assert (result[y0:y1, x0:x1] != image[y0:y1, x0:x1]).any()
+    doc.close()
+
+
+def test_text_region_index_uses_the_render_dpi(monkeypatch):
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=200)
+    page.insert_text((40, 60), "Invoice 2023", fontsize=12)
+    image = render_page(page, dpi=150, output='bgr')
+    words = {word[4]: word[:4] for word in page.get_text("words")}
+
+    index = EraseMode().text_region_index(image, dpi=150, page=page)
+
+    # Boxes come back in PDF points, which only works with the real DPI
+    hits = index.intersect(words["Invoice"])
+    assert [index.item(i)['text'] for i in hits] == ["Invoice"]
+    assert index.box(hits[0]) == pytest.approx(words["Invoice"], abs=1)
+    assert index.box(hits[0], dpi=150) == pytest.approx(index.item(hits[0])['bbox'], abs=0.01)
+    doc.close()
+
+
+def test_snap_to_text_returns_the_erased_word_boxes():
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=200)
+    page.insert_text((40, 60), "Invoice 2023", fontsize=12)
+    page.insert_text((40, 120), "Thank you", fontsize=12)
+    image = render_page(page, dpi=150, output='bgr')
+    engine = EraseMode()
+    index = engine.text_region_index(image, dpi=150, page=page)
+    invoice = [region['bbox'] for region in index.items if region['text'] == "Invoice"]
+
+    # A loose user box around the first word only
+    loose = [[60, 90, 165, 140]]
+    result, erased = engine.erase_text_by_coordinates(image, loose, snap_to_text=True,
+                                                      page=page, dpi=150)
+
+    assert erased == invoice
+    x0, y0, x1, y1 = erased[0]
+    assert (result[y0:y1, x0:x1] != image[y0:y1, x0:x1]).any()
+    doc.close()
+
+
+def test_snap_to_text_reuses_the_page_index(monkeypatch):
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=200)
+    page.insert_text((40, 60), "Invoice 2023", fontsize=12)
+    image = render_page(page, dpi=150, output='bgr')
+    engine = EraseMode()
+    detections = []
+    detect = engine.detect_page_text_regions
+    monkeypatch.setattr(engine, "detect_page_text_regions",
+                        lambda *args, **kwargs: detections.append(1) or detect(*args, **kwargs))
+
+    # Reruns query the same page image again and again
+    for _ in range(3):
+        _, erased = engine.erase_text_by_coordinates(image, [[60, 90, 165, 140]], snap_to_text=True,
+                                                     page=page, dpi=150)
+        assert len(erased) == 1
+    assert len(detections) == 1
+
+    # Another DPI, or different pixels, is another index
+    engine.text_region_index(render_page(page, dpi=100, output='bgr'), dpi=100, page=page)
+    erased_image = image.copy()
+    erased_image[0, 0] = 0
+    engine.text_region_index(erased_image, dpi=150, page=page)
+    assert len(detections) == 3
+    doc.close()
+
+
+def test_redact_pdf_keeps_text_layer_and_untouched_pages():
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=200)
+    page.insert_text((40, 40), "Secret", fontsize=12)
+    page.insert_text((40, 80), "Keep", fontsize=12)
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 100, 40), False)
+    pix.clear_with(90)
+    page.insert_image(fitz.Rect(100, 120, 300, 200), pixmap=pix)
+    doc.new_page(width=300, height=200).insert_text((40, 40), "Second page", fontsize=12)
+    pdf_bytes = doc.tobytes()
+    doc.close()
+
+    engine = EraseMode()
+    # 300 DPI pixel boxes: over "Secret", and over the middle of the image
+    engine.add_to_history(np.zeros((4, 4, 3), np.uint8), "base")
+    engine.add_to_history(np.ones((4, 4, 3), np.uint8), "erase", erasures={0: [[150, 110, 300, 175]]})
+    engine.add_to_history(np.full((4, 4, 3), 2, np.uint8), "erase", erasures={0: [[600, 600, 900, 700]]})
+    engine.undo()
+    assert engine.applied_erasures() == {0: [[150, 110, 300, 175]]}
+    engine.redo()
+
+    output = fitz.open(stream=engine.redact_pdf(pdf_bytes, engine.applied_erasures(), dpi=300),
+                       filetype="pdf")
+    first = output[0].get_text()
+    assert "Secret" not in first and "Keep" in first
+    assert output[1].get_text().strip() == "Second page"
+    # The image survives; only the erased area was patched over it
+    assert len(output[0].get_image_info()) == 2
+    output.close()
+
+
+def test_choose_codec_by_page_content():
+    rng = np.random.default_rng(0)
+    text_scan = np.full((200, 200), 255, np.uint8)
+    text_scan[50:60, 20:180] = 0
+    photo = rng.integers(0, 256, size=(200, 200, 3), dtype=np.uint8)
+    line_art = np.full((200, 200, 3), 255, np.uint8)
+    cv2.rectangle(line_art, (20, 20), (120, 120), (200, 40, 10), 3)
+
+    assert erase_utils.choose_codec(text_scan) == 'bilevel'
+    assert erase_utils.choose_codec(photo) == 'jpeg'
+    assert erase_utils.choose_codec(line_art) == 'png'
+
+
+def test_images_to_pdf_copies_untouched_pages():
+    source = fitz.open()
+    for label in ("one", "two", "three"):
+        source.new_page(width=300, height=200).insert_text((40, 40), f"page {label}")
+    source_bytes = source.tobytes()
+    source.close()
+
+    erased = np.full((400, 600, 3), 255, np.uint8)
+    output = EraseMode().images_to_pdf([None, erased, None], source_pdf=source_bytes, workers=2)
+
+    with fitz.open(stream=output, filetype="pdf") as doc:
+        assert len(doc) == 3
+        assert doc[0].get_text().strip() == "page one"
+        assert doc[2].get_text().strip() == "page three"
+        # The re-encoded page keeps the original page size and is bilevel
+        assert doc[1].rect == fitz.Rect(0, 0, 300, 200)
+        assert doc[1].get_images()[0][4] == 1
+
+
+def test_images_to_pdf_keeps_aspect_ratio_without_source():
+    # A wide, non-A4 image on a default page must not be stretched
+    wide = np.full((200, 800, 3), 255, np.uint8)
+    wide[:, :10] = 0
+    output = EraseMode().images_to_pdf([wide], codec='png')
+
+    with fitz.open(stream=output, filetype="pdf") as doc:
+        page = doc[0]
+        bbox = page.get_image_info()[0]['bbox']
+        width, height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        assert width == pytest.approx(page.rect.width, abs=0.5)
+        assert width / height == pytest.approx(4, rel=0.01)
@@ -0,0 +1,198 @@
+"""
+Tests for src/ocr_utils.py OCR result cache and OCR service.
+"""
+
+import shlex
+import subprocess
+import threading
+import time
+from types import SimpleNamespace
+
+import fitz
+import numpy as np
+
+from src import ocr_utils
+from src.ocr_utils import OcrCache, OcrService, page_content_hash, parse_tesseract_tsv, split_config
+from src.pdf_utils import OCR_CONFIG
+
+
+def form_xobject_pdf(text):
+    """A page whose content stream only draws a form XObject holding the text."""
+    source = fitz.open()
+    source.new_page(width=200, height=100).insert_text((20, 50), text)
+    doc = fitz.open()
+    doc.new_page(width=200, height=100).show_pdf_page(fitz.Rect(0, 0, 200, 100), source, 0)
+    data = doc.tobytes()
+    doc.close()
+    source.close()
+    return fitz.open(stream=data, filetype="pdf")
+
+
+def test_page_content_hash_covers_form_xobjects():
+    first, second, again = (form_xobject_pdf(text) for text in ("Invoice 1", "Invoice 2", "Invoice 1"))
+
+    # Same content stream ("/fzFrm0 Do"), different form contents
+    assert first[0].read_contents() == second[0].read_contents()
+    assert page_content_hash(first[0]) != page_content_hash(second[0])
+    assert page_content_hash(first[0]) == page_content_hash(again[0])
+
+
+def test_ocr_cache_hit_miss_and_lru_eviction(tmp_path):
+    cache = OcrCache(path=str(tmp_path / "ocr.sqlite"), max_bytes=80)
+    first = OcrCache.make_key(b"page one", "psm 6")
+    second = OcrCache.make_key(b"page two", "psm 6")
+
+    assert cache.get(first) is None
+    cache.put(first, {'text': "one", 'words': []})
+    cache.put(second, {'text': "two", 'words': []})
+    assert cache.get(first) == {'text': "one", 'words': []}
+
+    # Over the cap: the least recently used entry (second) goes first
+    cache.put(OcrCache.make_key(b"page three", "psm 6"), {'text': "three", 'words': []})
+    assert cache.get(second) is None
+    assert cache.get(first) is not None
+
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['evictions'] == 1
+    assert stats['size_bytes'] <= 80
+
+
+def test_ocr_cache_key_depends_on_config_and_pixels():
+    image = np.zeros((4, 4, 3), dtype=np.uint8)
+    key = OcrCache.make_key(image, "psm 6")
+
+    assert key == OcrCache.make_key(image.copy(), "psm 6")
+    assert key != OcrCache.make_key(image, "psm 8")
+    image[0, 0] = 1
+    assert key != OcrCache.make_key(image, "psm 6")
+
+
+def test_cli_batch_runs_one_tesseract_process(monkeypatch):
+    monkeypatch.setattr(ocr_utils, "tesserocr", None)
+    calls = []
+
+    def fake_run(cmd, capture_output, check):
+        calls.append(cmd)
+        with open(cmd[1]) as f:
+            count = len(f.read().split())
+        stdout = "".join(f"text {i}\n\f" for i in range(count))
+        return subprocess.CompletedProcess(cmd, 0, stdout.encode(), b"")
+
+    monkeypatch.setattr(ocr_utils.subprocess, "run", fake_run)
+    images = [np.full((8, 8), i, dtype=np.uint8) for i in range(3)]
+
+    texts = OcrService().ocr_batch(images, config="--psm 8")
+
+    assert len(calls) == 1
+    assert "--psm" in calls[0] and "8" in calls[0]
+    assert [text.strip() for text in texts] == ["text 0", "text 1", "text 2"]
+
+
+def test_cli_batch_pads_missing_pages_with_separate_dicts(monkeypatch):
+    monkeypatch.setattr(ocr_utils, "tesserocr", None)
+    header = "\t".join(ocr_utils.TSV_COLUMNS)
+    row = "5\t1\t1\t1\t1\t1\t10\t20\t30\t40\t91.5\tHello"
+    monkeypatch.setattr(ocr_utils.subprocess, "run", lambda cmd, capture_output, check:
+                        subprocess.CompletedProcess(cmd, 0, f"{header}\n{row}\n".encode(), b""))
+    images = [np.full((8, 8), i, dtype=np.uint8) for i in range(3)]
+
+    pages = OcrService().ocr_batch(images, output='data')
+
+    assert pages[0]['text'] == ["Hello"]
+    assert pages[1] == pages[2] == {column: [] for column in ocr_utils.TSV_COLUMNS}
+    pages[1]['text'].append("filled in")
+    assert pages[2]['text'] == []
+
+
+def test_parse_tesseract_tsv_splits_pages():
+    tsv = "\n".join([
+        "\t".join(ocr_utils.TSV_COLUMNS),
+        "5\t1\t1\t1\t1\t1\t10\t20\t30\t40\t91.5\tHello",
+        "5\t2\t1\t1\t1\t1\t1\t2\t3\t4\t80\tWorld",
+    ])
+
+    pages = parse_tesseract_tsv(tsv)
+
+    assert len(pages) == 2
+    assert pages[0]['text'] == ["Hello"]
+    assert pages[0]['left'] == [10] and pages[0]['conf'] == [91.5]
+    assert pages[1]['text'] == ["World"]
+
+
+def test_ocr_service_limits_concurrency(monkeypatch):
+    monkeypatch.setattr(ocr_utils, "tesserocr", None)
+    active = [0]
+    peak = [0]
+    lock = threading.Lock()
+
+    def slow_ocr(image, config=""):
+        with lock:
+            active[0] += 1
+            peak[0] = max(peak[0], active[0])
+        time.sleep(0.02)
+        with lock:
+            active[0] -= 1
+        return "ok"
+
+    monkeypatch.setattr(ocr_utils.pytesseract, "image_to_string", slow_ocr)
+    service = OcrService(max_concurrency=2)
+    image = np.zeros((4, 4), dtype=np.uint8)
+    threads = [threading.Thread(target=service.ocr_page, args=(image,)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak[0] == 2
+
+
+class FakeTessBaseAPI:
+    """Records how an in-process engine was configured."""
+
+    created = []
+
+    def __init__(self, lang, oem=None, psm=None):
+        self.settings = {'lang': lang, 'oem': oem, 'psm': psm}
+        FakeTessBaseAPI.created.append(self)
+
+    def SetVariable(self, name, value):
+        self.settings[name] = value
+
+    def SetImage(self, image):
+        pass
+
+    def GetUTF8Text(self):
+        return "text"
+
+
+def test_page_ocr_config_splits_the_same_on_every_path(monkeypatch):
+    args = split_config(OCR_CONFIG)
+    assert args[:5] == ["--oem", "3", "--psm", "6", "-c"]
+    whitelist = args[5].split("=", 1)[1]
+    assert all(char in whitelist for char in "09AZaz.,\\\"'`~")
+
+    # What pytesseract's own split hands to the tesseract CLI
+    assert shlex.split(ocr_utils._pytesseract_config(OCR_CONFIG)) == args
+
+    # In-process engine path
+    FakeTessBaseAPI.created.clear()
+    fake_tesserocr = SimpleNamespace(PyTessBaseAPI=FakeTessBaseAPI, OEM=int, PSM=int)
+    monkeypatch.setattr(ocr_utils, "tesserocr", fake_tesserocr)
+    assert OcrService().ocr_page(np.zeros((4, 4), dtype=np.uint8), OCR_CONFIG) == "text"
+    settings = FakeTessBaseAPI.created[0].settings
+    assert settings['oem'] == 3 and settings['psm'] == 6
+    assert settings['tessedit_char_whitelist'] == whitelist
+
+    # Batched CLI path
+    monkeypatch.setattr(ocr_utils, "tesserocr", None)
+    calls = []
+
+    def fake_run(cmd, capture_output, check):
+        calls.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0, b"a\f b\f", b"")
+
+    monkeypatch.setattr(ocr_utils.subprocess, "run", fake_run)
+    OcrService().ocr_batch([np.zeros((4, 4), dtype=np.uint8)] * 2, OCR_CONFIG)
+    assert calls[0][3:] == args
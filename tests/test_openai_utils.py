@@ -0,0 +1,397 @@
+"""
+Tests for src/openai_utils.py concurrent, cached and packed rewriting and the request governor.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from src import openai_utils
+from src.openai_utils import (CircuitOpenError, RequestGovernor, ResponseCache, TokenBucket,
+                               dedupe_blocks, get_gpt_response, get_gpt_response_async, pack_blocks,
+                               rewrite_many, rewrite_many_async, rewrite_text_blocks, rewrite_with_gpt,
+                               split_packed_response)
+
+
+@pytest.fixture(autouse=True)
+def isolated_response_cache(tmp_path, monkeypatch):
+    cache = ResponseCache(path=str(tmp_path / "llm.sqlite"))
+    monkeypatch.setattr(openai_utils, "response_cache", cache)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def isolated_governor(monkeypatch):
+    governor = RequestGovernor(backoff_base=0.001)
+    monkeypatch.setattr(openai_utils, "gpt_governor", governor)
+    return governor
+
+
+class FakeCompletions:
+    """Stands in for AsyncOpenAI().chat.completions, tracking requests in flight."""
+
+    def __init__(self, fail_on=(), mangle=lambda content: content):
+        self.fail_on = set(fail_on)
+        self.mangle = mangle
+        self.packed_calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    async def create(self, model, messages):
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            prompt = messages[-1]["content"]
+            if "[[BLOCK 1]]" in prompt:
+                return self.packed_response(prompt)
+            text = next(line.strip() for line in prompt.splitlines() if line.strip().startswith("block"))
+            # Later blocks finish first, so ordering must not depend on completion order
+            await asyncio.sleep(0.01 / (1 + int(text.split()[1])))
+            if text in self.fail_on:
+                raise RuntimeError(f"boom {text}")
+            message = SimpleNamespace(content=text.upper())
+            return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+        finally:
+            self.in_flight -= 1
+
+    def packed_response(self, prompt):
+        self.packed_calls += 1
+        lines = [line.strip() for line in prompt.splitlines() if line.strip()]
+        answer = []
+        for line in lines:
+            if line.startswith("[[BLOCK"):
+                answer.append(line)
+            elif line.startswith("block"):
+                answer.append(line.upper())
+        content = self.mangle("\n".join(answer))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+def fake_client(**kwargs):
+    completions = FakeCompletions(**kwargs)
+    return SimpleNamespace(chat=SimpleNamespace(completions=completions)), completions
+
+
+def test_rewrite_many_preserves_order_and_caps_concurrency():
+    client, completions = fake_client()
+    texts = [f"block {i}" for i in range(20)]
+
+    results = asyncio.run(rewrite_many_async(texts, concurrency=4, client=client, pack=False))
+
+    assert [r['text'] for r in results] == [t.upper() for t in texts]
+    assert all(r['error'] is None for r in results)
+    assert completions.calls == 20
+    assert completions.max_in_flight == 4
+
+
+def test_rewrite_many_reports_errors_per_item():
+    client, _ = fake_client(fail_on={"block 1"})
+
+    results = asyncio.run(rewrite_many_async(["block 0", "block 1", "block 2"], client=client, pack=False))
+
+    assert results[0] == {'text': "BLOCK 0", 'error': None, 'cached': False}
+    assert results[1]['text'] is None and "boom block 1" in results[1]['error']
+    assert results[2] == {'text': "BLOCK 2", 'error': None, 'cached': False}
+
+
+def test_rewrite_many_reuses_cached_responses(isolated_response_cache):
+    client, completions = fake_client(fail_on={"block 1"})
+    asyncio.run(rewrite_many_async(["block 0", "block 1"], client=client, pack=False))
+
+    # Failures are not cached, so only block 1 is sent again
+    client, completions = fake_client()
+    results = asyncio.run(rewrite_many_async(["block 0", "block 1"], client=client, pack=False))
+    assert [r['cached'] for r in results] == [True, False]
+    assert [r['text'] for r in results] == ["BLOCK 0", "BLOCK 1"]
+    assert completions.calls == 1
+
+    # Bypassing the cache sends everything again
+    client, completions = fake_client()
+    results = asyncio.run(rewrite_many_async(["block 0", "block 1"], client=client,
+                                             use_cache=False, pack=False))
+    assert not any(r['cached'] for r in results)
+    assert completions.calls == 2
+
+    stats = isolated_response_cache.stats()
+    assert stats['hits'] == 1
+    assert stats['entries'] == 2
+
+
+def test_rewrite_with_gpt_raises_instead_of_returning_the_error(monkeypatch, isolated_response_cache):
+    def fail(prompt):
+        raise RuntimeError("quota exceeded")
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(openai, "api_key", None)
+    monkeypatch.setattr(openai, "max_retries", openai.max_retries)
+    monkeypatch.setattr(openai, "http_client", None)
+    monkeypatch.setattr(openai_utils, "get_gpt_response", fail)
+
+    with pytest.raises(RuntimeError, match="quota exceeded"):
+        rewrite_with_gpt("Fix this")
+    assert isolated_response_cache.stats()['entries'] == 0
+
+
+def test_rewrite_with_gpt_takes_use_cache_by_keyword_only():
+    # A second positional argument (e.g. the document text) must not become use_cache
+    with pytest.raises(TypeError):
+        rewrite_with_gpt("Make this formal", "The document text")
+
+
+def test_response_cache_ttl_lru_and_persistence(tmp_path):
+    path = str(tmp_path / "llm.sqlite")
+    cache = ResponseCache(path=path, max_bytes=10)
+    first = ResponseCache.make_key("model", None, "rewrite", "one")
+    second = ResponseCache.make_key("model", None, "rewrite", "two")
+    assert first != ResponseCache.make_key("model", "be terse", "rewrite", "one")
+
+    cache.put(first, "11111")
+    cache.put(second, "22222")
+    assert cache.get(first) == "11111"  # first is now the most recently used
+    cache.put(ResponseCache.make_key("model", None, "rewrite", "three"), "33333")
+
+    # A fresh instance reads the file, not the memory layer
+    reopened = ResponseCache(path=path, max_bytes=10)
+    assert reopened.get(second) is None
+    assert reopened.get(first) == "11111"
+    assert cache.stats()['evictions'] == 1
+
+    expiring = ResponseCache(path=path, ttl=0.01)
+    time.sleep(0.02)
+    assert expiring.get(first) is None
+    stats = expiring.stats()
+    assert stats['expired'] == 1 and stats['misses'] == 1 and stats['hit_rate'] == 0.0
+
+
+def test_pack_blocks_respects_token_budget():
+    texts = ["a" * 40, "b" * 40, "c" * 2000, "d" * 40, "e" * 40, "f" * 40]
+
+    # 40 chars is about 11 tokens, so two fit a 25-token budget; the long text travels alone
+    assert pack_blocks(texts, max_tokens=25, block_max_tokens=100) == [[0, 1], [2], [3, 4], [5]]
+
+
+def test_split_packed_response_validates_markers():
+    assert split_packed_response("[[BLOCK 1]]\nOne\n\n[[BLOCK 2]]\nTwo", 2) == ["One", "Two"]
+    assert split_packed_response("[[BLOCK 1]]\nOne", 2) is None
+    assert split_packed_response("[[BLOCK 2]]\nTwo\n[[BLOCK 1]]\nOne", 2) is None
+    assert split_packed_response("[[BLOCK 1]]\n\n[[BLOCK 2]]\nTwo", 2) is None
+    assert split_packed_response("Sure!\n[[BLOCK 1]]\nOne\n[[BLOCK 2]]\nTwo", 2) is None
+
+
+def test_rewrite_many_packs_short_blocks():
+    client, completions = fake_client()
+    texts = [f"block {i}" for i in range(30)]
+
+    results = asyncio.run(rewrite_many_async(texts, client=client))
+
+    assert [r['text'] for r in results] == [t.upper() for t in texts]
+    assert completions.calls == completions.packed_calls == 1
+
+
+def test_rewrite_many_falls_back_when_a_pack_does_not_split():
+    client, completions = fake_client(mangle=lambda content: content.replace("[[BLOCK 2]]", ""))
+
+    results = asyncio.run(rewrite_many_async(["block 0", "block 1", "block 2"], client=client))
+
+    assert [r['text'] for r in results] == ["BLOCK 0", "BLOCK 1", "BLOCK 2"]
+    assert completions.packed_calls == 1
+    assert completions.calls == 4
+
+
+def test_estimate_tokens_falls_back_when_tiktoken_fails(monkeypatch):
+    def no_encoding(model):
+        raise KeyError(model)
+
+    monkeypatch.setattr(openai_utils, "tiktoken", SimpleNamespace(encoding_for_model=no_encoding))
+    openai_utils._encoding.cache_clear()
+    try:
+        assert openai_utils.estimate_tokens("x" * 40) == 11
+        assert pack_blocks(["block 0", "block 1"]) == [[0, 1]]
+    finally:
+        openai_utils._encoding.cache_clear()
+
+
+def statement_blocks(pages=3):
+    blocks = []
+    for page in range(1, pages + 1):
+        blocks.append({'text': "ACME  Bank\nStatement", 'page': page, 'bbox': [50, 20 + page * 0.5, 300, 40]})
+        blocks.append({'text': f"Balance on page {page}", 'page': page, 'bbox': [50, 100, 300, 120]})
+        blocks.append({'text': "Confidential", 'page': page, 'bbox': [50, 780, 200, 795]})
+    # Same words as the footer, but in the body: not page furniture
+    blocks.append({'text': "Confidential", 'page': pages, 'bbox': [50, 400, 200, 415]})
+    return blocks
+
+
+def test_dedupe_blocks_matches_text_and_position():
+    blocks = statement_blocks()
+    blocks[3]['text'] = "ACME Bank Statement"  # Whitespace differences are normalised away
+
+    unique, owners = dedupe_blocks(blocks)
+
+    assert unique == [0, 1, 2, 4, 7, 9]
+    assert owners == [0, 1, 2, 0, 4, 2, 0, 7, 2, 9]
+
+
+def test_rewrite_text_blocks_rewrites_repeats_once(monkeypatch):
+    sent = []
+
+    def fake_rewrite_many(texts, concurrency, use_cache=True, pack=True):
+        sent.extend(texts)
+        return [{'text': text.upper(), 'error': None, 'cached': False} for text in texts]
+
+    monkeypatch.setattr(openai_utils, "rewrite_many", fake_rewrite_many)
+    blocks = statement_blocks(pages=10)
+
+    results = rewrite_text_blocks(blocks)
+
+    assert len(sent) == 13  # Header, footer, ten balances and the body text
+    assert [r['text'] for r in results] == [b['text'].upper() for b in blocks]
+    assert sum(r['duplicate'] for r in results) == 18
+
+
+class StubServer:
+    """Local chat completions endpoint answering with scripted (status, headers) replies."""
+
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.requests += 1
+                status, headers = stub.replies.pop(0) if len(stub.replies) > 1 else stub.replies[0]
+                if status == 200:
+                    body = {"id": "stub", "object": "chat.completion", "created": 0,
+                            "model": "gpt-3.5-turbo",
+                            "choices": [{"index": 0, "finish_reason": "stop",
+                                         "message": {"role": "assistant", "content": "Rewritten."}}]}
+                else:
+                    body = {"error": {"message": f"stub {status}", "type": "stub", "code": None}}
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self):
+        # An explicit http_client, since the pinned openai predates httpx 0.28's constructor
+        return openai.AsyncOpenAI(api_key="test", max_retries=0, http_client=httpx.AsyncClient(),
+                                  base_url=f"http://127.0.0.1:{self.server.server_port}/v1")
+
+
+def run_with_client(stub, make_coro):
+    async def run():
+        client = stub.client()
+        try:
+            return await make_coro(client)
+        finally:
+            await client.close()
+    return asyncio.run(run())
+
+
+def test_rewrite_many_builds_its_own_client(monkeypatch):
+    with StubServer([(200, {})]) as stub:
+        monkeypatch.setenv("OPENAI_API_KEY", "test")
+        monkeypatch.setenv("OPENAI_BASE_URL", f"http://127.0.0.1:{stub.server.server_port}/v1")
+        # Module-level client state that set_openai_api_key() and the sync call set up
+        for name in ("api_key", "max_retries", "http_client", "base_url", "_client"):
+            monkeypatch.setattr(openai, name, None if name != "max_retries" else openai.max_retries)
+
+        results = rewrite_many(["Fix this", "And this"], pack=False)
+        text = get_gpt_response("Fix this")
+        openai.http_client.close()
+
+    assert [result['text'] for result in results] == ["Rewritten.", "Rewritten."]
+    assert [result['error'] for result in results] == [None, None]
+    assert text == "Rewritten."
+    assert stub.requests == 3
+
+
+def test_rewrite_many_fails_a_pack_on_auth_errors():
+    with StubServer([(401, {})]) as stub:
+        results = run_with_client(stub, lambda client: rewrite_many_async(
+            ["block 0", "block 1", "block 2"], client=client))
+
+    # One packed request; its blocks are not retried one by one
+    assert stub.requests == 1
+    assert [result['text'] for result in results] == [None, None, None]
+    assert all("401" in result['error'] for result in results)
+
+
+def test_token_bucket_spaces_out_reservations():
+    now = [0.0]
+    bucket = TokenBucket(per_minute=60, clock=lambda: now[0])
+
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(1) == pytest.approx(1.0)
+    assert bucket.reserve(1) == pytest.approx(2.0)
+    now[0] = 10.0
+    assert bucket.reserve(5) == 0.0
+
+
+def test_governor_retries_rate_limits_after_retry_after(isolated_governor):
+    with StubServer([(429, {"retry-after-ms": "200"}), (200, {})]) as stub:
+        started = time.monotonic()
+        text = run_with_client(stub, lambda client: get_gpt_response_async("Fix this", client))
+        elapsed = time.monotonic() - started
+
+    assert text == "Rewritten."
+    assert stub.requests == 2
+    assert elapsed >= 0.2
+    stats = isolated_governor.stats()
+    assert stats['retries'] == 1 and stats['rate_limited'] == 1 and stats['successes'] == 1
+    assert stats['state'] == 'closed'
+
+
+def test_governor_circuit_breaker_fails_fast_then_recovers(monkeypatch):
+    governor = RequestGovernor(max_retries=10, backoff_base=0.001, failure_threshold=3, cooldown=0.2)
+    monkeypatch.setattr(openai_utils, "gpt_governor", governor)
+
+    with StubServer([(500, {})]) as stub:
+        results = run_with_client(stub, lambda client: rewrite_many_async(
+            [f"block {i}" for i in range(5)], concurrency=1, client=client, pack=False))
+
+        # Three failed attempts open the circuit; the rest never reach the server
+        assert stub.requests == 3
+        assert all(r['error'] for r in results)
+        stats = governor.stats()
+        assert stats['circuit_opens'] == 1 and stats['fast_failures'] == 4
+        assert stats['state'] == 'open'
+
+        with pytest.raises(CircuitOpenError):
+            run_with_client(stub, lambda client: get_gpt_response_async("again", client))
+
+        # After the cooldown one probe goes through and closes the circuit
+        time.sleep(0.25)
+        stub.replies = [(200, {})]
+        assert run_with_client(stub, lambda client: get_gpt_response_async("again", client)) == "Rewritten."
+        assert governor.state == 'closed'
+        assert stub.requests == 4
@@ -0,0 +1,337 @@
+"""
+Tests for src/pdf_utils.py text extraction.
+"""
+
+import fitz
+import numpy as np
+import pytest
+
+from src import ocr_utils, pdf_utils
+from src.ocr_utils import OcrCache
+
+
+@pytest.fixture(autouse=True)
+def isolated_ocr_cache(tmp_path, monkeypatch):
+    cache = OcrCache(path=str(tmp_path / "ocr.sqlite"))
+    monkeypatch.setattr(pdf_utils, "ocr_cache", cache)
+    return cache
+
+
+def make_pdf(pages):
+    """Build a PDF where each entry is page text, or None for an image-only page."""
+    doc = fitz.open()
+    for text in pages:
+        page = doc.new_page(width=300, height=200)
+        if text is None:
+            pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 60, 40), False)
+            pix.clear_with(200)
+            page.insert_image(page.rect, pixmap=pix)
+        else:
+            page.insert_text((40, 60), text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def tesseract_data(words):
+    """Build image_to_data output from (text, left, top, width, height, conf, block) tuples."""
+    data = {key: [] for key in ('level', 'page_num', 'block_num', 'par_num', 'line_num',
+                                'word_num', 'left', 'top', 'width', 'height', 'conf', 'text')}
+    for i, (text, left, top, width, height, conf, block) in enumerate(words):
+        for key, value in (('level', 5), ('page_num', 1), ('block_num', block), ('par_num', 1),
+                           ('line_num', 1), ('word_num', i + 1), ('left', left), ('top', top),
+                           ('width', width), ('height', height), ('conf', conf), ('text', text)):
+            data[key].append(value)
+    return data
+
+
+def make_scans(count):
+    """Build a PDF of image-only pages whose images all differ."""
+    doc = fitz.open()
+    for i in range(count):
+        page = doc.new_page(width=300, height=200)
+        pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 60, 40), False)
+        pix.clear_with(200 - i)
+        page.insert_image(page.rect, pixmap=pix)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def fake_image_to_data(img, config="", output_type=None):
+    return tesseract_data([("scanned", 0, 0, 100, 50, 90, 1), (str(img.shape[1]), 120, 0, 60, 50, 90, 1)])
+
+
+def fake_ocr(monkeypatch):
+    monkeypatch.setattr(pdf_utils, "_tesseract_available", lambda: True)
+    monkeypatch.setattr(pdf_utils.pytesseract, "image_to_data", fake_image_to_data)
+    # Batches of pages go to one tesseract CLI run instead
+    monkeypatch.setattr(pdf_utils.ocr_service, "_cli_batch",
+                        lambda images, config, output: [fake_image_to_data(img) for img in images])
+
+
+class WorkerPatch:
+    """monkeypatch stand-in for spawned workers, whose patches die with the process."""
+
+    @staticmethod
+    def setattr(target, name, value):
+        setattr(target, name, value)
+
+
+real_init_extract_worker = pdf_utils._init_extract_worker
+
+
+def init_fake_ocr_worker(*args):
+    """Extraction worker initializer that installs the fake OCR in the spawned process."""
+    fake_ocr(WorkerPatch)
+    real_init_extract_worker(*args)
+
+
+def fake_ocr_in_workers(monkeypatch):
+    fake_ocr(monkeypatch)
+    monkeypatch.setattr(pdf_utils, "_init_extract_worker", init_fake_ocr_worker)
+
+
+def test_extract_text_blocks_parallel_matches_serial(monkeypatch, isolated_ocr_cache):
+    fake_ocr_in_workers(monkeypatch)
+    pdf_bytes = make_pdf(["first page", None, "third page", None, None])
+
+    # Pages 2, 4 and 5 are OCR'd in spawned workers running the fake OCR,
+    # which share the parent's cache file
+    parallel = pdf_utils.extract_text_blocks(pdf_bytes, workers=2)
+    assert isolated_ocr_cache.stats()['misses'] >= 1
+    isolated_ocr_cache.clear()
+    serial = pdf_utils.extract_text_blocks(pdf_bytes, workers=1)
+
+    assert parallel == serial
+    assert [b["page"] for b in serial] == [1, 2, 3, 4, 5]
+    assert [b["type"] for b in serial] == ["text", "ocr", "text", "ocr", "ocr"]
+
+
+def test_scanned_pages_share_tesseract_runs(monkeypatch, isolated_ocr_cache):
+    fake_ocr_in_workers(monkeypatch)
+    monkeypatch.setattr(ocr_utils, "tesserocr", None)
+    batches = []
+    monkeypatch.setattr(pdf_utils.ocr_service, "_cli_batch",
+                        lambda images, config, output: batches.append(len(images)) or
+                        [fake_image_to_data(img) for img in images])
+    pdf_bytes = make_scans(pdf_utils.OCR_BATCH_PAGES + 2)
+
+    serial = pdf_utils.extract_text_blocks(pdf_bytes, workers=1)
+    isolated_ocr_cache.clear()
+    parallel = pdf_utils.extract_text_blocks(pdf_bytes, workers=2)
+
+    # One tesseract process per batch of pages, not one per page
+    assert batches == [pdf_utils.OCR_BATCH_PAGES, 2]
+    assert [b["page"] for b in serial] == list(range(1, pdf_utils.OCR_BATCH_PAGES + 3))
+    assert {b["type"] for b in serial} == {"ocr"}
+    assert parallel == serial
+
+
+def test_partial_ocr_batch_does_not_hold_back_text_pages(monkeypatch):
+    fake_ocr(monkeypatch)
+    classified = []
+    classify_page = pdf_utils.classify_page
+    monkeypatch.setattr(pdf_utils, "classify_page", lambda page: classified.append(page.number) or
+                        classify_page(page))
+    pdf_bytes = make_pdf([None] + [f"text page {i}" for i in range(40)])
+
+    stream = pdf_utils.iter_text_blocks(pdf_bytes, workers=1)
+    first = next(stream)
+
+    # The lone scanned page is OCR'd without reading the rest of the document first
+    assert first["page"] == 1 and first["type"] == "ocr"
+    assert len(classified) < 20
+    stream.close()
+
+
+def test_extract_text_blocks_without_tesseract(monkeypatch):
+    monkeypatch.setattr(pdf_utils, "_tesseract_available", lambda: False)
+    blocks = pdf_utils.extract_text_blocks(make_pdf([None]), workers=4)
+
+    assert blocks[0]["type"] == "error"
+    assert "Tesseract not installed" in blocks[0]["text"]
+
+
+def test_iter_text_blocks_page_range(monkeypatch):
+    fake_ocr_in_workers(monkeypatch)
+    pdf_bytes = make_pdf(["first page", None, "third page", None])
+
+    stream = pdf_utils.iter_text_blocks(pdf_bytes, pages=range(1, 3), workers=2)
+    first = next(stream)
+
+    assert first["page"] == 2 and first["type"] == "ocr"
+    assert [b["page"] for b in stream] == [3]
+
+
+def test_extract_text_blocks_reuses_cached_ocr(monkeypatch, isolated_ocr_cache):
+    fake_ocr(monkeypatch)
+    pdf_bytes = make_pdf([None, None])
+
+    first = pdf_utils.extract_text_blocks(pdf_bytes, workers=1)
+    monkeypatch.setattr(pdf_utils.pytesseract, "image_to_data",
+                        lambda img, config="", output_type=None: pytest.fail("OCR should come from cache"))
+    second = pdf_utils.extract_text_blocks(pdf_bytes, workers=1)
+
+    assert second == first
+    # Both pages have identical content, so each run looks it up (and OCRs it) once
+    assert isolated_ocr_cache.stats()['misses'] == 1
+    assert isolated_ocr_cache.stats()['hits'] == 1
+
+
+def test_cached_rerun_starts_no_worker_pool(monkeypatch, isolated_ocr_cache):
+    fake_ocr_in_workers(monkeypatch)
+    pdf_bytes = make_pdf(["first page", None, "third page", None])
+
+    first = pdf_utils.extract_text_blocks(pdf_bytes, workers=2)
+    monkeypatch.setattr(pdf_utils, "ProcessPoolExecutor",
+                        lambda *args, **kwargs: pytest.fail("every page is cached"))
+    second = pdf_utils.extract_text_blocks(pdf_bytes, workers=2)
+
+    assert second == first
+    assert [b["type"] for b in second] == ["text", "ocr", "text", "ocr"]
+
+
+def test_extraction_runs_from_memory(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    pdf_bytes = bytearray(make_pdf(["in memory"]))
+
+    blocks = pdf_utils.extract_text_blocks(memoryview(pdf_bytes), workers=1)
+    images = pdf_utils.pdf_to_images(memoryview(pdf_bytes))
+
+    assert blocks[0]["text"] == "in memory"
+    assert len(images) == 1
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_pdf_page_images_render_lazily_with_bounded_cache(monkeypatch):
+    from src import doc_utils
+
+    rendered = []
+    real_render = doc_utils.render_page
+
+    def counting_render(page, dpi, output='pil'):
+        rendered.append(page.number)
+        return real_render(page, dpi, output)
+
+    monkeypatch.setattr(doc_utils, "render_page", counting_render)
+    images = pdf_utils.pdf_page_images(make_pdf([f"page {i}" for i in range(10)]), cache_size=3)
+    try:
+        assert len(images) == 10
+        assert rendered == []
+
+        first = images[4]
+        assert images[4] is first
+        images._executor.submit(lambda: None).result()  # let prefetch finish
+        assert {3, 4, 5} <= set(rendered)
+        assert rendered.count(4) == 1
+
+        images[8]
+        assert len(images.cached_pages()) <= 3
+        assert images[-1].size == images[9].size
+    finally:
+        images.close()
+
+
+def test_pixmap_bridge_matches_png_round_trip():
+    import io
+
+    from PIL import Image
+
+    from src.doc_utils import pixmap_to_array, render_page
+
+    doc = fitz.open(stream=make_pdf(["bridge"]), filetype="pdf")
+    page = doc.load_page(0)
+    pix = page.get_pixmap(dpi=72)
+    via_png = np.array(Image.open(io.BytesIO(pix.tobytes("png"))))
+
+    np.testing.assert_array_equal(pixmap_to_array(pix), via_png)
+    np.testing.assert_array_equal(render_page(page, 72, 'bgr'), via_png[:, :, ::-1])
+    assert render_page(page, 72, 'gray').shape == via_png.shape[:2]
+    doc.close()
+
+
+def test_adaptive_dpi_escalates_only_low_confidence_pages(monkeypatch):
+    monkeypatch.setattr(pdf_utils, "_tesseract_available", lambda: True)
+    rendered = []
+
+    def fake_image_to_data(img, config="", output_type=None):
+        # Width of a 300pt page: 625px at 150 DPI, 834px at 200 DPI
+        rendered.append(img.shape[1])
+        confidence = 95 if img.shape[1] > 700 else 40
+        return tesseract_data([("word", 1, 1, 10, 10, confidence, 1)])
+
+    monkeypatch.setattr(pdf_utils.ocr_service, "ocr_page",
+                        lambda img, config="", output="text": fake_image_to_data(img))
+    blocks = pdf_utils.extract_text_blocks(make_pdf([None]), workers=1,
+                                           dpi_ladder=(150, 200, 300), min_confidence=0.9)
+
+    assert rendered == [625, 834]
+    stats = blocks[0]["ocr_stats"]
+    assert stats["dpi"] == 200
+    assert stats["confidence"] == pytest.approx(0.95)
+    assert [attempt["dpi"] for attempt in stats["attempts"]] == [150, 200]
+    assert blocks[0]["text"] == "word"
+
+
+def make_hybrid_pdf():
+    """One page with a text header above a scanned image body."""
+    doc = fitz.open()
+    page = doc.new_page(width=300, height=200)
+    page.insert_text((40, 30), "Header")
+    pix = fitz.Pixmap(fitz.csRGB, fitz.IRect(0, 0, 60, 30), False)
+    pix.clear_with(200)
+    page.insert_image(fitz.Rect(0, 50, 300, 200), pixmap=pix)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def test_classify_page_without_rendering():
+    pdf_bytes = make_pdf(["text page", None, ""])
+    hybrid = make_hybrid_pdf()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        kinds = [pdf_utils.classify_page(page)['kind'] for page in doc]
+    with fitz.open(stream=hybrid, filetype="pdf") as doc:
+        layout = pdf_utils.classify_page(doc[0])
+
+    assert kinds == ["text", "scanned", "text"]
+    assert layout['kind'] == "hybrid"
+    assert layout['ocr_rects'] == [(0.0, 50.0, 300.0, 200.0)]
+    assert 0.7 < layout['image_coverage'] < 0.8
+
+
+def test_hybrid_page_ocrs_only_image_rects(monkeypatch):
+    monkeypatch.setattr(pdf_utils, "_tesseract_available", lambda: True)
+    shapes = []
+
+    def fake_ocr_page(img, config="", output="text"):
+        shapes.append(img.shape)
+        return tesseract_data([("scanned", 0, 0, 300, 60, 90, 1), ("body", 0, 300, 300, 60, 90, 2)])
+
+    monkeypatch.setattr(pdf_utils.ocr_service, "ocr_page", fake_ocr_page)
+    blocks = pdf_utils.extract_text_blocks(make_hybrid_pdf(), workers=1)
+
+    # 300x150pt image rectangle at 300 DPI, not the full 300x200pt page
+    assert shapes == [(626, 1250)]
+    assert [(b["type"], b["text"]) for b in blocks] == [("text", "Header"), ("ocr", "scanned"), ("ocr", "body")]
+    # OCR pixels map back into the image rectangle, in PDF points
+    assert blocks[1]["bbox"] == [0.0, 50.0, 72.0, 64.4]
+    assert blocks[2]["bbox"] == [0.0, 122.0, 72.0, 136.4]
+
+
+def test_text_blocks_carry_real_geometry(monkeypatch):
+    fake_ocr(monkeypatch)
+    blocks = pdf_utils.extract_text_blocks(make_pdf(["first page", None]), workers=1)
+
+    text_block, ocr_block = blocks
+    x0, y0, x1, y1 = text_block["bbox"]
+    # insert_text((40, 60), ...) puts the baseline at y=60
+    assert x0 == pytest.approx(40, abs=1) and y0 < 60 < y1
+    assert text_block["lines"][0]["text"] == "first page"
+
+    # 100x50px and 60x50px words at 300 DPI on one line
+    assert ocr_block["text"] == "scanned 1250"
+    assert ocr_block["bbox"] == [0.0, 0.0, 43.2, 12.0]
+    assert ocr_block["lines"] == [{'bbox': [0.0, 0.0, 43.2, 12.0], 'text': "scanned 1250"}]
+    assert ocr_block["confidence"] == pytest.approx(0.9)
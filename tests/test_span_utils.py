@@ -0,0 +1,60 @@
+"""
+Tests for src/span_utils.py columnar span storage.
+"""
+
+import fitz
+import pytest
+
+from src.pdf_utils import extract_text_with_style
+from src.span_utils import SpanTable
+
+
+def make_styled_pdf():
+    doc = fitz.open()
+    for page_num in range(3):
+        page = doc.new_page(width=300, height=200)
+        page.insert_text((20, 40), f"Title {page_num}", fontname="helv", fontsize=18)
+        page.insert_text((20, 80), f"Body {page_num}", fontname="cour", fontsize=10)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+def reference_spans(pdf_bytes):
+    """The list of span dicts extract_text_with_style used to build."""
+    spans = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+        for page_num, page in enumerate(doc):
+            for block in page.get_text("dict")["blocks"]:
+                for line in block.get("lines", []):
+                    for span in line.get("spans", []):
+                        spans.append({"page": page_num, "text": span["text"], "bbox": span["bbox"],
+                                      "font": span["font"], "size": span["size"]})
+    return spans
+
+
+def test_span_table_matches_list_of_dicts():
+    pdf_bytes = make_styled_pdf()
+    table = extract_text_with_style(pdf_bytes)
+    expected = reference_spans(pdf_bytes)
+
+    assert isinstance(table, SpanTable)
+    assert len(table) == len(expected) == 6
+    # Exactly the values the old list of dicts held, bboxes and sizes included
+    assert table.to_dicts() == expected
+    assert list(table) == expected
+    # Fonts are interned once per name
+    assert len(table.fonts) == 2
+
+
+def test_span_table_page_and_slice_views():
+    table = SpanTable.from_spans(reference_spans(make_styled_pdf()))
+
+    page = table.page(1)
+    assert [span["text"] for span in page] == ["Title 1", "Body 1"]
+    assert len(table.page(7)) == 0
+    assert table[-1]["text"] == "Body 2"
+    assert table[2:4].texts() == ["Title 1", "Body 1"]
+    # Views share the parent's buffers
+    assert page.text is table.text
+    assert page.bboxes.base is not None
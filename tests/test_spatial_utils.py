@@ -0,0 +1,83 @@
+"""
+Tests for src/spatial_utils.py grid index.
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from src.spatial_utils import SpatialIndex
+from src.span_utils import SpanTable
+
+
+def random_boxes(count, seed=0):
+    rng = np.random.default_rng(seed)
+    origin = rng.uniform(0, 580, size=(count, 2))
+    size = rng.uniform(4, 60, size=(count, 2)) * [1, 0.3]
+    return np.hstack([origin, origin + size]).astype(np.float32)
+
+
+def test_queries_match_brute_force():
+    boxes = random_boxes(2000)
+    index = SpatialIndex(boxes)
+    rng = np.random.default_rng(1)
+
+    for _ in range(50):
+        x0, y0 = rng.uniform(0, 550, size=2)
+        rect = np.array([x0, y0, x0 + rng.uniform(1, 80), y0 + rng.uniform(1, 40)], dtype=np.float32)
+        overlaps = np.flatnonzero((boxes[:, 0] <= rect[2]) & (boxes[:, 2] >= rect[0]) &
+                                  (boxes[:, 1] <= rect[3]) & (boxes[:, 3] >= rect[1]))
+        inside = np.flatnonzero((boxes[:, 0] >= rect[0]) & (boxes[:, 2] <= rect[2]) &
+                                (boxes[:, 1] >= rect[1]) & (boxes[:, 3] <= rect[3]))
+        assert index.intersect(rect) == overlaps.tolist()
+        assert index.contains(rect) == inside.tolist()
+
+        px, py = rng.uniform(-50, 650, size=2)
+        dx = np.maximum(np.maximum(boxes[:, 0] - px, 0), px - boxes[:, 2])
+        dy = np.maximum(np.maximum(boxes[:, 1] - py, 0), py - boxes[:, 3])
+        nearest = index.nearest(px, py, k=3)
+        assert np.hypot(dx, dy)[nearest].tolist() == pytest.approx(np.sort(np.hypot(dx, dy))[:3].tolist())
+
+
+def test_nearest_far_from_the_page_stays_cheap():
+    boxes = random_boxes(200)
+    index = SpatialIndex(boxes)
+
+    for px, py in [(1e7, 1e7), (-1e7, 300), (300, -1e7)]:
+        dx = np.maximum(np.maximum(boxes[:, 0] - px, 0), px - boxes[:, 2])
+        dy = np.maximum(np.maximum(boxes[:, 1] - py, 0), py - boxes[:, 3])
+        start = time.perf_counter()
+        nearest = index.nearest(px, py, k=2)
+        assert time.perf_counter() - start < 1.0
+        assert np.hypot(dx, dy)[nearest].tolist() == pytest.approx(np.sort(np.hypot(dx, dy))[:2].tolist())
+
+
+def test_huge_query_rectangles_stay_cheap():
+    index = SpatialIndex([[10, 10, 20, 20], [100, 50, 140, 60]])
+
+    start = time.perf_counter()
+    assert index.intersect((-1e7, -1e7, 1e7, 1e7)) == [0, 1]
+    assert index.contains((0, 0, 1e7, 1e7)) == [0, 1]
+    assert index.intersect((1e6, 1e6, 2e6, 2e6)) == []
+    assert index.contains((-2e6, -2e6, -1e6, -1e6)) == []
+    assert time.perf_counter() - start < 1.0
+
+
+def test_pixel_queries_convert_dpi():
+    spans = SpanTable.from_spans([
+        {'page': 0, 'text': "Invoice", 'bbox': (72, 72, 144, 84), 'font': "helv", 'size': 12},
+        {'page': 0, 'text': "Total", 'bbox': (72, 300, 120, 312), 'font': "helv", 'size': 12},
+        {'page': 1, 'text': "Other", 'bbox': (72, 72, 144, 84), 'font': "helv", 'size': 12},
+    ])
+    index = SpatialIndex.from_spans(spans, page=0)
+
+    # A click at 300 DPI pixels on the first word
+    hits = index.at(400, 320, dpi=300)
+    assert [index.item(i)['text'] for i in hits] == ["Invoice"]
+    assert index.box(hits[0], dpi=300) == pytest.approx([300, 300, 600, 350])
+
+    regions = [{'bbox': [300, 300, 600, 350], 'text': "Invoice"}]
+    pixel_index = SpatialIndex.from_regions(regions, dpi=300)
+    assert pixel_index.intersect((70, 70, 80, 80)) == [0]
+    assert pixel_index.nearest(0, 0, dpi=300) == [0]
@@ -154,7 +154,7 @@ def check_quantum_edition_integration():
     
     try:
         # Import Quantum Edition modules
-        from src.erase_utils import erase_mode
+        from src.erase_utils import erase_sessions
         
         print("✅ Quantum Edition modules imported successfully")
         